@@ -0,0 +1,200 @@
+"""
+Replay a recorded workload (`--record_path` of the runners) through `ModelWrapper` against the
+mock backend, to compare concurrency, scheduling and rate limiting settings offline on
+production-shaped traffic.
+
+Requests are dispatched open-loop at their recorded times, with prompts of their recorded size.
+The backend answers each with its recorded latency and outcome (the recorded latency already
+includes the client's retries, so the replay client does not retry). Per-request and
+per-conversation completion latencies are reported for the recording and for the replay.
+
+    python -m benchmarks.replay_workload --record_path requests.jsonl --max_concurrent 20 --speedup 4
+"""
+
+import argparse
+import asyncio
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+import openai
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.classification as classification
+import emoclassifiers.metrics as metrics
+import emoclassifiers.mock_backend as mock_backend
+import emoclassifiers.recording as recording
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.tracing as tracing
+
+
+class ReplayBackend(mock_backend.MockBackend):
+    def __init__(self, records: list[recording.RequestRecord], speedup: float = 1.0):
+        """
+        A mock backend answering the replay of request `i` with the latency (divided by `speedup`),
+        outcome and token usage of `records[i]`.
+        """
+        super().__init__(mock_backend.MockBackendConfig())
+        self.records = records
+        self.speedup = speedup
+
+    def handle(self, body: dict) -> tuple[int, dict, dict, float]:
+        prompt = body["messages"][-1]["content"]
+        record = self.records[int(prompt.split(maxsplit=2)[1])]
+        latency = record.latency / self.speedup
+        if record.outcome != recording.OK_OUTCOME:
+            with self.lock:
+                self.stats["requests"] += 1
+                self.stats[record.outcome] += 1
+            # Errors without a status (connection errors, timeouts) are replayed as 503s.
+            status = record.status_code or 503
+            error = {"message": f"Replayed {record.outcome}", "type": "replay", "code": None}
+            return status, {}, {"error": error}, latency
+        status, headers, payload, _ = super().handle(body)
+        if record.prompt_tokens is not None:
+            payload["usage"] = {
+                "prompt_tokens": record.prompt_tokens,
+                "completion_tokens": record.completion_tokens,
+                "total_tokens": record.prompt_tokens + record.completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": record.cached_tokens},
+            }
+        return status, headers, payload, latency
+
+
+def get_replay_prompt(index: int, record: recording.RequestRecord) -> str:
+    """
+    A prompt identifying the record, padded to its recorded size.
+    """
+    prefix = f"replay {index} "
+    return prefix + "x" * max(0, record.prompt_chars - len(prefix))
+
+
+async def replay_request(
+    index: int,
+    record: recording.RequestRecord,
+    model_wrapper: classification.ModelWrapper,
+    start_time: float,
+    speedup: float,
+) -> dict:
+    await asyncio.sleep(max(0.0, record.dispatch_time / speedup - (time.perf_counter() - start_time)))
+    dispatch_time = time.perf_counter() - start_time
+    try:
+        await model_wrapper.request_completion(
+            classifier_definition={
+                "version": record.classifier_set,
+                "classifier_set": record.classifier_set,
+                "name": record.classifier,
+            },
+            prompt=get_replay_prompt(index, record),
+            max_completion_tokens=record.max_completion_tokens,
+        )
+        outcome = recording.OK_OUTCOME
+    except openai.APIError as e:
+        outcome = type(e).__name__
+    return {
+        "conversation": record.conversation,
+        "dispatch_time": dispatch_time,
+        "end_time": time.perf_counter() - start_time,
+        "outcome": outcome,
+    }
+
+
+async def replay(
+    records: list[recording.RequestRecord],
+    model_wrapper: classification.ModelWrapper,
+    speedup: float = 1.0,
+) -> list[dict]:
+    start_time = time.perf_counter()
+    futures = []
+    for index, record in enumerate(records):
+        future = replay_request(index, record, model_wrapper, start_time, speedup)
+        if record.conversation is not None:
+            future = scheduling.with_flow(future, flow=record.conversation)
+            future = tracing.traced_conversation(future, name=record.conversation)
+        futures.append(future)
+    return await asyncio.gather(*futures)
+
+
+def get_percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def summarize(requests: list[dict]) -> dict:
+    """
+    Summarize requests given as dicts of conversation, dispatch_time, end_time and outcome.
+    """
+    conversation_times = defaultdict(list)
+    for request in requests:
+        if request["conversation"] is not None:
+            conversation_times[request["conversation"]].append((request["dispatch_time"], request["end_time"]))
+    return {
+        "num_requests": len(requests),
+        "makespan": max(request["end_time"] for request in requests) - min(request["dispatch_time"] for request in requests),
+        "outcomes": dict(Counter(request["outcome"] for request in requests)),
+        "request_latency": get_percentiles([request["end_time"] - request["dispatch_time"] for request in requests]),
+        "conversation_latency": get_percentiles([
+            max(end for _, end in times) - min(dispatch for dispatch, _ in times)
+            for times in conversation_times.values()
+        ]),
+    }
+
+
+def print_summary(name: str, summary: dict):
+    print(f"{name}: {summary['num_requests']} requests in {summary['makespan']:.1f}s, outcomes {summary['outcomes']}")
+    for key in ("request_latency", "conversation_latency"):
+        percentiles = ", ".join(f"{q}={value:.3f}s" for q, value in summary[key].items())
+        print(f"  {key}: {percentiles or 'n/a'}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record_path", type=str, required=True)
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="fifo",
+        choices=list(scheduling.SCHEDULER_DICT),
+        help="fair: gating classifiers first, then fair sharing across classifier sets and conversations.",
+    )
+    parser.add_argument("--max_concurrent", type=int, default=20)
+    parser.add_argument("--speedup", type=float, default=1.0, help="Divide dispatch times and latencies by this.")
+    parser.add_argument("--limit", type=int, default=None, help="Only replay the first requests.")
+    parser.add_argument("--output_path", type=str, default=None)
+    args = parser.parse_args()
+    records = recording.load_records(args.record_path)[:args.limit]
+    backend = ReplayBackend(records, speedup=args.speedup)
+    client = mock_backend.get_backend_client(backend, max_retries=0)
+    model_wrapper = classification.ModelWrapper(
+        openai_client=client,
+        model=records[0].model,
+        max_concurrent=args.max_concurrent,
+        scheduler=args.scheduler,
+    )
+    replayed = asyncio.run(replay(records, model_wrapper, speedup=args.speedup))
+
+    recorded_summary = summarize([
+        {
+            "conversation": record.conversation,
+            "dispatch_time": record.dispatch_time / args.speedup,
+            "end_time": (record.dispatch_time + record.semaphore_wait + record.latency) / args.speedup,
+            "outcome": record.outcome,
+        }
+        for record in records
+    ])
+    replayed_summary = summarize(replayed)
+    replayed_summary["semaphore_wait"] = metrics.SEMAPHORE_WAIT.snapshot()
+    print_summary("Recorded", recorded_summary)
+    print_summary(f"Replayed (max_concurrent={args.max_concurrent})", replayed_summary)
+    if args.output_path is not None:
+        io_utils.save_json({
+            "config": vars(args),
+            "recorded": recorded_summary,
+            "replayed": replayed_summary,
+        }, args.output_path)
+        print(f"Saved results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
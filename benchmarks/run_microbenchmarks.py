@@ -0,0 +1,229 @@
+"""
+CPU microbenchmarks for the synchronous hot paths: chunking, prompt rendering, aggregation and
+JSONL I/O, on synthetic workloads of different shapes (see `synthetic.WORKLOAD_DICT`).
+
+Each benchmark is timed with `timeit` over `--repeat` rounds of at least `--min_time` seconds each,
+and run once under tracemalloc for its peak allocation. Rounds are interleaved across benchmarks,
+so that a slow period of the machine affects one round of many benchmarks rather than every round
+of a few. A fixed calibration workload runs in the same rounds, and times are scaled by its speed
+relative to the baselines, so that the machine running faster or slower overall is not taken for a
+change in the code. The scaled median time per call across rounds is compared with the baselines, and the run fails if a benchmark got slower by more than
+`--threshold` and by more than the absolute `--noise_floor` (per call), or allocates more by more
+than `--threshold`:
+
+    python -m benchmarks.run_microbenchmarks
+    python -m benchmarks.run_microbenchmarks --filter chunking/ --threshold 0.1
+
+Timings depend on the machine, so baselines should be saved on the machine that checks them
+(`--save_baselines`), after any intended change in performance.
+"""
+
+import argparse
+import functools
+import math
+import os
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from typing import Callable
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.classification as classification
+import emoclassifiers.aggregation as aggregation
+from emoclassifiers.chunking import CHUNKER_DICT, Chunker, Chunk
+from benchmarks import synthetic
+
+BASELINE_PATH = io_utils.get_path("benchmarks/microbenchmark_baselines.json")
+
+# Conversations per workload, so that each benchmark takes a few milliseconds or more.
+NUM_CONVERSATIONS_DICT = {
+    "short": 200,
+    "long": 50,
+    "many_turn": 20,
+    "huge_message": 10,
+}
+CHUNKERS = ("user_message", "u_a_exchange", "whole_budgeted")
+CLASSIFIER_SETS = ("v1", "v1_top_level", "v2", "question_tree")
+AGGREGATION_NUM_CHUNKS = (20, 200, 2000)
+# Allocation growth below this is noise (interning, caches), not a regression.
+MIN_PEAK_BYTES_INCREASE = 64 * 1024
+CALIBRATION = "calibration"
+
+
+def calibrate():
+    """
+    A fixed mix of string, dict and list work, independent of the code being benchmarked.
+    """
+    counts = {}
+    for i in range(5000):
+        word = f"word{i % 97}"
+        counts[word] = counts.get(word, 0) + len(word.upper().split("O"))
+    return sorted(counts.items())
+
+
+def chunk_all(chunker: Chunker, conversations: list[list[dict]]):
+    for conversation in conversations:
+        chunker.chunk_simple_convo(conversation)
+
+
+def render_all(classifier_definition: dict, chunks: list[Chunk]):
+    for chunk in chunks:
+        classification.get_emo_classifiers_prompt(classifier_definition=classifier_definition, chunk=chunk)
+
+
+def get_benchmarks(workloads: list[str], tmp_dir: str) -> dict[str, Callable[[], object]]:
+    """
+    Benchmarks by name, as functions of no arguments.
+    """
+    definitions = {
+        classifier_set: next(iter(classification.load_classifier_definitions(classifier_set).values()))
+        for classifier_set in CLASSIFIER_SETS
+    }
+    benchmarks = {}
+    for workload in workloads:
+        conversations = synthetic.generate_workload(workload, NUM_CONVERSATIONS_DICT[workload])
+        for chunker_name in CHUNKERS:
+            benchmarks[f"chunking/{chunker_name}/{workload}"] = functools.partial(
+                chunk_all, CHUNKER_DICT[chunker_name], conversations,
+            )
+        for classifier_set, definition in definitions.items():
+            chunks = [
+                chunk
+                for conversation in conversations
+                for chunk in CHUNKER_DICT[definition["chunker"]].chunk_simple_convo(conversation).values()
+            ]
+            benchmarks[f"render_prompt/{classifier_set}/{workload}"] = functools.partial(
+                render_all, definition, chunks,
+            )
+        records = [{"conversation": conversation} for conversation in conversations]
+        path = os.path.join(tmp_dir, f"{workload}.jsonl")
+        io_utils.save_jsonl(records, path)
+        benchmarks[f"io/save_jsonl/{workload}"] = functools.partial(
+            io_utils.save_jsonl, records, os.path.join(tmp_dir, f"{workload}.out.jsonl"),
+        )
+        benchmarks[f"io/load_jsonl/{workload}"] = functools.partial(io_utils.load_jsonl, path)
+    benchmarks[CALIBRATION] = calibrate
+    rng = random.Random(0)
+    for num_chunks in AGGREGATION_NUM_CHUNKS:
+        results = {
+            chunk_id: classification.YesNoUnsureEnum.YES if rng.random() < 0.05 else classification.YesNoUnsureEnum.NO
+            for chunk_id in range(num_chunks)
+        }
+        benchmarks[f"aggregate/adjusted/{num_chunks}"] = functools.partial(
+            aggregation.AdjustedAggregator.aggregate, results,
+        )
+        benchmarks[f"aggregate/any/{num_chunks}"] = functools.partial(aggregation.AnyAggregator.aggregate, results)
+    return benchmarks
+
+
+def run_benchmarks(benchmarks: dict[str, Callable[[], object]], repeat: int = 5, min_time: float = 0.1) -> dict:
+    """
+    Time each benchmark over `repeat` rounds, each calling it enough times to take at least
+    `min_time` seconds, taking one round of every benchmark at a time.
+    """
+    timers = {}
+    for name, fn in benchmarks.items():
+        timer = timeit.Timer(fn)
+        number, time_taken = timer.autorange()
+        timers[name] = (timer, max(number, math.ceil(number * min_time / time_taken)))
+    times = {name: [] for name in benchmarks}
+    for _ in range(repeat):
+        for name, (timer, number) in timers.items():
+            times[name].append(timer.timeit(number=number) / number)
+    results = {}
+    for name, fn in benchmarks.items():
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            "seconds": min(times[name]),
+            "median_seconds": sorted(times[name])[len(times[name]) // 2],
+            "peak_bytes": peak,
+        }
+    return results
+
+
+def get_speed(results: dict, baselines: dict) -> float:
+    """
+    Speed of the machine relative to when the baselines were saved, by the calibration workload.
+    """
+    if CALIBRATION not in results or CALIBRATION not in baselines:
+        return 1.0
+    return baselines[CALIBRATION]["median_seconds"] / results[CALIBRATION]["median_seconds"]
+
+
+def compare(result: dict, baseline: dict, threshold: float, noise_floor: float) -> list[str]:
+    """
+    Regressions of a (scaled) result against its baseline, as messages. Slowdowns of less than
+    `noise_floor` seconds per call are ignored.
+    """
+    regressions = []
+    for key in ("median_seconds", "peak_bytes"):
+        min_increase = noise_floor if key == "median_seconds" else MIN_PEAK_BYTES_INCREASE
+        if result[key] - baseline[key] < min_increase:
+            continue
+        if baseline[key] and result[key] > baseline[key] * (1 + threshold):
+            regressions.append(f"{key} {baseline[key]:.4g} -> {result[key]:.4g} (x{result[key] / baseline[key]:.2f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workloads", type=str, nargs="+", default=list(synthetic.WORKLOAD_DICT), choices=list(synthetic.WORKLOAD_DICT))
+    parser.add_argument("--filter", type=str, default=None, help="Only run benchmarks whose name contains this.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing rounds; their median is compared.")
+    parser.add_argument("--min_time", type=float, default=0.1, help="Minimum seconds per timing round.")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative slowdown or allocation growth.")
+    parser.add_argument(
+        "--noise_floor",
+        type=float,
+        default=2e-6,
+        help="Slowdowns below this many seconds per call are ignored, whatever their relative size.",
+    )
+    parser.add_argument("--baseline_path", type=str, default=BASELINE_PATH)
+    parser.add_argument("--save_baselines", action="store_true", help="Overwrite the baselines with this run.")
+    parser.add_argument("--output_path", type=str, default=None)
+    args = parser.parse_args()
+    baselines = {}
+    if os.path.exists(args.baseline_path):
+        baselines = io_utils.load_json(args.baseline_path)
+
+    failures = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmarks = {
+            name: fn
+            for name, fn in get_benchmarks(args.workloads, tmp_dir).items()
+            if name == CALIBRATION or args.filter is None or args.filter in name
+        }
+        results = run_benchmarks(benchmarks, repeat=args.repeat, min_time=args.min_time)
+        speed = get_speed(results, baselines)
+        print(f"Machine speed: x{speed:.2f} of baseline (times below are scaled by it)")
+        for name, result in results.items():
+            result = {**result, "median_seconds": result["median_seconds"] * speed}
+            status = "no baseline"
+            if name == CALIBRATION:
+                status = "calibration"
+            elif name in baselines:
+                regressions = compare(result, baselines[name], args.threshold, args.noise_floor)
+                if regressions:
+                    failures[name] = regressions
+                status = "REGRESSED: " + "; ".join(regressions) if regressions else (
+                    f"x{result['median_seconds'] / baselines[name]['median_seconds']:.2f} of baseline"
+                )
+            print(f"{name:<40} {result['median_seconds'] * 1e3:10.3f}ms {result['peak_bytes'] / 2**20:8.2f}MB  {status}")
+
+    if args.output_path is not None:
+        io_utils.save_json(results, args.output_path)
+    if args.save_baselines:
+        io_utils.save_json({**baselines, **results}, args.baseline_path)
+        print(f"Saved baselines to {args.baseline_path}")
+    elif failures:
+        print(f"{len(failures)} benchmarks regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+End-to-end load benchmark of the classification pipelines against the mock backend
+(no API calls). Each pipeline is run at each concurrency level on the same synthetic
+conversations, reporting throughput, request latency percentiles and memory. With
+`--hedge_percentiles`, each configuration is also run with hedged requests, to compare tail
+latency against the extra spend. With injected errors (`--rate_limit_rate`, `--error_rate`), a
+conversation that still fails after the client's retries is counted as failed and the run goes
+on; the result reports failed conversations, errors by type, 429 responses and retries.
+
+    python -m benchmarks.run_pipeline_benchmark --num_conversations 200 --concurrency 5 20 50 \
+        --latency_mean 0.5 --rate_limit_rate 0.01 --output_path benchmark.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import resource
+import time
+import tracemalloc
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.classification as classification
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.hedging as hedging
+import emoclassifiers.metrics as metrics
+import emoclassifiers.mock_backend as mock_backend
+import emoclassifiers.usage as usage
+import emoclassifiers.scheduling as scheduling
+import run_hierarchical_emoclassifiers_v1
+import run_efficient_question_classification
+from benchmarks import synthetic
+
+MODEL = "gpt-4o-mini"
+
+
+async def run_hierarchical_v1(model_wrapper: classification.ModelWrapper, conversations: list[list[dict]]) -> int:
+    top_level_classifiers = classification.load_classifiers("v1_top_level", model_wrapper=model_wrapper)
+    sub_classifiers = classification.load_classifiers("v1", model_wrapper=model_wrapper)
+    dependency_graph = io_utils.load_json(io_utils.get_path(
+        "assets/definitions/emoclassifiers_v1_dependency.json"
+    ))["dependency"]
+    # In batches of 10 as in run_hierarchical_emoclassifiers_v1.run_classification, except that
+    # a failed conversation is counted instead of failing the run.
+    num_completed = 0
+    for i in range(0, len(conversations), 10):
+        results = await asyncio.gather(
+            *(
+                scheduling.with_flow(
+                    run_hierarchical_emoclassifiers_v1.run_classification_on_single_conversation(
+                        conversation=conversation,
+                        top_level_classifiers=top_level_classifiers,
+                        sub_classifiers=sub_classifiers,
+                        dependency_graph=dependency_graph,
+                        aggregator=aggregation.AGGREGATOR_DICT["any"],
+                    ),
+                    flow=str(conversation_id),
+                )
+                for conversation_id, conversation in enumerate(conversations[i:i + 10], start=i)
+            ),
+            return_exceptions=True,
+        )
+        num_completed += sum(not isinstance(result, Exception) for result in results)
+    return num_completed
+
+
+async def run_question_tree(model_wrapper: classification.ModelWrapper, conversations: list[list[dict]]) -> int:
+    # Failed conversations are left out of the results (and their errors printed).
+    classifier = classification.load_classifiers("question_tree", model_wrapper=model_wrapper)["QUESTION_TYPE"]
+    results, _ = await run_efficient_question_classification.process_all_conversations(
+        conversations=[
+            {"conversation_hash": str(conversation_id), "conversation": conversation}
+            for conversation_id, conversation in enumerate(conversations)
+        ],
+        classifier=classifier,
+        batch_size=10,
+    )
+    return len(results)
+
+
+PIPELINE_DICT = {
+    "hierarchical_v1": run_hierarchical_v1,
+    "question_tree": run_question_tree,
+}
+
+
+async def run_benchmark(
+    pipeline: str,
+    conversations: list[list[dict]],
+    max_concurrent: int,
+    backend_config: mock_backend.MockBackendConfig,
+    scheduler: str = "fifo",
+    trace_memory: bool = False,
+    hedge_percentile: float | None = None,
+    max_hedge_rate: float = 0.05,
+) -> dict:
+    metrics.METRICS.reset()
+    client, backend = mock_backend.get_mock_client(backend_config)
+    usage_tracker = usage.UsageTracker()
+    hedging_policy = None
+    if hedge_percentile is not None:
+        hedging_policy = hedging.HedgingPolicy(percentile=hedge_percentile, max_hedge_rate=max_hedge_rate)
+    model_wrapper = classification.ModelWrapper(
+        openai_client=client,
+        model=MODEL,
+        max_concurrent=max_concurrent,
+        scheduler=scheduler,
+        usage_tracker=usage_tracker,
+        hedging_policy=hedging_policy,
+    )
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    # The pipelines print progress and per-conversation errors; keep the benchmark output readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        num_completed = await PIPELINE_DICT[pipeline](model_wrapper, conversations)
+    elapsed = time.perf_counter() - start_time
+    traced_peak = None
+    if trace_memory:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    await client.close()
+
+    num_requests = metrics.REQUESTS.total()
+    num_errors = metrics.ERRORS.total()
+    num_hedges = hedging_policy.num_hedges if hedging_policy is not None else 0
+    latency = metrics.REQUEST_LATENCY.snapshot()
+    semaphore_wait = metrics.SEMAPHORE_WAIT.snapshot()
+    return {
+        "pipeline": pipeline,
+        "max_concurrent": max_concurrent,
+        "scheduler": scheduler,
+        "hedge_percentile": hedge_percentile,
+        "num_conversations": len(conversations),
+        "num_completed": num_completed,
+        "elapsed_seconds": elapsed,
+        "conversations_per_second": num_completed / elapsed,
+        "requests": num_requests,
+        "requests_per_second": num_requests / elapsed,
+        "request_latency": latency.get(metrics.format_labels((("model", MODEL),))),
+        "semaphore_wait": semaphore_wait.get(metrics.format_labels((("model", MODEL),))),
+        "failed_conversations": len(conversations) - num_completed,
+        "errors": metrics.ERRORS.snapshot(),
+        "rate_limited": backend.stats["rate_limited"],
+        # Requests the backend received beyond the wrapper's attempts (answered or failed) and hedges.
+        "retries": int(backend.stats["requests"] - num_requests - num_errors - num_hedges),
+        "backend": dict(backend.stats),
+        "usage": usage_tracker.report()["total"],
+        "hedging": hedging_policy.report() if hedging_policy is not None else None,
+        # ru_maxrss is in KiB on Linux; it only grows, so later runs report the peak so far.
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "traced_peak_mb": traced_peak / 2**20 if traced_peak is not None else None,
+    }
+
+
+def print_result(result: dict):
+    latency = result["request_latency"] or {}
+    print(
+        f"{result['pipeline']:<16} {result['scheduler']:<5} concurrency={result['max_concurrent']:<4}"
+        f" {result['conversations_per_second']:8.2f} conv/s"
+        f" {result['requests_per_second']:8.1f} req/s"
+        f"  latency p50={latency.get('p50', float('nan')):.3f}s"
+        f" p95={latency.get('p95', float('nan')):.3f}s"
+        f" p99={latency.get('p99', float('nan')):.3f}s"
+        f"  cost=${result['usage']['cost']:.4f}"
+        + (
+            f" hedged={result['hedging']['hedge_rate']:.1%} (p{result['hedge_percentile']:g})"
+            if result["hedging"] is not None else ""
+        )
+        + f"  completed={result['num_completed']}/{result['num_conversations']}"
+        + (
+            f" (429s={result['rate_limited']} retries={result['retries']} errors={sum(result['errors'].values()):g})"
+            if result["rate_limited"] or result["errors"] else ""
+        )
+        + f"  max_rss={result['max_rss_mb']:.0f}MB"
+        + (f" traced_peak={result['traced_peak_mb']:.1f}MB" if result["traced_peak_mb"] is not None else "")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pipelines", type=str, nargs="+", default=list(PIPELINE_DICT), choices=list(PIPELINE_DICT))
+    parser.add_argument(
+        "--schedulers",
+        type=str,
+        nargs="+",
+        default=["fifo", "fair"],
+        choices=list(scheduling.SCHEDULER_DICT),
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[5, 20, 50])
+    parser.add_argument(
+        "--hedge_percentiles",
+        type=float,
+        nargs="+",
+        default=[],
+        help="Also run each configuration with hedged requests at these latency percentiles.",
+    )
+    parser.add_argument("--max_hedge_rate", type=float, default=0.05)
+    parser.add_argument("--num_conversations", type=int, default=100)
+    parser.add_argument("--mean_turns", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency_distribution", type=str, default="lognormal", choices=["constant", "uniform", "lognormal"])
+    parser.add_argument("--latency_mean", type=float, default=0.5)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--latency_per_1k_prompt_tokens", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--trace_memory", action="store_true", help="Also report the tracemalloc peak (slower).")
+    parser.add_argument("--output_path", type=str, default=None)
+    args = parser.parse_args()
+    conversations = synthetic.generate_conversations(
+        args.num_conversations, seed=args.seed, mean_turns=args.mean_turns,
+    )
+    backend_config = mock_backend.MockBackendConfig(
+        latency_distribution=args.latency_distribution,
+        latency_mean=args.latency_mean,
+        latency_sigma=args.latency_sigma,
+        latency_per_1k_prompt_tokens=args.latency_per_1k_prompt_tokens,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    results = []
+    for pipeline in args.pipelines:
+        for scheduler in args.schedulers:
+            for max_concurrent in args.concurrency:
+                for hedge_percentile in [None, *args.hedge_percentiles]:
+                    result = asyncio.run(run_benchmark(
+                        pipeline=pipeline,
+                        conversations=conversations,
+                        max_concurrent=max_concurrent,
+                        backend_config=backend_config,
+                        scheduler=scheduler,
+                        trace_memory=args.trace_memory,
+                        hedge_percentile=hedge_percentile,
+                        max_hedge_rate=args.max_hedge_rate,
+                    ))
+                    print_result(result)
+                    results.append(result)
+    if args.output_path is not None:
+        io_utils.save_json({"config": vars(args), "results": results}, args.output_path)
+        print(f"Saved results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Open-loop load test of run_classification_service.py: conversations are submitted at a fixed
+rate (Poisson arrivals), whether or not earlier ones have been answered, reporting throughput,
+latency percentiles and the share of requests rejected or shed. With `--growing`, each synthetic
+conversation is submitted once per turn as it grows, as when classifying conversations online.
+
+    python run_classification_service.py --mock_backend --latency_mean 0.3 --port 8080 &
+    python -m benchmarks.run_service_load_test --url http://127.0.0.1:8080 --rates 5 20 50 --duration 30
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+import httpx
+
+import emoclassifiers.io_utils as io_utils
+from emoclassifiers.hedging import get_percentiles
+from benchmarks import synthetic
+
+
+def get_requests(conversations: list[list[dict]], growing: bool) -> list[list[dict]]:
+    if not growing:
+        return conversations
+    # Every prefix ending with an assistant message, in order, one conversation after the other.
+    return [conversation[:end] for conversation in conversations for end in range(2, len(conversation) + 1, 2)]
+
+
+async def send(client: httpx.AsyncClient, conversation: list[dict], statuses: Counter, latencies: list[float]):
+    start_time = time.perf_counter()
+    try:
+        response = await client.post("/classify", json={"conversation": conversation})
+        status = str(response.status_code)
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    statuses[status] += 1
+    if status == "200":
+        latencies.append(time.perf_counter() - start_time)
+
+
+async def run_load(url: str, requests: list[list[dict]], rate: float, duration: float, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    statuses = Counter()
+    latencies = []
+    tasks = []
+    async with httpx.AsyncClient(base_url=url, timeout=None, limits=httpx.Limits(max_connections=1000)) as client:
+        start_time = time.perf_counter()
+        next_time = start_time
+        while next_time - start_time < duration:
+            await asyncio.sleep(max(0.0, next_time - time.perf_counter()))
+            tasks.append(asyncio.create_task(send(client, requests[len(tasks) % len(requests)], statuses, latencies)))
+            next_time += rng.expovariate(rate)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start_time
+        stats = (await client.get("/stats")).json()
+    return {
+        "rate": rate,
+        "requests": len(tasks),
+        "elapsed_seconds": elapsed,
+        "answered_per_second": len(latencies) / elapsed,
+        "statuses": dict(statuses),
+        "latency": get_percentiles(latencies),
+        "service": stats,
+    }
+
+
+def print_result(result: dict):
+    latency = result["latency"]
+    print(
+        f"rate={result['rate']:<6g} {result['answered_per_second']:7.2f} answered/s"
+        f"  latency p50={latency.get('p50', float('nan')):.3f}s"
+        f" p95={latency.get('p95', float('nan')):.3f}s"
+        f" p99={latency.get('p99', float('nan')):.3f}s"
+        f"  statuses={result['statuses']}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080")
+    parser.add_argument("--rates", type=float, nargs="+", default=[5.0, 20.0], help="Requests per second.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of arrivals per rate.")
+    parser.add_argument("--num_conversations", type=int, default=200)
+    parser.add_argument("--workload", type=str, default="short", choices=list(synthetic.WORKLOAD_DICT))
+    parser.add_argument("--growing", action="store_true", help="Submit every conversation once per turn.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output_path", type=str, default=None)
+    args = parser.parse_args()
+    conversations = synthetic.generate_workload(args.workload, args.num_conversations, seed=args.seed)
+    requests = get_requests(conversations, growing=args.growing)
+    results = []
+    for rate in args.rates:
+        result = asyncio.run(run_load(args.url, requests, rate=rate, duration=args.duration, seed=args.seed))
+        print_result(result)
+        results.append(result)
+    stats = results[-1]["service"]
+    print(f"Service: {stats['service']}")
+    print(f"Deduplication: {stats.get('deduplication')}")
+    if args.output_path is not None:
+        io_utils.save_json({"config": vars(args), "results": results}, args.output_path)
+        print(f"Saved results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
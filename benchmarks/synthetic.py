@@ -0,0 +1,72 @@
+"""
+Deterministic synthetic conversations for benchmarks, in the `{"role", "content"}` format
+the classifiers take.
+"""
+
+import random
+
+WORDS = (
+    "i feel like nobody really listens to me lately and it is getting hard to focus on work "
+    "can you help me plan my week so that i have time for friends family exercise and rest "
+    "thank you that actually makes a lot of sense i appreciate you taking the time to explain "
+    "sometimes i wonder whether you understand how i feel or if you are just a program "
+    "what would you recommend for someone who is anxious about an upcoming job interview "
+    "here is the code that keeps failing with a key error when the input file is empty"
+).split()
+
+
+def generate_message(rng: random.Random, role: str, mean_words: int) -> dict:
+    num_words = max(1, int(rng.expovariate(1 / mean_words)))
+    words = [rng.choice(WORDS) for _ in range(num_words)]
+    content = " ".join(words).capitalize()
+    if role == "user" and rng.random() < 0.5:
+        content += "?"
+    return {"role": role, "content": content}
+
+
+def generate_conversation(
+    rng: random.Random,
+    mean_turns: int = 4,
+    mean_user_words: int = 40,
+    mean_assistant_words: int = 150,
+    huge_message_words: int = 0,
+) -> list[dict]:
+    """
+    A conversation of alternating user and assistant messages, starting with the user.
+    If `huge_message_words` is set, one random message is replaced by one of that many words
+    (e.g. a pasted document or log).
+    """
+    num_turns = max(1, int(rng.expovariate(1 / mean_turns)) + 1)
+    conversation = []
+    for _ in range(num_turns):
+        conversation.append(generate_message(rng, "user", mean_user_words))
+        conversation.append(generate_message(rng, "assistant", mean_assistant_words))
+    if huge_message_words:
+        idx = rng.randrange(len(conversation))
+        conversation[idx] = {
+            "role": conversation[idx]["role"],
+            "content": " ".join(rng.choice(WORDS) for _ in range(huge_message_words)),
+        }
+    return conversation
+
+
+def generate_conversations(num_conversations: int, seed: int = 0, **kwargs) -> list[list[dict]]:
+    """
+    `num_conversations` conversations; the same seed always gives the same conversations.
+    """
+    rng = random.Random(seed)
+    return [generate_conversation(rng, **kwargs) for _ in range(num_conversations)]
+
+
+
+# Conversation shapes for benchmarks, as arguments of `generate_conversation`.
+WORKLOAD_DICT = {
+    "short": {"mean_turns": 1, "mean_user_words": 20, "mean_assistant_words": 60},
+    "long": {"mean_turns": 4, "mean_user_words": 200, "mean_assistant_words": 800},
+    "many_turn": {"mean_turns": 60, "mean_user_words": 30, "mean_assistant_words": 100},
+    "huge_message": {"mean_turns": 3, "huge_message_words": 50000},
+}
+
+
+def generate_workload(workload: str, num_conversations: int, seed: int = 0) -> list[list[dict]]:
+    return generate_conversations(num_conversations, seed=seed, **WORKLOAD_DICT[workload])
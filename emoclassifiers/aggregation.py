@@ -1,11 +1,13 @@
 from math import comb
 from typing import Any
 
-from emoclassifiers.classification import YesNoUnsureEnum
+from emoclassifiers.classification import ChunkClassification, YesNoUnsureEnum
 
 
 
 class Aggregator:
+    # Whether the aggregator needs detailed results (`EmoClassifier.classify_conversation_detailed`).
+    requires_detailed_results = False
 
     @classmethod
     def aggregate(cls, results: dict[str, YesNoUnsureEnum]) -> Any:
@@ -70,8 +72,48 @@ class AdjustedAggregator(Aggregator):
         return expected_value
 
 
+def get_yes_probability(result: ChunkClassification | YesNoUnsureEnum) -> float:
+    """
+    Probability that a chunk is a YES. Falls back to 0/1 if no label distribution is available.
+    """
+    if isinstance(result, ChunkClassification):
+        if result.label_probabilities is not None:
+            return result.label_probabilities.get(YesNoUnsureEnum.YES.value, 0.0)
+        result = result.label
+    return 1.0 if result == YesNoUnsureEnum.YES else 0.0
+
+
+class NoisyOrAggregator(Aggregator):
+    """
+    Probability that at least one chunk is a YES, treating chunks as independent.
+    """
+    requires_detailed_results = True
+
+    @classmethod
+    def aggregate(cls, results: dict[str, ChunkClassification | YesNoUnsureEnum]) -> float:
+        prob_none = 1.0
+        for val in results.values():
+            prob_none *= 1.0 - get_yes_probability(val)
+        return 1.0 - prob_none
+
+
+class MeanProbabilityAggregator(Aggregator):
+    """
+    Mean probability of YES across chunks.
+    """
+    requires_detailed_results = True
+
+    @classmethod
+    def aggregate(cls, results: dict[str, ChunkClassification | YesNoUnsureEnum]) -> float:
+        if not results:
+            return 0.0
+        return sum(get_yes_probability(val) for val in results.values()) / len(results)
+
+
 AGGREGATOR_DICT = {
     "raw": RawAggregator,
     "any": AnyAggregator,
     "adjusted": AdjustedAggregator,
-}
\ No newline at end of file
+    "noisy_or": NoisyOrAggregator,
+    "mean_probability": MeanProbabilityAggregator,
+}
@@ -0,0 +1,185 @@
+"""
+Model cascades: query a cheaper/faster model first and escalate to a stronger model
+only when the answer is UNSURE, fails to parse, or is not confident enough.
+"""
+
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+import pydantic
+
+from emoclassifiers.chunking import Chunk
+from emoclassifiers.classification import (
+    ChunkClassification,
+    ModelWrapper,
+    YesNoUnsureEnum,
+    QuestionTypeEnum,
+    IntentTypeEnum,
+    PARSE_ERRORS,
+    get_classifier_name,
+)
+
+
+class EscalationPolicy(pydantic.BaseModel):
+    """
+    When to escalate a result to the next tier of a cascade.
+    `min_probability` only applies to tiers that return probabilities
+    (e.g. a ModelWrapper with request_logprobs=True).
+    """
+    escalate_on_unsure: bool = True
+    escalate_on_parse_error: bool = True
+    min_probability: float | None = None
+    escalate_labels: list[str] = []
+
+    def get_escalation_reason(self, result: ChunkClassification) -> str | None:
+        """
+        Return the reason to escalate a result, or None to accept it.
+        """
+        if self.escalate_on_unsure and result.label == YesNoUnsureEnum.UNSURE:
+            return "unsure"
+        if result.label.value in self.escalate_labels:
+            return "label"
+        if (
+            self.min_probability is not None
+            and result.probability is not None
+            and result.probability < self.min_probability
+        ):
+            return "low_confidence"
+        return None
+
+
+class TierStats:
+    """
+    Call, escalation and latency statistics for one tier of a cascade.
+    Latency percentiles are over the last `reservoir_size` calls.
+    """
+    def __init__(self, model: str, reservoir_size: int = 10000):
+        self.model = model
+        self.calls = defaultdict(int)
+        self.escalations = defaultdict(lambda: defaultdict(int))
+        self.latencies = deque(maxlen=reservoir_size)
+
+    def report(self) -> dict:
+        total_calls = sum(self.calls.values())
+        total_escalations = sum(sum(reasons.values()) for reasons in self.escalations.values())
+        return {
+            "model": self.model,
+            "calls": total_calls,
+            "escalations": total_escalations,
+            "escalation_rate": total_escalations / total_calls if total_calls else 0.0,
+            "latency_p50": float(np.percentile(self.latencies, 50)) if self.latencies else None,
+            "latency_p95": float(np.percentile(self.latencies, 95)) if self.latencies else None,
+            "by_classifier": {
+                name: {
+                    "calls": calls,
+                    "escalations": dict(self.escalations[name]),
+                }
+                for name, calls in self.calls.items()
+            },
+        }
+
+
+class CascadeModelWrapper:
+    # Packed and localized requests would bypass the escalation policy (see `EmoClassifier`).
+    PER_CHUNK_ONLY = True
+
+    def __init__(
+        self,
+        tiers: list[ModelWrapper],
+        default_policy: EscalationPolicy | None = None,
+        policies: dict[str, EscalationPolicy] | None = None,
+    ):
+        """
+        A cascade over model wrappers, ordered from cheapest to strongest. Each chunk is sent
+        to the first tier, and re-sent to the next tier only if the escalation policy asks for it.
+        The last tier's answer is always accepted (and its errors are raised).
+
+        The policy for a classifier is taken from `policies` (by classifier name), then from the
+        "escalation" key of the classifier definition, then `default_policy`.
+        """
+        assert tiers, "A cascade needs at least one tier"
+        self.tiers = tiers
+        self.default_policy = default_policy or EscalationPolicy()
+        self.policies = policies or {}
+        self.tier_stats = [TierStats(model=tier.model) for tier in tiers]
+
+    def __getattr__(self, name):
+        # Expose the strongest tier's attributes (model, scheduler, ...).
+        return getattr(self.tiers[-1], name)
+
+    def get_policy(self, classifier_definition: dict) -> EscalationPolicy:
+        name = get_classifier_name(classifier_definition)
+        if name in self.policies:
+            return self.policies[name]
+        if "escalation" in classifier_definition:
+            return EscalationPolicy(**classifier_definition["escalation"])
+        return self.default_policy
+
+    async def classify_conversation_chunk(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        max_completion_tokens: int = 20,
+    ) -> YesNoUnsureEnum | QuestionTypeEnum | IntentTypeEnum:
+        """
+        Classify a single conversation chunk through the cascade.
+        """
+        result = await self.classify_conversation_chunk_detailed(
+            classifier_definition=classifier_definition,
+            chunk=chunk,
+            max_completion_tokens=max_completion_tokens,
+        )
+        return result.label
+
+    async def classify_conversation_chunk_detailed(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        max_completion_tokens: int = 20,
+    ) -> ChunkClassification:
+        """
+        Classify a single conversation chunk through the cascade.
+        """
+        name = get_classifier_name(classifier_definition)
+        policy = self.get_policy(classifier_definition)
+        for tier_idx, (tier, stats) in enumerate(zip(self.tiers, self.tier_stats)):
+            is_last_tier = tier_idx == len(self.tiers) - 1
+            stats.calls[name] += 1
+            start_time = time.perf_counter()
+            try:
+                result = await tier.classify_conversation_chunk_detailed(
+                    classifier_definition=classifier_definition,
+                    chunk=chunk,
+                    max_completion_tokens=max_completion_tokens,
+                )
+            except PARSE_ERRORS:
+                if is_last_tier or not policy.escalate_on_parse_error:
+                    raise
+                stats.escalations[name]["parse_error"] += 1
+                continue
+            finally:
+                stats.latencies.append(time.perf_counter() - start_time)
+            if is_last_tier:
+                return result
+            reason = policy.get_escalation_reason(result)
+            if reason is None:
+                return result
+            stats.escalations[name][reason] += 1
+
+    def report(self) -> list[dict]:
+        """
+        Per-tier call counts, escalation rates and latency percentiles.
+        """
+        return [stats.report() for stats in self.tier_stats]
+
+    def print_report(self):
+        print("\nCascade statistics:")
+        for tier_idx, tier_report in enumerate(self.report()):
+            p50 = tier_report["latency_p50"]
+            p95 = tier_report["latency_p95"]
+            latency_str = "n/a" if p50 is None else f"p50 {p50:.2f}s, p95 {p95:.2f}s"
+            print(
+                f"- tier {tier_idx} ({tier_report['model']}): {tier_report['calls']} calls,"
+                f" escalated {tier_report['escalation_rate']:.1%}, latency {latency_str}"
+            )
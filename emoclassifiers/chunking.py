@@ -2,6 +2,8 @@
 Conversation chunking code. Shared with MIT.
 """
 
+from typing import Callable
+
 import pydantic
 
 USER = "user"
@@ -12,6 +14,10 @@ class Chunker:
     """
     Base class for chunking conversations.
     """
+    # Whether chunk ids are the index of the first message of the chunk (the chunk is contiguous
+    # from there), so message positions in a chunk map to message indices in the conversation.
+    KEYED_BY_START_INDEX = False
+
     def chunk_simple_convo(self, simple_convo: list[dict], n_context: int = 3) -> dict:
         """
         Chunk a conversation.
@@ -26,6 +32,8 @@ class Chunk(pydantic.BaseModel):
     """
     chunk: list[dict]
     touches_start: bool
+    # Rendered strings by compression settings, see `to_cached_string`.
+    _rendered: dict = pydantic.PrivateAttr(default_factory=dict)
 
     @classmethod
     def from_simple_convo(cls, simple_convo: list[dict], idx: int, n_context: int = 3) -> "Chunk":
@@ -39,15 +47,23 @@ class Chunk(pydantic.BaseModel):
             touches_start=start_idx == 0,
         )
 
-    def to_string(self, include_start_indicator: bool = True, do_truncate: bool = False) -> str:
+    def to_string(
+        self,
+        include_start_indicator: bool = True,
+        do_truncate: bool = False,
+        compressor: Callable[[str, str], str] | None = None,
+    ) -> str:
         """
         Convert a chunk to a string.
+        `compressor` optionally rewrites each message's content given (content, role).
         """
         elems = []
         if include_start_indicator and self.touches_start:
             elems.append("(This is the start of the conversation.)")
         for i, message in enumerate(self.chunk):
             content = message["content"].strip()
+            if compressor is not None:
+                content = compressor(content, message["role"])
             if do_truncate:
                 content = truncate_string(content, sep="[[...Long Message Truncated...]]")
             elems.append(
@@ -59,6 +75,22 @@ class Chunk(pydantic.BaseModel):
             )
         return "\n".join(elems)
 
+    def to_cached_string(self, key: str, compressor: Callable[[str, str], str] | None = None) -> str:
+        """
+        `to_string` with a compressor, cached under `key` (identifying the compressor), so that
+        classifiers sharing this chunk (see `ChunkPlan`) render it once.
+        """
+        if key not in self._rendered:
+            self._rendered[key] = self.to_string(compressor=compressor)
+        return self._rendered[key]
+
+
+def estimate_num_tokens(string: str) -> int:
+    """
+    Rough local token estimate (~4 characters per token), used for budgeting.
+    """
+    return (len(string) + 3) // 4
+
 
 def truncate_string(string: str, max_len: int = 1500, sep: str = "[...]") -> str:
     """
@@ -140,6 +172,8 @@ class WholeConversationChunker(Chunker):
     """
     Chunk a whole conversation.
     """
+    KEYED_BY_START_INDEX = True
+
     @classmethod
     def chunk_simple_convo(cls, simple_convo: list[dict], n_context: int = 3) -> dict:
         if not simple_convo:
@@ -147,10 +181,85 @@ class WholeConversationChunker(Chunker):
         return {0: Chunk(chunk=simple_convo, touches_start=True)}
 
 
+class BudgetedWholeConversationChunker(Chunker):
+    """
+    Chunk a whole conversation into overlapping windows that each stay under a token budget.
+    Messages longer than `max_message_chars` are truncated first, so a single outlier message
+    cannot blow up the prompt. Short conversations produce a single chunk, like
+    WholeConversationChunker. Keys are the index of the first message of each window.
+    """
+    KEYED_BY_START_INDEX = True
+
+    def __init__(self, max_tokens: int = 8000, overlap: int = 2, max_message_chars: int = 8000):
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.max_message_chars = max_message_chars
+
+    def chunk_simple_convo(self, simple_convo: list[dict], n_context: int = 3) -> dict:
+        if not simple_convo:
+            return {}
+        messages = [
+            {
+                **message,
+                "content": truncate_string(
+                    message["content"].strip(),
+                    max_len=self.max_message_chars,
+                    sep="[[...Long Message Truncated...]]",
+                ),
+            }
+            for message in simple_convo
+        ]
+        # Account for the role tag and quotes around each message.
+        message_tokens = [estimate_num_tokens(message["content"]) + 5 for message in messages]
+        chunks = {}
+        start = 0
+        while True:
+            end = start + 1
+            num_tokens = message_tokens[start]
+            while end < len(messages) and num_tokens + message_tokens[end] <= self.max_tokens:
+                num_tokens += message_tokens[end]
+                end += 1
+            chunks[start] = Chunk(chunk=messages[start:end], touches_start=start == 0)
+            if end == len(messages):
+                return chunks
+            start = max(end - self.overlap, start + 1)
+
+
 CHUNKER_DICT = {
     "user_message": UserMessageChunker(),
     "assistant_message": AssistantMessageChunker(),
     "u_a_exchange": UserAssistantExchangeChunker(),
     "a_u_exchange": AssistantUserExchangeChunker(),
     "whole": WholeConversationChunker,
+    "whole_budgeted": BudgetedWholeConversationChunker(),
 }
+
+
+def get_chunker(chunker: str, chunker_kwargs: dict | None = None) -> Chunker:
+    """
+    Get a chunker by name. If `chunker_kwargs` is given (the "chunker_kwargs" of a classifier
+    definition, e.g. the `max_tokens` of `whole_budgeted`), a new chunker of the same class is
+    configured with them.
+    """
+    if not chunker_kwargs:
+        return CHUNKER_DICT[chunker]
+    chunker_class = CHUNKER_DICT[chunker]
+    if not isinstance(chunker_class, type):
+        chunker_class = type(chunker_class)
+    return chunker_class(**chunker_kwargs)
+
+
+class ChunkPlan:
+    """
+    The chunks of a conversation, computed once per chunker and shared by all the classifiers
+    (of any classifier set) using that chunker, along with their rendered strings.
+    """
+    def __init__(self, simple_convo: list[dict]):
+        self.simple_convo = simple_convo
+        self.chunks = {}
+
+    def get_chunks(self, chunker: str, chunker_kwargs: dict | None = None) -> dict[int, Chunk]:
+        key = (chunker, tuple(sorted((chunker_kwargs or {}).items())))
+        if key not in self.chunks:
+            self.chunks[key] = get_chunker(chunker, chunker_kwargs).chunk_simple_convo(self.simple_convo)
+        return self.chunks[key]
@@ -1,10 +1,32 @@
 import asyncio
+import functools
+import json
+import math
+import time
 from enum import Enum
+from typing import TYPE_CHECKING
 import openai
 import pydantic
+import emoclassifiers.dead_letter as dead_letter
+import emoclassifiers.deadlines as deadlines
 import emoclassifiers.io_utils as io_utils
-from emoclassifiers.chunking import Chunk, CHUNKER_DICT
+import emoclassifiers.metrics as metrics
+from emoclassifiers.chunking import Chunk, ChunkPlan, estimate_num_tokens, get_chunker
+from emoclassifiers.compression import get_compressor
+from emoclassifiers.dedupe import RequestDeduplicator
+from emoclassifiers.hedging import HedgingPolicy
+import emoclassifiers.packing as packing
+import emoclassifiers.profiling as profiling
 import emoclassifiers.prompt_templates as prompt_templates
+from emoclassifiers.rate_limiting import SharedTokenBucket
+import emoclassifiers.recording as recording
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.tracing as tracing
+from emoclassifiers.usage import UsageTracker
+
+if TYPE_CHECKING:
+    # Only needed with a client pool, and needs httpx.
+    from emoclassifiers.client_pool import ClientPool
 
 
 CLASSIFIER_DEFINITION_PATH_DICT = {
@@ -46,13 +68,241 @@ class IntentTypeEnum(Enum):
     NONE = "none"
 
 
+class ClassificationStatusEnum(Enum):
+    """
+    Marker in place of a label for a chunk that was not classified.
+    """
+    TIMEOUT = "timeout"
+    ERROR = "error"
+
+
 class ResponseFormat(pydantic.BaseModel):
     """
-    Response format for structured completion.
+    Response format for structured completion, covering all label sets.
+    ModelWrapper uses the narrowed per-label-set formats from `get_response_format` instead.
     """
     response: YesNoUnsureEnum | QuestionTypeEnum | IntentTypeEnum
 
 
+LABEL_SET_DICT = {
+    "yes_no_unsure": YesNoUnsureEnum,
+    "question_type": QuestionTypeEnum,
+    "intent_type": IntentTypeEnum,
+}
+
+# Label set produced by each classifier version.
+VERSION_LABEL_ENUM_DICT = {
+    "v1": YesNoUnsureEnum,
+    "v1_top_level": YesNoUnsureEnum,
+    "v2": YesNoUnsureEnum,
+    "question_tree": QuestionTypeEnum,
+    "intent": YesNoUnsureEnum,
+}
+
+
+@functools.cache
+def get_response_format_for_label_enum(label_enum: type[Enum]) -> type[pydantic.BaseModel]:
+    """
+    Build (once per label set) a response format that only admits labels of `label_enum`,
+    and no other fields. No docstring is attached, to keep the JSON schema sent with each
+    request small.
+    """
+    return pydantic.create_model(
+        label_enum.__name__.removesuffix("Enum") + "ResponseFormat",
+        __config__=pydantic.ConfigDict(extra="forbid"),
+        response=(label_enum, ...),
+    )
+
+# Decoding modes: a JSON structured output, or a single label token read through logprobs.
+STRUCTURED_DECODING = "structured"
+LABEL_TOKEN_DECODING = "label_token"
+
+
+class ChunkClassification(pydantic.BaseModel):
+    """
+    Detailed classification result for a single chunk.
+    `probability` is the model's probability for the label, and `label_probabilities`
+    the distribution over all labels, if available. `message_indices` are the indices (in the
+    conversation) of the messages behind the label, for localized classifications.
+    """
+    label: YesNoUnsureEnum | QuestionTypeEnum | IntentTypeEnum | ClassificationStatusEnum
+    probability: float | None = None
+    label_probabilities: dict[str, float] | None = None
+    model: str | None = None
+    message_indices: list[int] | None = None
+
+
+TIMED_OUT = ChunkClassification(label=ClassificationStatusEnum.TIMEOUT)
+# Result of a chunk whose request failed, if failed chunks are dead-lettered.
+FAILED = ChunkClassification(label=ClassificationStatusEnum.ERROR)
+
+
+def get_timed_out_chunk_ids(results: dict) -> list:
+    """
+    Keys of the chunks in (detailed or plain) classification results that timed out.
+    """
+    return [
+        key for key, result in results.items()
+        if (result.label if isinstance(result, ChunkClassification) else result) == ClassificationStatusEnum.TIMEOUT
+    ]
+
+
+def get_neighborhood_chunk_ids(results_list: list[dict], radius: int) -> set[int] | None:
+    """
+    Message indices within `radius` messages of those behind the "yes" chunks of localized
+    (detailed) classification results, or None if a "yes" chunk is not localized.
+    """
+    chunk_ids = set()
+    for results in results_list:
+        for result in results.values():
+            if result.label != YesNoUnsureEnum.YES:
+                continue
+            if not result.message_indices:
+                return None
+            for idx in result.message_indices:
+                chunk_ids.update(range(idx - radius, idx + radius + 1))
+    return chunk_ids
+
+
+# Errors raised when a response cannot be parsed into a label.
+PARSE_ERRORS = (
+    AssertionError,
+    pydantic.ValidationError,
+    openai.LengthFinishReasonError,
+    openai.ContentFilterFinishReasonError,
+)
+
+
+def parse_label(value: str) -> YesNoUnsureEnum | QuestionTypeEnum | IntentTypeEnum:
+    """
+    Convert a label string (e.g. from a definition file or stored results) to its enum.
+    """
+    for enum_cls in (YesNoUnsureEnum, QuestionTypeEnum, IntentTypeEnum):
+        try:
+            return enum_cls(value)
+        except ValueError:
+            continue
+    raise ValueError(f"Unknown label: {value}")
+
+
+def check_parsed(parsed, model: str):
+    """
+    Raise an AssertionError (one of PARSE_ERRORS) if a response could not be parsed,
+    counting it in the error metrics.
+    """
+    if not parsed:
+        metrics.ERRORS.inc(model=model, error_type="unparseable_response")
+        raise AssertionError("Failed to parse response")
+
+
+def get_classifier_name(classifier_definition: dict) -> str:
+    """
+    Get a display name for a classifier definition (V2/intent definitions only have a full name).
+    """
+    return classifier_definition.get("name") or classifier_definition["full_name"]
+
+
+def get_label_enum(classifier_definition: dict) -> type[Enum]:
+    """
+    Get the label enum of a classifier: its "label_set" if given, otherwise the one of its version.
+    """
+    if "label_set" in classifier_definition:
+        return LABEL_SET_DICT[classifier_definition["label_set"]]
+    return VERSION_LABEL_ENUM_DICT[classifier_definition["version"]]
+
+
+@functools.cache
+def get_packed_response_format_for_label_enum(label_enum: type[Enum]) -> type[pydantic.BaseModel]:
+    """
+    Build (once per label set) a response format for packed requests: a list of
+    labels, one per target message index.
+    """
+    prefix = label_enum.__name__.removesuffix("Enum")
+    packed_label_format = pydantic.create_model(
+        prefix + "PackedLabel",
+        __config__=pydantic.ConfigDict(extra="forbid"),
+        index=(int, ...),
+        response=(label_enum, ...),
+    )
+    return pydantic.create_model(
+        prefix + "PackedResponseFormat",
+        __config__=pydantic.ConfigDict(extra="forbid"),
+        responses=(list[packed_label_format], ...),
+    )
+
+
+@functools.cache
+def get_localized_response_format_for_label_enum(label_enum: type[Enum]) -> type[pydantic.BaseModel]:
+    """
+    Build (once per label set) a response format with a label and the indices of the
+    messages behind it.
+    """
+    return pydantic.create_model(
+        label_enum.__name__.removesuffix("Enum") + "LocalizedResponseFormat",
+        __config__=pydantic.ConfigDict(extra="forbid"),
+        response=(label_enum, ...),
+        message_indices=(list[int], ...),
+    )
+
+
+def get_response_format(classifier_definition: dict) -> type[pydantic.BaseModel]:
+    """
+    Get the narrowed response format of a classifier.
+    """
+    return get_response_format_for_label_enum(get_label_enum(classifier_definition))
+
+
+def get_label_distribution(
+    top_logprobs: list,
+    label_enum: type[Enum],
+    temperature: float = 1.0,
+) -> dict[str, float]:
+    """
+    Map the top logprobs of a single answer token to a distribution over labels.
+    A token counts towards a label if it is the label, or an unambiguous prefix of it
+    (e.g. "fact" for "fact_checking"). The label mass is renormalized, optionally with
+    temperature scaling for calibration. Returns an empty dict if no token matches a label.
+    """
+    label_values = [label.value for label in label_enum]
+    mass = {value: 0.0 for value in label_values}
+    for top_logprob in top_logprobs:
+        token = top_logprob.token.strip().strip("\"'.").lower()
+        if not token:
+            continue
+        if token in mass:
+            matched = token
+        else:
+            candidates = [value for value in label_values if value.startswith(token)]
+            if len(candidates) != 1:
+                continue
+            matched = candidates[0]
+        mass[matched] += math.exp(top_logprob.logprob)
+    mass = {value: prob ** (1.0 / temperature) for value, prob in mass.items() if prob > 0}
+    total = sum(mass.values())
+    return {value: prob / total for value, prob in mass.items()}
+
+
+def get_label_probability(token_logprobs: list, label_value: str) -> float | None:
+    """
+    Compute the probability of the label from the token logprobs of a structured
+    JSON response, i.e. the product of the probabilities of the tokens spanning the label.
+    """
+    text = ""
+    spans = []
+    for token_logprob in token_logprobs:
+        start = len(text)
+        text += token_logprob.token
+        spans.append((start, len(text), token_logprob.logprob))
+    position = text.find(f'"{label_value}"')
+    if position < 0:
+        return None
+    label_start, label_end = position + 1, position + 1 + len(label_value)
+    return math.exp(sum(
+        logprob for start, end, logprob in spans
+        if start < label_end and end > label_start
+    ))
+
+
 def format_criteria(criteria: list[str]) -> str:
     """
     Format criteria for EmoClassifiers V2.
@@ -62,6 +312,16 @@ def format_criteria(criteria: list[str]) -> str:
     )
 
 
+def render_chunk(classifier_definition: dict, chunk: Chunk) -> str:
+    """
+    Render a chunk for a prompt, applying the classifier's compression settings (if any).
+    The rendering is cached on the chunk for classifiers with the same settings.
+    """
+    compression = classifier_definition.get("compression")
+    key = "" if compression is None else json.dumps(compression, sort_keys=True)
+    return chunk.to_cached_string(key, compressor=get_compressor(classifier_definition))
+
+
 def get_emo_classifiers_v1_prompt(
     classifier_definition: dict,
     chunk: Chunk,
@@ -73,7 +333,7 @@ def get_emo_classifiers_v1_prompt(
     return prompt_templates.EMO_CLASSIFIER_V1_PROMPT_TEMPLATE.format(
         classifier_name=classifier_definition["name"],
         prompt=classifier_definition["prompt"],
-        snippet_string=chunk.to_string(),
+        snippet_string=render_chunk(classifier_definition, chunk),
         prompt_short=classifier_definition["prompt"].splitlines()[0],
     )
 
@@ -89,10 +349,34 @@ def get_emo_classifiers_v1_top_level_prompt(
     return prompt_templates.EMO_CLASSIFIER_V1_TOP_LEVEL_PROMPT_TEMPLATE.format(
         classifier_name=classifier_definition["name"],
         prompt=classifier_definition["prompt"],
-        conversation_string=chunk.to_string(),
+        conversation_string=render_chunk(classifier_definition, chunk),
     )
 
 
+def get_localized_prompt(
+    classifier_definition: dict,
+    chunk: Chunk,
+    start: int,
+) -> str:
+    """
+    Construct a classification prompt for EmoClassifiers V1 (Top Level), with the messages
+    numbered by their index in the conversation (the chunk starting at message `start`),
+    asking for the indices of the messages behind a "yes".
+    """
+    assert classifier_definition["version"] == "v1_top_level"
+    compressor = get_compressor(classifier_definition)
+    lines = ["(This is the start of the conversation.)"] if chunk.touches_start else []
+    lines += [
+        packing.render_message(message, start + i, is_target=False, compressor=compressor)
+        for i, message in enumerate(chunk.chunk)
+    ]
+    return prompt_templates.EMO_CLASSIFIER_V1_TOP_LEVEL_PROMPT_TEMPLATE.format(
+        classifier_name=classifier_definition["name"],
+        prompt=classifier_definition["prompt"],
+        conversation_string="\n".join(lines),
+    ) + prompt_templates.LOCALIZATION_INSTRUCTION
+
+
 def get_emo_classifiers_v2_prompt(
     classifier_definition: dict,
     chunk: Chunk,
@@ -104,7 +388,7 @@ def get_emo_classifiers_v2_prompt(
     return prompt_templates.EMO_CLASSIFIER_V2_PROMPT_TEMPLATE.format(
         classifier_name=classifier_definition["full_name"],
         criteria=format_criteria(classifier_definition["criteria"]),
-        snippet_string=chunk.to_string(),
+        snippet_string=render_chunk(classifier_definition, chunk),
         prompt=classifier_definition["prompt"],
     )
 
@@ -120,7 +404,7 @@ def get_intent_classifier_prompt(
     return prompt_templates.INTENT_CLASSIFIER_PROMPT_TEMPLATE.format(
         classifier_name=classifier_definition["full_name"],
         criteria=format_criteria(classifier_definition["criteria"]),
-        snippet_string=chunk.to_string(),
+        snippet_string=render_chunk(classifier_definition, chunk),
         prompt=classifier_definition["prompt"],
     )
 
@@ -135,11 +419,11 @@ def get_emo_classifiers_prompt(
     if classifier_definition["version"] == "v1":
         return get_emo_classifiers_v1_prompt(classifier_definition=classifier_definition, chunk=chunk)
     elif classifier_definition["version"] == "v1_top_level":
-        if classifier_definition["name"].startswith("IS_") and "QUESTION" in classifier_definition["name"]:
+        if packing.is_question_classifier(classifier_definition):
             return prompt_templates.QUESTION_CLASSIFIER_PROMPT_TEMPLATE.format(
                 classifier_name=classifier_definition["name"],
                 prompt=classifier_definition["prompt"],
-                snippet_string=chunk.to_string(),
+                snippet_string=render_chunk(classifier_definition, chunk),
             )
         return get_emo_classifiers_v1_top_level_prompt(classifier_definition=classifier_definition, chunk=chunk)
     elif classifier_definition["version"] == "v2":
@@ -148,7 +432,7 @@ def get_emo_classifiers_prompt(
         return prompt_templates.QUESTION_TREE_PROMPT_TEMPLATE.format(
             classifier_name=classifier_definition["name"],
             prompt=classifier_definition["prompt"],
-            snippet_string=chunk.to_string(),
+            snippet_string=render_chunk(classifier_definition, chunk),
         )
     elif classifier_definition["version"] == "intent":
         return get_intent_classifier_prompt(classifier_definition=classifier_definition, chunk=chunk)
@@ -162,15 +446,289 @@ class ModelWrapper:
         openai_client: openai.AsyncOpenAI | None = None,
         model: str = "gpt-4o-mini-2024-07-18",
         max_concurrent: int = 5,
+        request_logprobs: bool = False,
+        decoding_modes: dict[str, str] | None = None,
+        label_token_temperature: float = 1.0,
+        usage_tracker: UsageTracker | None = None,
+        scheduler: str = "fifo",
+        classifier_set_weights: dict[str, float] | None = None,
+        request_timeout: float | None = None,
+        hedging_policy: HedgingPolicy | None = None,
+        client_pool: "ClientPool | None" = None,
+        rate_limiter: SharedTokenBucket | None = None,
+        deduplicator: RequestDeduplicator | None = None,
     ):
         """
-        A wrapper around the OpenAI async client with semaphore and model name.
+        A wrapper around the OpenAI async client with a scheduler for `max_concurrent` requests and model name.
+        If `request_logprobs` is set, results carry the probability of the label.
+        `decoding_modes` maps classifier versions to a decoding mode (structured by default);
+        a "decoding" key in a classifier definition takes precedence.
+        If `usage_tracker` is given, token usage is recorded and its budget (if any) enforced.
+        `scheduler` is a key of `scheduling.SCHEDULER_DICT` (first come, first served by default); with
+        "fair", gating classifiers are served first, then classifier sets share the slots by
+        `classifier_set_weights`, then conversations.
+        Requests taking longer than `request_timeout` seconds (including retries) raise RequestTimeoutError.
+        With a `hedging_policy`, slow requests are duplicated and the first answer is used.
+        With a `client_pool`, requests are balanced across its endpoints instead of sent with `openai_client`.
+        A `rate_limiter` (possibly shared with other processes) delays requests to stay within its limits;
+        failed requests are then retried by the wrapper rather than the client, so that retries are limited too.
+        With a `deduplicator`, identical requests in flight (or recently answered) are only sent once.
         """
-        if openai_client is None:
+        if openai_client is None and client_pool is None:
             openai_client = openai.AsyncOpenAI()
         self.openai_client = openai_client
         self.model = model
-        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.scheduler = scheduling.SCHEDULER_DICT[scheduler](max_concurrent, group_weights=classifier_set_weights)
+        self.request_timeout = request_timeout
+        self.request_logprobs = request_logprobs
+        self.decoding_modes = decoding_modes or {}
+        self.label_token_temperature = label_token_temperature
+        self.usage_tracker = usage_tracker
+        self.hedging_policy = hedging_policy
+        self.client_pool = client_pool
+        self.rate_limiter = rate_limiter
+        self.deduplicator = deduplicator
+
+    def get_decoding_mode(self, classifier_definition: dict) -> str:
+        return classifier_definition.get(
+            "decoding",
+            self.decoding_modes.get(classifier_definition["version"], STRUCTURED_DECODING),
+        )
+
+    def get_slot(self, classifier_definition: dict):
+        """
+        A scheduler slot for a request of a classifier.
+        """
+        return self.scheduler.slot(
+            priority=scheduling.get_priority(classifier_definition),
+            group=scheduling.get_classifier_set(classifier_definition),
+            flow=scheduling.FLOW.get(),
+        )
+
+    async def send_request(
+        self,
+        prompt: str,
+        max_completion_tokens: int,
+        response_format: type[pydantic.BaseModel] | None = None,
+        **kwargs,
+    ) -> tuple[str, object]:
+        """
+        Send a request to the client (or an endpoint of the client pool), returning the model it
+        was sent to (which an endpoint may override) and the response.
+        """
+        if self.client_pool is None:
+            return self.model, await self.send_request_with_client(
+                self.openai_client, self.model, prompt, max_completion_tokens, response_format, **kwargs
+            )
+        async with self.client_pool.endpoint() as endpoint:
+            model = endpoint.config.model or self.model
+            return model, await self.send_request_with_client(
+                endpoint.client,
+                model,
+                prompt,
+                max_completion_tokens,
+                response_format,
+                **kwargs,
+            )
+
+    async def send_request_with_client(
+        self,
+        openai_client: openai.AsyncOpenAI,
+        model: str,
+        prompt: str,
+        max_completion_tokens: int,
+        response_format: type[pydantic.BaseModel] | None = None,
+        **kwargs,
+    ):
+        if self.rate_limiter is not None:
+            return await self.rate_limiter.send_with_retries(
+                lambda client: self.send_request_once(
+                    client, model, prompt, max_completion_tokens, response_format, **kwargs
+                ),
+                openai_client,
+                num_tokens=estimate_num_tokens(prompt) + max_completion_tokens,
+            )
+        return await self.send_request_once(
+            openai_client, model, prompt, max_completion_tokens, response_format, **kwargs
+        )
+
+    async def send_request_once(
+        self,
+        openai_client: openai.AsyncOpenAI,
+        model: str,
+        prompt: str,
+        max_completion_tokens: int,
+        response_format: type[pydantic.BaseModel] | None = None,
+        **kwargs,
+    ):
+        if response_format is not None:
+            return await openai_client.beta.chat.completions.parse(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                response_format=response_format,
+                max_completion_tokens=max_completion_tokens,
+                **kwargs,
+            )
+        return await openai_client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_completion_tokens=max_completion_tokens,
+            **kwargs,
+        )
+
+    async def send_hedged_request(
+        self,
+        classifier_definition: dict,
+        prompt: str,
+        max_completion_tokens: int,
+        response_format: type[pydantic.BaseModel] | None = None,
+        **kwargs,
+    ):
+        """
+        Send a request, hedged by the hedging policy if there is one. A hedge waits for its own
+        scheduler slot and rate limiter tokens, and is only sent if the usage tracker's budget allows
+        it. The losing copy is cancelled, and its usage recorded if it answered before that.
+        """
+        def send():
+            return self.send_request(
+                prompt=prompt,
+                max_completion_tokens=max_completion_tokens,
+                response_format=response_format,
+                **kwargs,
+            )
+
+        if self.hedging_policy is None:
+            return await send()
+        hedge_reservation = None
+
+        def reserve_hedge() -> bool:
+            nonlocal hedge_reservation
+            if self.usage_tracker is None:
+                return True
+            hedge_reservation = self.usage_tracker.try_reserve(self.model, prompt, max_completion_tokens)
+            return hedge_reservation is not None
+
+        async def send_hedge():
+            async with self.get_slot(classifier_definition):
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire(estimate_num_tokens(prompt) + max_completion_tokens)
+                return await send()
+
+        try:
+            return await self.hedging_policy.send(
+                send,
+                model=self.model,
+                send_hedge=send_hedge,
+                reserve_hedge=reserve_hedge,
+                on_extra_result=lambda result: self.record_usage(classifier_definition, *result),
+            )
+        finally:
+            if hedge_reservation is not None:
+                self.usage_tracker.release(hedge_reservation)
+
+    async def request_completion(
+        self,
+        classifier_definition: dict,
+        prompt: str,
+        max_completion_tokens: int,
+        response_format: type[pydantic.BaseModel] | None = None,
+        **kwargs,
+    ):
+        """
+        Send a single-message request through the scheduler: a structured `parse` request if
+        `response_format` is given, otherwise a plain `create` request. Usage is recorded with the
+        usage tracker, which may raise BudgetExceededError instead of sending the request.
+        """
+        if self.deduplicator is not None:
+            key = (self.model, prompt, max_completion_tokens, response_format, tuple(sorted(kwargs.items())))
+            return await self.deduplicator.run(key, lambda: self.send_completion(
+                classifier_definition, prompt, max_completion_tokens, response_format, **kwargs
+            ))
+        return await self.send_completion(classifier_definition, prompt, max_completion_tokens, response_format, **kwargs)
+
+    async def send_completion(
+        self,
+        classifier_definition: dict,
+        prompt: str,
+        max_completion_tokens: int,
+        response_format: type[pydantic.BaseModel] | None = None,
+        **kwargs,
+    ):
+        classifier_name = get_classifier_name(classifier_definition)
+        wait_start_time = time.perf_counter()
+        async with self.get_slot(classifier_definition):
+            wait_end_time = time.perf_counter()
+            metrics.SEMAPHORE_WAIT.observe(wait_end_time - wait_start_time, model=self.model)
+            tracing.add_span("semaphore_wait", wait_start_time, wait_end_time)
+            if self.rate_limiter is not None:
+                with tracing.span("rate_limit_wait"):
+                    await self.rate_limiter.acquire(estimate_num_tokens(prompt) + max_completion_tokens)
+            reservation = 0.0
+            if self.usage_tracker is not None:
+                reservation = self.usage_tracker.reserve(self.model, prompt, max_completion_tokens)
+            metrics.REQUESTS_IN_FLIGHT.inc(model=self.model)
+            start_time = time.perf_counter()
+            try:
+                with tracing.span("network", model=self.model):
+                    try:
+                        async with asyncio.timeout(self.request_timeout):
+                            model, response = await self.send_hedged_request(
+                                classifier_definition=classifier_definition,
+                                prompt=prompt,
+                                max_completion_tokens=max_completion_tokens,
+                                response_format=response_format,
+                                **kwargs,
+                            )
+                    except TimeoutError:
+                        raise deadlines.RequestTimeoutError(
+                            f"No response within the request timeout ({self.request_timeout}s)"
+                        ) from None
+            except Exception as e:
+                metrics.ERRORS.inc(model=self.model, error_type=type(e).__name__)
+                recording.record_request(
+                    model=self.model,
+                    classifier_definition=classifier_definition,
+                    prompt=prompt,
+                    max_completion_tokens=max_completion_tokens,
+                    structured=response_format is not None,
+                    dispatch_time=wait_start_time,
+                    start_time=start_time,
+                    end_time=time.perf_counter(),
+                    error=e,
+                )
+                raise
+            finally:
+                metrics.REQUESTS_IN_FLIGHT.dec(model=self.model)
+                if self.usage_tracker is not None:
+                    self.usage_tracker.release(reservation)
+        end_time = time.perf_counter()
+        metrics.REQUEST_LATENCY.observe(end_time - start_time, model=model)
+        recording.record_request(
+            model=model,
+            classifier_definition=classifier_definition,
+            prompt=prompt,
+            max_completion_tokens=max_completion_tokens,
+            structured=response_format is not None,
+            dispatch_time=wait_start_time,
+            start_time=start_time,
+            end_time=end_time,
+            response=response,
+        )
+        metrics.REQUESTS.inc(model=model, classifier=classifier_name)
+        self.record_usage(classifier_definition, model, response)
+        return response
+
+    def record_usage(self, classifier_definition: dict, model: str, response):
+        """
+        Record the token usage of a response sent to `model`, in the metrics and the usage tracker.
+        """
+        if response.usage is not None:
+            details = response.usage.prompt_tokens_details
+            metrics.TOKENS.inc(response.usage.prompt_tokens, model=model, kind="prompt")
+            metrics.TOKENS.inc((details.cached_tokens or 0) if details else 0, model=model, kind="cached")
+            metrics.TOKENS.inc(response.usage.completion_tokens, model=model, kind="completion")
+        if self.usage_tracker is not None:
+            self.usage_tracker.record(model, classifier_definition, response.usage)
 
     async def classify_conversation_chunk(
         self,
@@ -181,18 +739,152 @@ class ModelWrapper:
         """
         Classify a single conversaiton chunk.
         """
-        prompt = get_emo_classifiers_prompt(classifier_definition=classifier_definition, chunk=chunk)
-        async with self.semaphore:
-            response = await self.openai_client.beta.chat.completions.parse(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                response_format=ResponseFormat,
-                max_completion_tokens=max_completion_tokens,
+        result = await self.classify_conversation_chunk_detailed(
+            classifier_definition=classifier_definition,
+            chunk=chunk,
+            max_completion_tokens=max_completion_tokens,
+        )
+        return result.label
+
+    async def classify_conversation_chunk_detailed(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        max_completion_tokens: int = 20,
+    ) -> ChunkClassification:
+        """
+        Classify a single conversation chunk, returning the label with its probability (if requested).
+        """
+        decoding_mode = self.get_decoding_mode(classifier_definition)
+        if decoding_mode == LABEL_TOKEN_DECODING:
+            return await self.classify_conversation_chunk_label_token(
+                classifier_definition=classifier_definition,
+                chunk=chunk,
             )
-        message = response.choices[0].message
-        assert message.parsed, "Failed to parse response"
-        return message.parsed.response
-    
+        elif decoding_mode != STRUCTURED_DECODING:
+            raise ValueError(f"Unknown decoding mode: {decoding_mode}")
+        with tracing.span("render_prompt"), profiling.stage("render_prompt"):
+            prompt = get_emo_classifiers_prompt(classifier_definition=classifier_definition, chunk=chunk)
+        extra_kwargs = {"logprobs": True} if self.request_logprobs else {}
+        response = await self.request_completion(
+            classifier_definition=classifier_definition,
+            prompt=prompt,
+            max_completion_tokens=max_completion_tokens,
+            response_format=get_response_format(classifier_definition),
+            **extra_kwargs,
+        )
+        with tracing.span("parse"), profiling.stage("parse"):
+            choice = response.choices[0]
+            check_parsed(choice.message.parsed, model=self.model)
+            label = choice.message.parsed.response
+            probability = None
+            if self.request_logprobs and choice.logprobs and choice.logprobs.content:
+                probability = get_label_probability(choice.logprobs.content, label.value)
+        return ChunkClassification(label=label, probability=probability, model=self.model)
+
+    async def classify_conversation_chunk_label_token(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        top_logprobs: int = 20,
+    ) -> ChunkClassification:
+        """
+        Classify a single conversation chunk by decoding a single label token, and read
+        the label distribution from its logprobs.
+        """
+        label_enum = get_label_enum(classifier_definition)
+        with tracing.span("render_prompt"), profiling.stage("render_prompt"):
+            prompt = get_emo_classifiers_prompt(classifier_definition=classifier_definition, chunk=chunk)
+            prompt += prompt_templates.LABEL_TOKEN_INSTRUCTION.format(
+                labels=", ".join(label.value for label in label_enum),
+            )
+        response = await self.request_completion(
+            classifier_definition=classifier_definition,
+            prompt=prompt,
+            max_completion_tokens=1,
+            logprobs=True,
+            top_logprobs=top_logprobs,
+            temperature=0,
+        )
+        with tracing.span("parse"), profiling.stage("parse"):
+            choice = response.choices[0]
+            check_parsed(choice.logprobs and choice.logprobs.content, model=self.model)
+            label_probabilities = get_label_distribution(
+                choice.logprobs.content[0].top_logprobs,
+                label_enum=label_enum,
+                temperature=self.label_token_temperature,
+            )
+            check_parsed(label_probabilities, model=self.model)
+        label_value = max(label_probabilities, key=label_probabilities.get)
+        return ChunkClassification(
+            label=label_enum(label_value),
+            probability=label_probabilities[label_value],
+            label_probabilities=label_probabilities,
+            model=self.model,
+        )
+
+    async def classify_conversation_chunk_localized(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        start: int,
+        max_completion_tokens: int = 60,
+    ) -> ChunkClassification:
+        """
+        Classify a chunk starting at message `start` of its conversation, returning the label with
+        the indices of the messages behind it (empty unless the label is "yes").
+        """
+        with tracing.span("render_prompt"), profiling.stage("render_prompt"):
+            prompt = get_localized_prompt(classifier_definition=classifier_definition, chunk=chunk, start=start)
+        response = await self.request_completion(
+            classifier_definition=classifier_definition,
+            prompt=prompt,
+            max_completion_tokens=max_completion_tokens,
+            response_format=get_localized_response_format_for_label_enum(get_label_enum(classifier_definition)),
+        )
+        with tracing.span("parse"), profiling.stage("parse"):
+            parsed = response.choices[0].message.parsed
+            check_parsed(parsed, model=self.model)
+        message_indices = []
+        if parsed.response == YesNoUnsureEnum.YES:
+            # Drop indices outside of the chunk.
+            message_indices = sorted({idx for idx in parsed.message_indices if start <= idx < start + len(chunk.chunk)})
+        return ChunkClassification(label=parsed.response, message_indices=message_indices, model=self.model)
+
+    async def classify_packed_window(
+        self,
+        classifier_definition: dict,
+        simple_convo: list[dict],
+        window: packing.PackedWindow,
+        max_completion_tokens_per_target: int = 20,
+    ) -> dict[int, ChunkClassification]:
+        """
+        Classify all target messages of a packed window in a single request.
+        Target indices missing from the response are omitted from the result.
+        """
+        label_enum = get_label_enum(classifier_definition)
+        with tracing.span("render_prompt"), profiling.stage("render_prompt"):
+            prompt = packing.get_packed_prompt(
+                classifier_definition=classifier_definition,
+                simple_convo=simple_convo,
+                window=window,
+                labels=[label.value for label in label_enum],
+            )
+        response = await self.request_completion(
+            classifier_definition=classifier_definition,
+            prompt=prompt,
+            max_completion_tokens=20 + max_completion_tokens_per_target * len(window.target_ids),
+            response_format=get_packed_response_format_for_label_enum(label_enum),
+        )
+        with tracing.span("parse"), profiling.stage("parse"):
+            message = response.choices[0].message
+            check_parsed(message.parsed, model=self.model)
+            target_ids = set(window.target_ids)
+            return {
+                elem.index: ChunkClassification(label=elem.response, model=self.model)
+                for elem in message.parsed.responses
+                if elem.index in target_ids
+            }
 
 
 class EmoClassifier:
@@ -200,54 +892,197 @@ class EmoClassifier:
         self,
         classifier_definition: dict,
         model_wrapper: ModelWrapper,
+        packed_token_budget: int | None = None,
+        localize: bool = False,
     ):
         """
         Main classifier object for performing classification over a conversation.
+        If `packed_token_budget` is set, chunks of per-message classifiers are classified
+        in packed requests (several target messages per request, windows split by the budget).
+        Packed requests go directly to the model wrapper's `classify_packed_window`.
+        If `localize` is set, chunks of whole-conversation chunkers are classified with the indices
+        of the messages behind a "yes" (see `ChunkClassification.message_indices`).
+        Neither can be combined with a wrapper that only decides single chunks (`PER_CHUNK_ONLY`,
+        e.g. the pre-screen), since its requests would bypass that wrapper.
         """
+        bypasses_chunks = (
+            packed_token_budget is not None and classifier_definition["chunker"] in packing.PACKABLE_CHUNKERS
+        ) or (localize and get_chunker(classifier_definition["chunker"]).KEYED_BY_START_INDEX)
+        if bypasses_chunks and getattr(model_wrapper, "PER_CHUNK_ONLY", False):
+            raise ValueError(
+                f"{type(model_wrapper).__name__} only handles single chunks and cannot be combined with"
+                " packed requests or localization"
+            )
         self.model_wrapper = model_wrapper
         self.classifier_definition = classifier_definition
+        self.packed_token_budget = packed_token_budget
+        self.localize = localize
 
-    async def classify_conversation(self, conversation: list[dict]) -> list[dict]:
+    async def classify_conversation(
+        self,
+        conversation: list[dict],
+        chunk_plan: ChunkPlan | None = None,
+        chunk_ids: set[int] | None = None,
+    ) -> list[dict]:
         """
         Classify a conversation. Depending on the classifier definition, it may
         chunk the conversation and return a dictionary of classifications, or it
         may return a single classification. Keys will be the index of the first message.
         """
-        chunker = CHUNKER_DICT[self.classifier_definition["chunker"]]
-        chunks = chunker.chunk_simple_convo(conversation)
-        keys = []
-        futures = []
-        for chunk_id, chunk in chunks.items():
-            futures.append(
-                self.model_wrapper.classify_conversation_chunk(
+        results = await self.classify_conversation_detailed(conversation, chunk_plan=chunk_plan, chunk_ids=chunk_ids)
+        return {key: result.label for key, result in results.items()}
+
+    async def classify_conversation_detailed(
+        self,
+        conversation: list[dict],
+        chunk_plan: ChunkPlan | None = None,
+        chunk_ids: set[int] | None = None,
+    ) -> dict[int, ChunkClassification]:
+        """
+        Same as `classify_conversation`, but returns detailed results (with probabilities, if available).
+        If `chunk_plan` (of this conversation) is given, its chunks are shared with other classifiers.
+        If `chunk_ids` is given, only those chunks are classified (e.g. the chunks near the messages
+        behind a localized gating classifier, see `get_neighborhood_chunk_ids`).
+        """
+        with tracing.lane(get_classifier_name(self.classifier_definition)), tracing.span("classify_conversation"):
+            with tracing.span("chunking"), profiling.stage("chunking"):
+                chunker_kwargs = self.classifier_definition.get("chunker_kwargs")
+                chunker = get_chunker(self.classifier_definition["chunker"], chunker_kwargs)
+                if chunk_plan is not None:
+                    chunks = chunk_plan.get_chunks(self.classifier_definition["chunker"], chunker_kwargs)
+                else:
+                    chunks = chunker.chunk_simple_convo(conversation)
+                if chunk_ids is not None:
+                    chunks = {chunk_id: chunk for chunk_id, chunk in chunks.items() if chunk_id in chunk_ids}
+            if (
+                self.packed_token_budget is not None
+                and self.classifier_definition["chunker"] in packing.PACKABLE_CHUNKERS
+                and len(chunks) > 1
+            ):
+                return await self.classify_chunks_packed(conversation, chunks)
+            keys = []
+            futures = []
+            for chunk_id, chunk in chunks.items():
+                if self.localize and chunker.KEYED_BY_START_INDEX:
+                    coroutine = self.model_wrapper.classify_conversation_chunk_localized(
+                        classifier_definition=self.classifier_definition,
+                        chunk=chunk,
+                        start=chunk_id,
+                    )
+                else:
+                    coroutine = self.model_wrapper.classify_conversation_chunk_detailed(
+                        classifier_definition=self.classifier_definition,
+                        chunk=chunk,
+                    )
+                futures.append(tracing.in_lane(
+                    dead_letter.capture(
+                        coroutine,
+                        classifier_definition=self.classifier_definition,
+                        chunk_ids=[chunk_id],
+                        marker=FAILED,
+                    ),
+                    name=f"chunk {chunk_id}",
+                ))
+                keys.append(chunk_id)
+            results = await deadlines.gather_until_deadline(futures, marker=TIMED_OUT)
+            return {key: result for key, result in zip(keys, results)}
+
+
+    async def classify_chunks_packed(
+        self,
+        conversation: list[dict],
+        chunks: dict[int, Chunk],
+    ) -> dict[int, ChunkClassification]:
+        """
+        Classify chunks in packed windows. Chunks missing from a packed response
+        are classified individually, so the result has the same keys as the chunks.
+        Chunks of windows cut off by the deadline are marked as timed out.
+        """
+        windows = packing.plan_packed_windows(
+            simple_convo=conversation,
+            chunks=chunks,
+            max_tokens=self.packed_token_budget,
+        )
+        window_results = await deadlines.gather_until_deadline([
+            tracing.in_lane(
+                dead_letter.capture(
+                    self.model_wrapper.classify_packed_window(
+                        classifier_definition=self.classifier_definition,
+                        simple_convo=conversation,
+                        window=window,
+                    ),
                     classifier_definition=self.classifier_definition,
-                    chunk=chunk,
-                )
+                    chunk_ids=window.target_ids,
+                    marker={chunk_id: FAILED for chunk_id in window.target_ids},
+                ),
+                name=f"window {window.start}-{window.end}",
             )
-            keys.append(chunk_id)
-        results = await asyncio.gather(*futures)
-        return {key: result for key, result in zip(keys, results)}
+            for window in windows
+        ], marker=None)
+        results = {}
+        for window, window_result in zip(windows, window_results):
+            if window_result is None:
+                results.update({chunk_id: TIMED_OUT for chunk_id in window.target_ids})
+            else:
+                results.update(window_result)
+        missing_ids = [chunk_id for chunk_id in chunks if chunk_id not in results]
+        missing_results = await deadlines.gather_until_deadline([
+            tracing.in_lane(
+                dead_letter.capture(
+                    self.model_wrapper.classify_conversation_chunk_detailed(
+                        classifier_definition=self.classifier_definition,
+                        chunk=chunks[chunk_id],
+                    ),
+                    classifier_definition=self.classifier_definition,
+                    chunk_ids=[chunk_id],
+                    marker=FAILED,
+                ),
+                name=f"chunk {chunk_id}",
+            )
+            for chunk_id in missing_ids
+        ], marker=TIMED_OUT)
+        results.update(zip(missing_ids, missing_results))
+        return {chunk_id: results[chunk_id] for chunk_id in chunks}
+
+
+def load_classifier_definitions(
+    classifier_set: str = "v2",
+    custom_path: str | None = None,
+) -> dict[str, dict]:
+    """
+    Load a set of classifier definitions from a JSON file, without creating a model wrapper.
+    Predefined definitions are tagged with their "classifier_set", since sets can share a version.
+    """
+    if custom_path is None:
+        path = CLASSIFIER_DEFINITION_PATH_DICT[classifier_set]
+    else:
+        path = custom_path
+    definitions = io_utils.load_json(io_utils.get_path(path))
+    if custom_path is None:
+        for definition in definitions.values():
+            definition.setdefault("classifier_set", classifier_set)
+    return definitions
 
 
 def load_classifiers(
     classifier_set: str = "v2",
     model_wrapper: ModelWrapper | None = None,
     custom_path: str | None = None,
+    packed_token_budget: int | None = None,
+    localize: bool = False,
 ) -> dict[str, EmoClassifier]:
     """
     Load a set of classifiers from a JSON file. Defaults to loading from predefined paths.
     """
     if model_wrapper is None:
         model_wrapper = ModelWrapper()
-    if custom_path is None:
-        path = CLASSIFIER_DEFINITION_PATH_DICT[classifier_set]
-    else:
-        path = custom_path
-    definitions = io_utils.load_json(io_utils.get_path(path))
+    definitions = load_classifier_definitions(classifier_set=classifier_set, custom_path=custom_path)
     return {
         name: EmoClassifier(
             classifier_definition=definition,
             model_wrapper=model_wrapper,
+            packed_token_budget=packed_token_budget,
+            localize=localize,
         )
         for name, definition in definitions.items()
     }
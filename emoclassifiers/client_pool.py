@@ -0,0 +1,280 @@
+"""
+A pool of OpenAI-compatible endpoints (API keys, projects, or base URLs such as local model
+servers) for `ModelWrapper` (`client_pool`, `--endpoints_path` of the runners).
+
+Each request goes to the endpoint with the fewest outstanding requests relative to its
+`max_concurrent`, waiting if every endpoint is at its limit. Every endpoint has its own httpx
+connection pool sized to its `max_concurrent`, with long-lived keep-alive connections, which
+`warm_up` opens before the run. After `max_consecutive_failures` connection errors or 5xx
+responses in a row, an endpoint is taken out of rotation until a health check (GET /models)
+succeeds; health checks also keep a connection to idle endpoints open. If no endpoint is healthy,
+all of them are used.
+
+Endpoints are configured as a JSON list of `EndpointConfig`, e.g.
+
+    [
+        {"name": "main", "max_concurrent": 50},
+        {"name": "project_b", "api_key_env": "OPENAI_API_KEY_B", "project": "proj_123", "max_concurrent": 20},
+        {"name": "local", "base_url": "http://localhost:8000/v1", "model": "llama-3.1-8b", "max_concurrent": 8}
+    ]
+"""
+
+import asyncio
+import contextlib
+import os
+from collections import Counter, deque
+
+import openai
+import pydantic
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.metrics as metrics
+
+# Idle connections are kept open this long (httpx closes them after 5s by default).
+KEEPALIVE_EXPIRY = 60.0
+HEALTH_CHECK_TIMEOUT = 5.0
+
+# Errors that count against the health of an endpoint (timeouts are connection errors).
+FAILURE_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+ENDPOINT_REQUESTS = metrics.METRICS.counter(
+    "emoclassifiers_endpoint_requests_total", "Requests sent through the client pool, by endpoint and outcome.",
+)
+HEALTHY_ENDPOINTS = metrics.METRICS.gauge(
+    "emoclassifiers_healthy_endpoints", "Endpoints of the client pool in rotation.",
+)
+
+
+class EndpointConfig(pydantic.BaseModel):
+    """
+    An OpenAI-compatible endpoint. The API key is read from the environment variable `api_key_env`
+    (OPENAI_API_KEY by default). `model` overrides the model name of the ModelWrapper at this endpoint.
+    """
+    name: str
+    base_url: str | None = None
+    api_key_env: str | None = None
+    organization: str | None = None
+    project: str | None = None
+    model: str | None = None
+    max_concurrent: int = 20
+    max_retries: int = 2
+    timeout: float = 600.0
+
+
+def create_client(config: EndpointConfig) -> openai.AsyncOpenAI:
+    """
+    An openai client for an endpoint, with a connection pool sized to its `max_concurrent`.
+    """
+    import httpx
+
+    if config.api_key_env is not None:
+        api_key = os.environ[config.api_key_env]
+    else:
+        # Local servers usually do not check the key.
+        api_key = os.environ.get("OPENAI_API_KEY", "unused")
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        organization=config.organization,
+        project=config.project,
+        base_url=config.base_url,
+        max_retries=config.max_retries,
+        timeout=config.timeout,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config.max_concurrent,
+                max_keepalive_connections=config.max_concurrent,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        ),
+    )
+
+
+class Endpoint:
+    def __init__(self, config: EndpointConfig, client: openai.AsyncOpenAI | None = None):
+        """
+        An endpoint of the pool, with its client (created from the config unless given).
+        """
+        self.config = config
+        self.client = client if client is not None else create_client(config)
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.stats = Counter()
+
+    @property
+    def load(self) -> float:
+        return self.outstanding / self.config.max_concurrent
+
+
+class ClientPool:
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        max_consecutive_failures: int = 3,
+        health_check_interval: float = 10.0,
+    ):
+        """
+        Least-outstanding-requests balancing over `endpoints`, with health checks every
+        `health_check_interval` seconds once requests are being sent.
+        """
+        assert endpoints, "A client pool needs at least one endpoint"
+        self.endpoints = endpoints
+        self.max_consecutive_failures = max_consecutive_failures
+        self.health_check_interval = health_check_interval
+        self.waiters = deque()
+        self.health_check_task = None
+        HEALTHY_ENDPOINTS.set(len(endpoints))
+
+    @classmethod
+    def from_configs(cls, configs: list[EndpointConfig], **kwargs) -> "ClientPool":
+        return cls([Endpoint(config) for config in configs], **kwargs)
+
+    @property
+    def max_concurrent(self) -> int:
+        return sum(endpoint.config.max_concurrent for endpoint in self.endpoints)
+
+    def choose(self) -> Endpoint | None:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy] or self.endpoints
+        available = [endpoint for endpoint in candidates if endpoint.outstanding < endpoint.config.max_concurrent]
+        return min(available, key=lambda endpoint: endpoint.load, default=None)
+
+    def wake(self, all_waiters: bool = False):
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                if not all_waiters:
+                    return
+
+    async def acquire(self) -> Endpoint:
+        if self.health_check_task is None or self.health_check_task.done():
+            self.health_check_task = asyncio.create_task(self.run_health_checks())
+        while (endpoint := self.choose()) is None:
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Woken just before the cancellation; pass the wake-up on.
+                    self.wake()
+                raise
+        endpoint.outstanding += 1
+        return endpoint
+
+    def release(self, endpoint: Endpoint):
+        endpoint.outstanding -= 1
+        self.wake()
+
+    def set_healthy(self, endpoint: Endpoint, healthy: bool):
+        if endpoint.healthy == healthy:
+            return
+        endpoint.healthy = healthy
+        endpoint.consecutive_failures = 0
+        HEALTHY_ENDPOINTS.set(sum(endpoint.healthy for endpoint in self.endpoints))
+        print(f"Endpoint {endpoint.config.name} is {'back in rotation' if healthy else 'out of rotation'}")
+        # Capacity changed: let every waiter choose again.
+        self.wake(all_waiters=True)
+
+    @contextlib.asynccontextmanager
+    async def endpoint(self):
+        """
+        Choose an endpoint for a request, and track its outcome.
+        """
+        endpoint = await self.acquire()
+        try:
+            yield endpoint
+        except FAILURE_ERRORS as e:
+            endpoint.stats["failures"] += 1
+            ENDPOINT_REQUESTS.inc(endpoint=endpoint.config.name, outcome=type(e).__name__)
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.max_consecutive_failures:
+                self.set_healthy(endpoint, False)
+            raise
+        except Exception as e:
+            # Other errors (e.g. 4xx responses) are not the endpoint's fault.
+            ENDPOINT_REQUESTS.inc(endpoint=endpoint.config.name, outcome=type(e).__name__)
+            raise
+        else:
+            endpoint.stats["requests"] += 1
+            ENDPOINT_REQUESTS.inc(endpoint=endpoint.config.name, outcome="ok")
+            endpoint.consecutive_failures = 0
+        finally:
+            self.release(endpoint)
+
+    async def check_endpoint(self, endpoint: Endpoint) -> bool:
+        try:
+            await endpoint.client.with_options(max_retries=0, timeout=HEALTH_CHECK_TIMEOUT).models.list()
+        except openai.APIError:
+            return False
+        return True
+
+    async def run_health_checks(self):
+        """
+        Periodically check endpoints out of rotation (to restore them) and idle ones (to keep a
+        connection open, and to take them out of rotation before requests fail on them).
+        """
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            endpoints = [endpoint for endpoint in self.endpoints if not endpoint.healthy or endpoint.outstanding == 0]
+            results = await asyncio.gather(*(self.check_endpoint(endpoint) for endpoint in endpoints))
+            for endpoint, healthy in zip(endpoints, results):
+                self.set_healthy(endpoint, healthy)
+
+    async def warm_up(self, num_connections: int | None = None):
+        """
+        Open up to `num_connections` (by default `max_concurrent`) connections to every endpoint
+        with concurrent health checks. Endpoints failing them are taken out of rotation.
+        """
+        for endpoint in self.endpoints:
+            count = min(num_connections or endpoint.config.max_concurrent, endpoint.config.max_concurrent)
+            results = await asyncio.gather(*(self.check_endpoint(endpoint) for _ in range(count)))
+            self.set_healthy(endpoint, any(results))
+
+    async def close(self):
+        if self.health_check_task is not None:
+            self.health_check_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.health_check_task
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    def report(self) -> dict:
+        return {
+            endpoint.config.name: {
+                "requests": endpoint.stats["requests"],
+                "failures": endpoint.stats["failures"],
+                "healthy": endpoint.healthy,
+            }
+            for endpoint in self.endpoints
+        }
+
+    def print_report(self):
+        for name, stats in self.report().items():
+            print(
+                f"Endpoint {name}: {stats['requests']} requests, {stats['failures']} failures"
+                + ("" if stats["healthy"] else " (out of rotation)")
+            )
+
+
+def load_client_pool(path: str, **kwargs) -> ClientPool:
+    """
+    Load a client pool from a JSON list of endpoint configs.
+    """
+    return ClientPool.from_configs(
+        [EndpointConfig.model_validate(config) for config in io_utils.load_json(path)],
+        **kwargs,
+    )
+
+
+async def with_client_pool(coroutine, pool: ClientPool | None):
+    """
+    Await a coroutine with a client pool (if any) warmed up before and closed after.
+    """
+    if pool is None:
+        return await coroutine
+    await pool.warm_up()
+    try:
+        return await coroutine
+    finally:
+        await pool.close()
@@ -0,0 +1,171 @@
+"""
+Optional prompt compression applied to message contents when rendering chunks.
+
+Emotional classifiers rarely need code, URLs, pasted blobs or repeated text. Compression is
+configured per classifier under the "compression" key of the classifier definition, e.g.
+
+    "compression": {"elide_code_blocks": true, "role_max_chars": {"assistant": 2000}}
+
+An empty dict enables the defaults below. Savings are accumulated in `COMPRESSION_STATS`, once
+per unique message (messages are rendered again for overlapping chunks and other classifiers).
+"""
+
+import contextlib
+import re
+from collections import defaultdict
+
+import pydantic
+
+from emoclassifiers.chunking import estimate_num_tokens, truncate_string
+
+CODE_BLOCK_PATTERN = re.compile(r"```.*?(?:```|$)", flags=re.DOTALL)
+URL_PATTERN = re.compile(r"https?://([^\s/)\]>\"']+)[^\s)\]>\"']*")
+BASE64_PATTERN = re.compile(r"(?:data:[\w/+.-]+;base64,)?[A-Za-z0-9+/]{120,}={0,2}")
+INLINE_WHITESPACE_PATTERN = re.compile(r"[ \t ]+")
+BLANK_LINES_PATTERN = re.compile(r"\n\s*\n\s*\n+")
+PARAGRAPH_SPLIT_PATTERN = re.compile(r"\n\s*\n")
+
+
+class CompressionStats:
+    """
+    Estimated message tokens before/after compression, per role. Each unique message (by role
+    and content) is counted once, as compressed the first time it is rendered.
+    """
+    def __init__(self):
+        self.tokens_before = defaultdict(int)
+        self.tokens_after = defaultdict(int)
+        self.seen = set()
+        self.enabled = True
+
+    def update(self, role: str, before: str, after: str):
+        if not self.enabled:
+            return
+        key = hash((role, before))
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        self.tokens_before[role] += estimate_num_tokens(before)
+        self.tokens_after[role] += estimate_num_tokens(after)
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """
+        Render without recording savings (e.g. for dry-run planning).
+        """
+        enabled, self.enabled = self.enabled, False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+
+    def reset(self):
+        self.tokens_before.clear()
+        self.tokens_after.clear()
+        self.seen.clear()
+
+    def report(self) -> dict:
+        total_before = sum(self.tokens_before.values())
+        total_after = sum(self.tokens_after.values())
+        return {
+            "tokens_before": total_before,
+            "tokens_after": total_after,
+            "tokens_saved": total_before - total_after,
+            "saved_fraction": (total_before - total_after) / total_before if total_before else 0.0,
+            "tokens_saved_by_role": {
+                role: self.tokens_before[role] - self.tokens_after[role]
+                for role in self.tokens_before
+            },
+        }
+
+    def print_report(self):
+        report = self.report()
+        print(
+            f"\nPrompt compression: {report['tokens_saved']} of {report['tokens_before']}"
+            f" estimated message tokens saved ({report['saved_fraction']:.1%})"
+        )
+
+
+COMPRESSION_STATS = CompressionStats()
+
+
+class CompressionConfig(pydantic.BaseModel):
+    """
+    Configuration of the compression stage. `role_max_chars` sets a per-role character
+    budget (e.g. {"assistant": 2000}); longer messages keep their start and end.
+    """
+    collapse_whitespace: bool = True
+    elide_code_blocks: bool = True
+    elide_urls: bool = True
+    elide_base64: bool = True
+    dedupe_paragraphs: bool = True
+    role_max_chars: dict[str, int] = {}
+
+    def compress(self, content: str, role: str) -> str:
+        """
+        Compress a message's content, recording the savings in COMPRESSION_STATS.
+        """
+        compressed = content
+        if self.elide_code_blocks:
+            compressed = CODE_BLOCK_PATTERN.sub(
+                lambda match: f"[code block elided: {match.group(0).count(chr(10)) + 1} lines]",
+                compressed,
+            )
+        if self.elide_base64:
+            compressed = BASE64_PATTERN.sub(elide_base64_match, compressed)
+        if self.elide_urls:
+            compressed = URL_PATTERN.sub(lambda match: f"[link: {match.group(1)}]", compressed)
+        if self.dedupe_paragraphs:
+            compressed = dedupe_paragraphs(compressed)
+        if self.collapse_whitespace:
+            compressed = INLINE_WHITESPACE_PATTERN.sub(" ", compressed)
+            compressed = BLANK_LINES_PATTERN.sub("\n\n", compressed).strip()
+        if role in self.role_max_chars:
+            compressed = truncate_string(
+                compressed,
+                max_len=self.role_max_chars[role],
+                sep="[[...Long Message Truncated...]]",
+            )
+        COMPRESSION_STATS.update(role, content, compressed)
+        return compressed
+
+
+def elide_base64_match(match: re.Match) -> str:
+    """
+    Elide a base64-looking run, unless it is plain text (e.g. a long run of one character).
+    """
+    blob = match.group(0)
+    is_encoded = blob.startswith("data:") or (
+        any(c.isdigit() for c in blob) and any(c.isupper() for c in blob) and any(c.islower() for c in blob)
+    )
+    return "[encoded data elided]" if is_encoded else blob
+
+
+def dedupe_paragraphs(content: str) -> str:
+    """
+    Replace paragraphs that repeat an earlier paragraph (ignoring whitespace and case)
+    with a single marker per run of repeats.
+    """
+    paragraphs = PARAGRAPH_SPLIT_PATTERN.split(content)
+    if len(paragraphs) < 2:
+        return content
+    seen = set()
+    kept = []
+    for paragraph in paragraphs:
+        key = " ".join(paragraph.split()).lower()
+        if key and key in seen:
+            if not kept or kept[-1] != "[repeated text elided]":
+                kept.append("[repeated text elided]")
+            continue
+        seen.add(key)
+        kept.append(paragraph)
+    return "\n\n".join(kept)
+
+
+def get_compressor(classifier_definition: dict):
+    """
+    Get the compression function (content, role) -> content of a classifier, or None.
+    """
+    compression = classifier_definition.get("compression")
+    if compression is None:
+        return None
+    return CompressionConfig(**compression).compress
@@ -0,0 +1,117 @@
+"""
+Dead-letter queue for chunks whose classification failed (`--dead_letter_path` of the runners).
+
+By default an error in one chunk request fails the whole conversation. Once `enable` is called,
+a failed chunk request is instead appended to the dead-letter file (classifier, conversation
+hash, chunk id and error) and the chunk is labeled "error", so the rest of the conversation is
+kept. `redrive_dead_letters.py` then retries only the dead-lettered chunks and patches their
+labels into the existing results. Request timeouts and budget stops keep their own handling
+(a "timeout" label, an incomplete conversation) and are not dead-lettered.
+
+The conversation hash is taken from the context set by `with_conversation`.
+"""
+
+import contextvars
+import os
+import time
+
+import pydantic
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.scheduling as scheduling
+from emoclassifiers.deadlines import RequestTimeoutError
+from emoclassifiers.usage import BudgetExceededError
+
+CONVERSATION_HASH = contextvars.ContextVar("emoclassifiers_conversation_hash", default=None)
+
+
+class DeadLetter(pydantic.BaseModel):
+    """
+    A chunk whose classification failed. `classifier_set` is the set its classifier was loaded from
+    (the version, for custom definitions, see `scheduling.get_classifier_set`).
+    """
+    conversation_hash: str | None
+    classifier_set: str
+    classifier: str
+    chunk_id: int
+    error_type: str
+    error: str
+    failed_at: float
+
+
+class DeadLetterQueue:
+    def __init__(self, path: str):
+        """
+        Write dead letters to the JSONL file at `path` (replacing it), flushing each one as it fails.
+        """
+        self.path = path
+        self.file = open(path, "w")
+        self.num_letters = 0
+
+    def add(self, letter: DeadLetter):
+        self.file.write(letter.model_dump_json() + "\n")
+        self.file.flush()
+        self.num_letters += 1
+
+    def close(self):
+        self.file.close()
+
+
+DEAD_LETTER_QUEUE = None
+
+
+def enable(path: str) -> DeadLetterQueue:
+    """
+    Dead-letter failed chunks to `path` instead of failing their conversation.
+    """
+    global DEAD_LETTER_QUEUE
+    DEAD_LETTER_QUEUE = DeadLetterQueue(path)
+    return DEAD_LETTER_QUEUE
+
+
+async def with_conversation(coroutine, conversation_hash: str):
+    """
+    Await a coroutine, dead-lettering its failed chunks under `conversation_hash`.
+    """
+    token = CONVERSATION_HASH.set(conversation_hash)
+    try:
+        return await coroutine
+    finally:
+        CONVERSATION_HASH.reset(token)
+
+
+async def capture(coroutine, classifier_definition: dict, chunk_ids: list[int], marker):
+    """
+    Await a coroutine classifying `chunk_ids`. If dead-lettering is enabled and it fails, record
+    the chunks in the dead-letter queue and return `marker` instead of raising.
+    """
+    if DEAD_LETTER_QUEUE is None:
+        return await coroutine
+    try:
+        return await coroutine
+    except (RequestTimeoutError, BudgetExceededError):
+        raise
+    except Exception as e:
+        for chunk_id in chunk_ids:
+            DEAD_LETTER_QUEUE.add(DeadLetter(
+                conversation_hash=CONVERSATION_HASH.get(),
+                classifier_set=scheduling.get_classifier_set(classifier_definition),
+                classifier=classifier_definition.get("name") or classifier_definition["full_name"],
+                chunk_id=chunk_id,
+                error_type=type(e).__name__,
+                error=str(e),
+                failed_at=time.time(),
+            ))
+        return marker
+
+
+def load_dead_letters(path: str) -> list[DeadLetter]:
+    return [DeadLetter.model_validate(row) for row in io_utils.load_jsonl(path)]
+
+
+def save_dead_letters(letters: list[DeadLetter], path: str):
+    """
+    Replace the dead-letter file at `path` (atomically) with `letters`.
+    """
+    io_utils.save_jsonl([letter.model_dump() for letter in letters], path + ".tmp")
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,92 @@
+"""
+Per-conversation deadlines and per-request timeouts.
+
+A deadline set with `deadline` (or `with_deadline`) applies to everything awaited within,
+including tasks started there. `EmoClassifier` classifies chunks with `gather_until_deadline`:
+chunks run in a task group, so an error cancels the sibling chunks, and when the deadline
+passes the unfinished chunks are cancelled and marked as timed out instead of failing the
+conversation. A chunk whose request exceeds the request timeout of `ModelWrapper`
+(`RequestTimeoutError`) is marked the same way.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+
+# Event loop time by which the current conversation must be classified, or None.
+DEADLINE = contextvars.ContextVar("emoclassifiers_deadline", default=None)
+
+
+class RequestTimeoutError(TimeoutError):
+    """
+    A request (including the client's retries) took longer than the request timeout.
+    """
+
+
+@contextlib.contextmanager
+def deadline(timeout: float | None):
+    """
+    Set a deadline `timeout` seconds from now for the enclosed code (an enclosing,
+    earlier deadline still applies). Does nothing if `timeout` is None.
+    """
+    if timeout is None:
+        yield
+        return
+    when = asyncio.get_running_loop().time() + timeout
+    current = DEADLINE.get()
+    token = DEADLINE.set(when if current is None else min(current, when))
+    try:
+        yield
+    finally:
+        DEADLINE.reset(token)
+
+
+async def with_deadline(coroutine, timeout: float | None):
+    """
+    Await a coroutine with a deadline `timeout` seconds from now.
+    """
+    with deadline(timeout):
+        return await coroutine
+
+
+async def mark_request_timeout(coroutine, marker):
+    """
+    Await a coroutine, returning `marker` if one of its requests timed out.
+    """
+    try:
+        return await coroutine
+    except RequestTimeoutError:
+        return marker
+
+
+async def gather_structured(coroutines: list) -> list:
+    """
+    Like `asyncio.gather`, but in a task group: if a coroutine fails, the others are cancelled
+    and its error is raised (not wrapped in an ExceptionGroup).
+    """
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            tasks = [task_group.create_task(coroutine) for coroutine in coroutines]
+    except BaseExceptionGroup as e:
+        raise e.exceptions[0]
+    return [task.result() for task in tasks]
+
+
+async def gather_until_deadline(coroutines: list, marker) -> list:
+    """
+    Run coroutines in a task group until the current deadline (if any). Results of coroutines
+    that were cut off by the deadline, or whose request timed out, are replaced by `marker`.
+    If a coroutine fails, the others are cancelled and its error is raised, as in `gather_structured`.
+    """
+    tasks = []
+    try:
+        async with asyncio.timeout_at(DEADLINE.get()):
+            async with asyncio.TaskGroup() as task_group:
+                for coroutine in coroutines:
+                    tasks.append(task_group.create_task(mark_request_timeout(coroutine, marker)))
+    except TimeoutError:
+        # The task group has cancelled the unfinished tasks.
+        pass
+    except BaseExceptionGroup as e:
+        raise e.exceptions[0]
+    return [task.result() if task.done() and not task.cancelled() else marker for task in tasks]
@@ -0,0 +1,81 @@
+"""
+Request deduplication for `ModelWrapper` (`deduplicator`, used by run_classification_service.py).
+
+Identical requests (same model, prompt and parameters) are sent once: a request identical to one
+in flight waits for its response, and recent responses are kept in a small LRU cache. This is
+common when classifying conversations online, where a conversation is classified again as it
+grows and its earlier chunks (or packed windows) render to the same prompts, and clients retry.
+
+The shared request runs in its own task, so cancelling one of its callers (e.g. on a deadline)
+does not fail the others; it is only cancelled once all of its callers are.
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+import emoclassifiers.metrics as metrics
+
+DEDUPED_REQUESTS = metrics.METRICS.counter(
+    "emoclassifiers_deduped_requests_total", "Requests answered without sending them, by source (in_flight, cache).",
+)
+
+
+class SharedRequest:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.num_callers = 0
+
+
+class RequestDeduplicator:
+    def __init__(self, max_cached: int = 10000):
+        """
+        Share identical requests in flight, and cache the last `max_cached` responses (0 to disable).
+        """
+        self.max_cached = max_cached
+        self.in_flight = {}
+        self.cache = OrderedDict()
+        self.num_requests = 0
+        self.num_in_flight_hits = 0
+        self.num_cache_hits = 0
+
+    def on_done(self, key: Hashable, task: asyncio.Task):
+        self.in_flight.pop(key, None)
+        if self.max_cached and not task.cancelled() and task.exception() is None:
+            self.cache[key] = task.result()
+            if len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+
+    async def run(self, key: Hashable, send: Callable[[], Awaitable]):
+        """
+        The response of `send()`, unless an identical request (by `key`) is in flight or cached.
+        """
+        self.num_requests += 1
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.num_cache_hits += 1
+            DEDUPED_REQUESTS.inc(source="cache")
+            return self.cache[key]
+        shared = self.in_flight.get(key)
+        if shared is None:
+            shared = SharedRequest(asyncio.ensure_future(send()))
+            self.in_flight[key] = shared
+            shared.task.add_done_callback(lambda task: self.on_done(key, task))
+        else:
+            self.num_in_flight_hits += 1
+            DEDUPED_REQUESTS.inc(source="in_flight")
+        shared.num_callers += 1
+        try:
+            return await asyncio.shield(shared.task)
+        finally:
+            shared.num_callers -= 1
+            if shared.num_callers == 0 and not shared.task.done():
+                shared.task.cancel()
+
+    def report(self) -> dict:
+        return {
+            "requests": self.num_requests,
+            "in_flight_hits": self.num_in_flight_hits,
+            "cache_hits": self.num_cache_hits,
+            "cached": len(self.cache),
+        }
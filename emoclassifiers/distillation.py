@@ -0,0 +1,358 @@
+"""
+Compact local classifiers distilled from stored LLM classification results.
+
+A hashed n-gram multinomial logistic regression (NumPy only) is trained per classifier.
+`DistilledModelWrapper` serves predictions above a confidence threshold locally and
+escalates the remaining chunks to the wrapped ModelWrapper.
+"""
+
+import json
+import math
+import os
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+import emoclassifiers.io_utils as io_utils
+from emoclassifiers.chunking import Chunk, ChunkPlan, truncate_string
+from emoclassifiers.classification import (
+    ChunkClassification,
+    ModelWrapper,
+    YesNoUnsureEnum,
+    QuestionTypeEnum,
+    IntentTypeEnum,
+    CLASSIFIER_DEFINITION_PATH_DICT,
+    get_classifier_name,
+    parse_label,
+)
+
+BIAS_FEATURE = "__bias__"
+
+
+def extract_features(string: str, num_features: int = 2 ** 18) -> np.ndarray:
+    """
+    Hash word unigrams/bigrams and character trigrams of a string into feature indices.
+    """
+    lowered = string.lower()
+    words = lowered.split()
+    grams = [BIAS_FEATURE]
+    grams += [f"w:{word}" for word in words]
+    grams += [f"b:{w1} {w2}" for w1, w2 in zip(words, words[1:])]
+    grams += [f"c:{lowered[i:i + 3]}" for i in range(len(lowered) - 2)]
+    indices = {zlib.crc32(gram.encode("utf-8")) % num_features for gram in grams}
+    return np.fromiter(sorted(indices), dtype=np.int64)
+
+
+def get_chunk_text(chunk: Chunk) -> str:
+    """
+    Text used as model input for a chunk: the (truncated) message being classified.
+    """
+    return truncate_string(chunk.chunk[-1]["content"].strip())
+
+
+class HashedLogisticRegression:
+    def __init__(self, labels: list[str], num_features: int = 2 ** 18, l2: float = 1e-3):
+        """
+        Multinomial logistic regression over hashed binary n-gram features.
+        """
+        self.labels = list(labels)
+        self.num_features = num_features
+        self.l2 = l2
+        self.weights = np.zeros((num_features, len(self.labels)), dtype=np.float32)
+
+    def _featurize(self, texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        feature_list = [extract_features(text, self.num_features) for text in texts]
+        indptr = np.zeros(len(feature_list) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(features) for features in feature_list])
+        indices = np.concatenate(feature_list) if feature_list else np.zeros(0, dtype=np.int64)
+        return indptr, indices
+
+    def _logits(self, indptr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        # Every row contains the bias feature, so no row is empty for reduceat.
+        return np.add.reduceat(self.weights[indices], indptr[:-1], axis=0)
+
+    @staticmethod
+    def _softmax(logits: np.ndarray) -> np.ndarray:
+        logits = logits - logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def fit(
+        self,
+        texts: list[str],
+        labels: list[str],
+        num_epochs: int = 5,
+        batch_size: int = 64,
+        learning_rate: float = 0.1,
+        seed: int = 0,
+    ) -> "HashedLogisticRegression":
+        """
+        Train with mini-batch AdaGrad.
+        """
+        label_to_idx = {label: i for i, label in enumerate(self.labels)}
+        targets = np.array([label_to_idx[label] for label in labels], dtype=np.int64)
+        indptr, indices = self._featurize(texts)
+        grad_sq = np.full_like(self.weights, 1e-8)
+        rng = np.random.default_rng(seed)
+        for _ in range(num_epochs):
+            order = rng.permutation(len(texts))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                batch_indices = np.concatenate([indices[indptr[i]:indptr[i + 1]] for i in batch])
+                batch_lengths = indptr[batch + 1] - indptr[batch]
+                batch_indptr = np.zeros(len(batch) + 1, dtype=np.int64)
+                batch_indptr[1:] = np.cumsum(batch_lengths)
+                probs = self._softmax(self._logits(batch_indptr, batch_indices))
+                probs[np.arange(len(batch)), targets[batch]] -= 1.0
+                row_grads = np.repeat(probs / len(batch), batch_lengths, axis=0)
+                unique_indices, inverse = np.unique(batch_indices, return_inverse=True)
+                grads = np.zeros((len(unique_indices), len(self.labels)), dtype=np.float32)
+                np.add.at(grads, inverse, row_grads)
+                grads += self.l2 * self.weights[unique_indices]
+                grad_sq[unique_indices] += grads ** 2
+                self.weights[unique_indices] -= learning_rate * grads / np.sqrt(grad_sq[unique_indices])
+        return self
+
+    def predict_proba(self, texts: list[str]) -> np.ndarray:
+        """
+        Predict label probabilities, shape (len(texts), len(labels)).
+        """
+        indptr, indices = self._featurize(texts)
+        return self._softmax(self._logits(indptr, indices))
+
+    def predict(self, texts: list[str]) -> list[tuple[str, float]]:
+        """
+        Predict (label, probability) pairs.
+        """
+        probs = self.predict_proba(texts)
+        return [(self.labels[i], float(row[i])) for row, i in zip(probs, probs.argmax(axis=1))]
+
+    def save(self, path: str):
+        """
+        Save the model as a compressed .npz file.
+        """
+        np.savez_compressed(
+            path,
+            weights=self.weights,
+            labels=np.array(json.dumps(self.labels)),
+            num_features=self.num_features,
+            l2=self.l2,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "HashedLogisticRegression":
+        """
+        Load a model saved with `save`.
+        """
+        data = np.load(path)
+        model = cls(
+            labels=json.loads(str(data["labels"])),
+            num_features=int(data["num_features"]),
+            l2=float(data["l2"]),
+        )
+        model.weights = data["weights"]
+        return model
+
+
+def load_training_examples(
+    results_path: str,
+    conversations_path: str,
+    classifier_set: str,
+    layout: str = "classifier",
+) -> dict[str, tuple[list[str], list[str]]]:
+    """
+    Join stored results with their conversations and return (texts, labels) per classifier key.
+
+    Results are JSONL records with "conversation_hash" and "classifications". With
+    layout="classifier", classifications are keyed by classifier key (single chunk, e.g.
+    intent results). With layout="chunk", the set has a single classifier and
+    classifications are keyed by chunk id (e.g. question tree results).
+    Results that are not valid labels (e.g. "error") are skipped.
+    """
+    definitions = io_utils.load_json(io_utils.get_path(CLASSIFIER_DEFINITION_PATH_DICT[classifier_set]))
+    conversations = {
+        row["conversation_hash"]: row["conversation"]
+        for row in io_utils.load_jsonl(conversations_path)
+    }
+    examples = defaultdict(lambda: ([], []))
+    for row in io_utils.load_jsonl(results_path):
+        conversation = conversations.get(row["conversation_hash"])
+        if conversation is None:
+            continue
+        # Chunked once per chunker, not once per label.
+        chunk_plan = ChunkPlan(conversation)
+        if layout == "chunk":
+            assert len(definitions) == 1, "layout='chunk' requires a single-classifier set"
+            key = next(iter(definitions))
+            items = [(key, int(chunk_id), label) for chunk_id, label in row["classifications"].items()]
+        elif layout == "classifier":
+            items = [(key, None, label) for key, label in row["classifications"].items()]
+        else:
+            raise ValueError(f"Unknown layout: {layout}")
+        for key, chunk_id, label in items:
+            if key not in definitions:
+                continue
+            try:
+                parse_label(label)
+            except ValueError:
+                continue
+            chunks = chunk_plan.get_chunks(definitions[key]["chunker"], definitions[key].get("chunker_kwargs"))
+            if chunk_id is None:
+                chunk_id = min(chunks, default=None)
+            if chunk_id not in chunks:
+                continue
+            texts, labels = examples[key]
+            texts.append(get_chunk_text(chunks[chunk_id]))
+            labels.append(label)
+    return dict(examples)
+
+
+def evaluate_thresholds(
+    model: HashedLogisticRegression,
+    texts: list[str],
+    labels: list[str],
+    thresholds: list[float],
+) -> list[dict]:
+    """
+    Agreement with the LLM labels vs. calls saved, for a range of confidence thresholds.
+    Chunks below the threshold are assumed to be escalated to the LLM (full agreement).
+    """
+    predictions = model.predict(texts)
+    report = []
+    for threshold in thresholds:
+        local = [(pred, label) for (pred, prob), label in zip(predictions, labels) if prob >= threshold]
+        num_agree = sum(pred == label for pred, label in local)
+        report.append({
+            "threshold": threshold,
+            "calls_saved": len(local) / len(labels) if labels else 0.0,
+            "local_agreement": num_agree / len(local) if local else None,
+            "overall_agreement": (num_agree + len(labels) - len(local)) / len(labels) if labels else None,
+        })
+    return report
+
+
+def get_held_out_agreement(evaluation: dict, threshold: float) -> float | None:
+    """
+    Held-out agreement of the locally served chunks at `threshold`, or None if it was not
+    evaluated at that threshold (agreement at other thresholds says nothing about it).
+    """
+    for row in evaluation["thresholds"]:
+        if math.isclose(row["threshold"], threshold):
+            return row["local_agreement"]
+    return None
+
+
+def load_distilled_models(
+    model_dir: str,
+    classifier_set: str,
+    threshold: float = 0.95,
+    min_agreement: float = 0.95,
+) -> dict[str, HashedLogisticRegression]:
+    """
+    Load distilled models saved as `<model_dir>/<classifier key>.npz`, keyed by classifier name.
+    Models whose held-out agreement at `threshold` (from the evaluation report saved with them by
+    train_distilled_classifiers.py, which must include `threshold` in its `--thresholds`) is below
+    `min_agreement`, or unknown, are not loaded, so their classifiers always go to the model.
+    """
+    definitions = io_utils.load_json(io_utils.get_path(CLASSIFIER_DEFINITION_PATH_DICT[classifier_set]))
+    report_path = os.path.join(model_dir, "evaluation_report.json")
+    evaluation_report = io_utils.load_json(report_path) if os.path.exists(report_path) else {}
+    models = {}
+    for key, definition in definitions.items():
+        path = os.path.join(model_dir, f"{key}.npz")
+        if not os.path.exists(path):
+            continue
+        agreement = None
+        if key in evaluation_report:
+            agreement = get_held_out_agreement(evaluation_report[key], threshold)
+        if agreement is None or agreement < min_agreement:
+            agreement_str = "unknown" if agreement is None else f"{agreement:.3f}"
+            print(
+                f"Not using the distilled model for {key}: held-out agreement {agreement_str}"
+                f" at threshold {threshold} is below {min_agreement}"
+            )
+            continue
+        models[get_classifier_name(definition)] = HashedLogisticRegression.load(path)
+    return models
+
+
+class DistilledModelWrapper:
+    # Packed and localized requests would bypass the distilled models (see `EmoClassifier`).
+    PER_CHUNK_ONLY = True
+
+    def __init__(
+        self,
+        model_wrapper: ModelWrapper,
+        models: dict[str, HashedLogisticRegression],
+        threshold: float = 0.95,
+        thresholds: dict[str, float] | None = None,
+    ):
+        """
+        A local cascade stage in front of a ModelWrapper. Chunks whose distilled model
+        prediction is at least as confident as the classifier's threshold are served
+        locally; everything else is escalated to the wrapped ModelWrapper.
+        """
+        self.model_wrapper = model_wrapper
+        self.models = models
+        self.threshold = threshold
+        self.thresholds = thresholds or {}
+        self.num_local = defaultdict(int)
+        self.num_escalated = defaultdict(int)
+
+    def __getattr__(self, name):
+        # Expose the wrapped ModelWrapper's attributes (model, scheduler, ...).
+        return getattr(self.model_wrapper, name)
+
+    async def classify_conversation_chunk(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        max_completion_tokens: int = 20,
+    ) -> YesNoUnsureEnum | QuestionTypeEnum | IntentTypeEnum:
+        """
+        Classify a single conversation chunk, locally if the distilled model is confident.
+        """
+        result = await self.classify_conversation_chunk_detailed(
+            classifier_definition=classifier_definition,
+            chunk=chunk,
+            max_completion_tokens=max_completion_tokens,
+        )
+        return result.label
+
+    async def classify_conversation_chunk_detailed(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        max_completion_tokens: int = 20,
+    ) -> ChunkClassification:
+        """
+        Classify a single conversation chunk, locally if the distilled model is confident.
+        """
+        name = get_classifier_name(classifier_definition)
+        model = self.models.get(name)
+        if model is not None:
+            (label, probability), = model.predict([get_chunk_text(chunk)])
+            if probability >= self.thresholds.get(name, self.threshold):
+                self.num_local[name] += 1
+                return ChunkClassification(label=parse_label(label), probability=probability, model="distilled")
+        self.num_escalated[name] += 1
+        return await self.model_wrapper.classify_conversation_chunk_detailed(
+            classifier_definition=classifier_definition,
+            chunk=chunk,
+            max_completion_tokens=max_completion_tokens,
+        )
+
+    def report(self) -> dict:
+        """
+        Fraction of chunks served locally per classifier.
+        """
+        report = {}
+        for name in set(self.num_local) | set(self.num_escalated):
+            total = self.num_local[name] + self.num_escalated[name]
+            report[name] = {
+                "local": self.num_local[name],
+                "escalated": self.num_escalated[name],
+                "local_rate": self.num_local[name] / total,
+            }
+        return report
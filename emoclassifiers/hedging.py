@@ -0,0 +1,195 @@
+"""
+Hedged requests (`hedging_policy` of `ModelWrapper`, `--hedge_percentile` of the runners).
+
+When a request has not answered after a percentile of recent latencies, a duplicate is sent and
+whichever answers first (successfully) is used. Hedges are capped to a fraction of requests, and
+are only sent while the usage budget (if any) allows them. A hedge is a request like any other: it
+waits for its own scheduler slot and rate limiter tokens (see `ModelWrapper.send_hedged_request`),
+so hedging never exceeds `max_concurrent` or the rate limits.
+
+The losing copy is cancelled as soon as the other answers, and awaited before returning, so it
+does not keep running once the caller has released its slot. If it answered anyway, its usage is
+recorded as the extra spend of hedging (the usage of cancelled copies is unknown).
+
+The hedging delay is a percentile of the latencies of original requests, timed on their own: a
+cancelled original only gives a lower bound (the time until it was cancelled), never the hedge's
+time. Since a cancelled original's latency is unknown, a random `holdout_rate` fraction of requests
+is never hedged: their latencies (and those before the delay is known) are the latency without
+hedging in the report, compared with the latency seen by the other requests.
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import numpy as np
+
+import emoclassifiers.metrics as metrics
+from emoclassifiers.usage import Usage
+
+HEDGED_REQUESTS = metrics.METRICS.counter(
+    "emoclassifiers_hedged_requests_total", "Duplicate requests sent by the hedging policy, by winning copy.",
+)
+
+
+def get_percentiles(values) -> dict:
+    if not values:
+        return {}
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+class HedgingPolicy:
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        max_hedge_rate: float = 0.05,
+        min_delay: float = 0.05,
+        window: int = 1000,
+        min_samples: int = 100,
+        reservoir_size: int = 10000,
+        holdout_rate: float = 0.05,
+        seed: int = 0,
+    ):
+        """
+        Hedge requests slower than the `percentile` of the last `window` latencies of original
+        requests (at least `min_delay` seconds), once `min_samples` latencies have been seen. At most
+        a fraction `max_hedge_rate` of requests is hedged, and a fraction `holdout_rate` is never
+        hedged, to measure the latency without hedging.
+        """
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.holdout_rate = holdout_rate
+        self.rng = random.Random(seed)
+        # Latencies of original requests (lower bounds for cancelled ones), for the delay.
+        self.recent_latencies = deque(maxlen=window)
+        # Latencies of requests that could not be hedged (held out, or before the delay was known).
+        self.unhedged_latencies = deque(maxlen=reservoir_size)
+        # Latencies seen by the caller, for requests that could be hedged.
+        self.hedged_latencies = deque(maxlen=reservoir_size)
+        self.delay = None
+        self.num_requests = 0
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+        self.num_censored = 0
+        self.extra_usage = Usage()
+
+    def observe(self, latency: float):
+        """
+        Record the latency of an original request (until it was cancelled, if a hedge won).
+        """
+        self.recent_latencies.append(latency)
+        num_samples = len(self.recent_latencies)
+        # Refresh the delay every few samples rather than on every request.
+        if num_samples >= self.min_samples and (self.delay is None or num_samples % 20 == 0):
+            self.delay = max(self.min_delay, float(np.percentile(self.recent_latencies, self.percentile)))
+
+    def can_hedge(self) -> bool:
+        return self.num_hedges < self.max_hedge_rate * self.num_requests
+
+    async def send(
+        self,
+        send_request: Callable[[], Awaitable],
+        model: str,
+        send_hedge: Callable[[], Awaitable] | None = None,
+        reserve_hedge: Callable[[], bool] = lambda: True,
+        on_extra_result: Callable = lambda result: None,
+    ):
+        """
+        Send a request with `send_request` (returning the model it was sent to and the response),
+        hedging it with `send_hedge` (by default `send_request`) if it is slow. `reserve_hedge` is
+        called before sending a hedge (which is skipped if it returns False), and `on_extra_result`
+        with the result of the losing copy if it answered before being cancelled.
+        """
+        send_hedge = send_hedge or send_request
+        self.num_requests += 1
+        start_time = time.perf_counter()
+        original_end_time = None
+
+        async def send_original():
+            nonlocal original_end_time
+            try:
+                return await send_request()
+            finally:
+                # When it answered, or was cancelled.
+                original_end_time = time.perf_counter()
+
+        if self.delay is None or self.rng.random() < self.holdout_rate:
+            result = await send_original()
+            latency = original_end_time - start_time
+            self.observe(latency)
+            self.unhedged_latencies.append(latency)
+            return result
+        original = asyncio.ensure_future(send_original())
+        hedge = None
+        try:
+            await asyncio.wait({original}, timeout=self.delay)
+            if original.done() or not self.can_hedge() or not reserve_hedge():
+                result = await original
+                latency = time.perf_counter() - start_time
+                self.observe(original_end_time - start_time)
+                self.hedged_latencies.append(latency)
+                return result
+            self.num_hedges += 1
+            hedge = asyncio.ensure_future(send_hedge())
+            done, _ = await asyncio.wait({original, hedge}, return_when=asyncio.FIRST_COMPLETED)
+            winner = original if original in done else hedge
+            loser = hedge if winner is original else original
+            if winner.exception() is not None:
+                # Fall back to the other copy; if it fails too, its error is raised.
+                await asyncio.wait({loser})
+                winner, loser = loser, winner
+            result = winner.result()
+        finally:
+            tasks = [task for task in (original, hedge) if task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.hedged_latencies.append(time.perf_counter() - start_time)
+        if original.cancelled():
+            self.num_censored += 1
+        self.observe(original_end_time - start_time)
+        if winner is hedge:
+            self.num_hedge_wins += 1
+        HEDGED_REQUESTS.inc(model=model, winner="original" if winner is original else "hedge")
+        if not loser.cancelled() and loser.exception() is None:
+            loser_result = loser.result()
+            loser_model, loser_response = loser_result
+            self.extra_usage.add(Usage.from_response(loser_model, loser_response.usage))
+            on_extra_result(loser_result)
+        return result
+
+    def report(self) -> dict:
+        return {
+            "percentile": self.percentile,
+            "max_hedge_rate": self.max_hedge_rate,
+            "holdout_rate": self.holdout_rate,
+            "delay": self.delay,
+            "requests": self.num_requests,
+            "hedges": self.num_hedges,
+            "hedge_rate": self.num_hedges / self.num_requests if self.num_requests else 0.0,
+            "hedge_wins": self.num_hedge_wins,
+            # Originals cancelled after losing to their hedge (their latency is only a lower bound).
+            "censored": self.num_censored,
+            "extra_usage": self.extra_usage.model_dump(),
+            "latency_without_hedging": get_percentiles(self.unhedged_latencies),
+            "latency_with_hedging": get_percentiles(self.hedged_latencies),
+        }
+
+    def print_report(self):
+        report = self.report()
+        print(
+            f"Hedging: {report['hedges']}/{report['requests']} requests hedged ({report['hedge_rate']:.1%}),"
+            f" {report['hedge_wins']} won by the hedge,"
+            f" extra spend ${report['extra_usage']['cost']:.4f}"
+            f" ({report['extra_usage']['prompt_tokens']} prompt tokens)"
+        )
+        for q, value in report["latency_with_hedging"].items():
+            print(f"  {q} latency: {report['latency_without_hedging'].get(q, float('nan')):.3f}s without hedging, {value:.3f}s with")
+        print(
+            f"  (without hedging: {len(self.unhedged_latencies)} held out or warm-up requests;"
+            f" with: {len(self.hedged_latencies)} requests that could be hedged)"
+        )
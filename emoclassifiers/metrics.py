@@ -0,0 +1,359 @@
+"""
+Metrics for the classification pipeline: counters, gauges and histograms with labels,
+exported through a pluggable sink (a Prometheus text-format file or HTTP endpoint, or periodic
+JSON snapshots).
+
+`ModelWrapper` records requests in flight, semaphore wait, request latency, errors by type,
+requests and tokens per classifier (the cache hit rate is cached / prompt tokens), and the
+runners record completed conversations. Metrics live in the global `METRICS` registry.
+"""
+
+import http.server
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+# Latency buckets (seconds) for histograms.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    ) + "}"
+
+
+class Metric:
+    """
+    Base class for metrics. Values are keyed by their sorted (label, value) pairs.
+    """
+    metric_type = None
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def to_prometheus(self) -> list[str]:
+        raise NotImplementedError()
+
+    def snapshot(self) -> dict:
+        raise NotImplementedError()
+
+    def reset(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values = defaultdict(float)
+
+    def inc(self, amount: float = 1.0, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] += amount
+
+    def total(self, **labels) -> float:
+        """
+        Sum over all label values matching `labels`.
+        """
+        with self.lock:
+            return sum(
+                value for key, value in self.values.items()
+                if all(item in key for item in labels.items())
+            )
+
+    def to_prometheus(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {format_labels(key): value for key, value in self.values.items()}
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Gauge(Counter):
+    metric_type = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    """
+    A histogram with cumulative buckets (for Prometheus). Snapshots report percentiles
+    over the most recent `reservoir_size` observations.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS, reservoir_size: int = 10000):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.bucket_counts = defaultdict(lambda: [0] * len(buckets))
+        self.sums = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.recent = defaultdict(lambda: deque(maxlen=reservoir_size))
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            bucket_counts = self.bucket_counts[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            self.sums[key] += value
+            self.counts[key] += 1
+            self.recent[key].append(value)
+
+    def to_prometheus(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, bucket_counts in self.bucket_counts.items():
+                for bound, count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {self.counts[key]}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {self.sums[key]}")
+                lines.append(f"{self.name}_count{format_labels(key)} {self.counts[key]}")
+        return lines
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                format_labels(key): {
+                    "count": self.counts[key],
+                    "sum": self.sums[key],
+                    "p50": float(np.percentile(recent, 50)),
+                    "p95": float(np.percentile(recent, 95)),
+                    "p99": float(np.percentile(recent, 99)),
+                }
+                for key, recent in self.recent.items()
+                if recent
+            }
+
+    def reset(self):
+        with self.lock:
+            self.bucket_counts.clear()
+            self.sums.clear()
+            self.counts.clear()
+            self.recent.clear()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        A set of named metrics.
+        """
+        self.metrics = {}
+        self.started_at = time.time()
+
+    def register(self, metric: Metric) -> Metric:
+        assert metric.name not in self.metrics, f"Duplicate metric: {metric.name}"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.register(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, **kwargs) -> Histogram:
+        return self.register(Histogram(name, help, **kwargs))
+
+    def to_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """
+        All metrics as a JSON-serializable dict, with derived throughput and cache hit rate.
+        """
+        elapsed = time.time() - self.started_at
+        snapshot = {
+            "timestamp": time.time(),
+            "elapsed_seconds": elapsed,
+            "metrics": {name: metric.snapshot() for name, metric in self.metrics.items()},
+        }
+        if "emoclassifiers_requests_total" in self.metrics:
+            snapshot["requests_per_second"] = {
+                labels: value / elapsed
+                for labels, value in self.metrics["emoclassifiers_requests_total"].snapshot().items()
+            }
+        if "emoclassifiers_tokens_total" in self.metrics:
+            tokens = self.metrics["emoclassifiers_tokens_total"]
+            prompt_tokens = tokens.total(kind="prompt")
+            snapshot["cache_hit_rate"] = tokens.total(kind="cached") / prompt_tokens if prompt_tokens else None
+        return snapshot
+
+    def reset(self):
+        """
+        Clear all values and restart the throughput clock, e.g. between benchmark runs.
+        """
+        for metric in self.metrics.values():
+            metric.reset()
+        self.started_at = time.time()
+
+
+METRICS = MetricsRegistry()
+REQUESTS_IN_FLIGHT = METRICS.gauge(
+    "emoclassifiers_requests_in_flight", "Requests sent and awaiting a response.",
+)
+SEMAPHORE_WAIT = METRICS.histogram(
+    "emoclassifiers_semaphore_wait_seconds", "Time spent waiting for the concurrency semaphore.",
+)
+REQUEST_LATENCY = METRICS.histogram(
+    "emoclassifiers_request_latency_seconds", "Latency of API requests.",
+)
+REQUESTS = METRICS.counter(
+    "emoclassifiers_requests_total", "Completed API requests.",
+)
+ERRORS = METRICS.counter(
+    "emoclassifiers_errors_total", "Failed requests and unparseable responses, by error type.",
+)
+TOKENS = METRICS.counter(
+    "emoclassifiers_tokens_total", "Tokens by kind (prompt, cached, completion).",
+)
+CONVERSATIONS = METRICS.counter(
+    "emoclassifiers_conversations_total", "Conversations completed by the runners.",
+)
+TIMED_OUT_CONVERSATIONS = METRICS.counter(
+    "emoclassifiers_conversations_timed_out_total", "Conversations with chunks cut off by a deadline or request timeout.",
+)
+
+
+class MetricsSink:
+    """
+    Base class for metric sinks. Periodic sinks export every `interval` seconds from a
+    background thread, and once more on `stop`.
+    """
+    def __init__(self, registry: MetricsRegistry = METRICS, interval: float = 15.0):
+        self.registry = registry
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def export(self):
+        raise NotImplementedError()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.export()
+
+    def start(self) -> "MetricsSink":
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
+
+
+class PrometheusFileSink(MetricsSink):
+    def __init__(self, target: str, **kwargs):
+        """
+        Periodically write the metrics to a Prometheus text-format file
+        (e.g. for the node exporter's textfile collector).
+        """
+        super().__init__(**kwargs)
+        self.path = target
+
+    def export(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.registry.to_prometheus())
+        # Atomic replace, so scrapers never read a partial file.
+        os.replace(tmp_path, self.path)
+
+
+class JSONSnapshotSink(MetricsSink):
+    def __init__(self, target: str, **kwargs):
+        """
+        Periodically append a JSON snapshot of the metrics to a JSONL file.
+        """
+        super().__init__(**kwargs)
+        self.path = target
+
+    def export(self):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(self.registry.snapshot()) + "\n")
+
+
+class PrometheusHTTPSink(MetricsSink):
+    def __init__(self, target: str, **kwargs):
+        """
+        Serve the metrics in the Prometheus text format at http://<host>:<port>/metrics,
+        with `target` given as "port" or "host:port". With only a port, the metrics are served on
+        localhost; give a host (e.g. "0.0.0.0:9100") to expose them to other machines.
+        """
+        super().__init__(**kwargs)
+        host, _, port = target.rpartition(":")
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/snapshot":
+                    body, content_type = json.dumps(registry.snapshot()), "application/json"
+                else:
+                    body, content_type = registry.to_prometheus(), "text/plain; version=0.0.4"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def export(self):
+        pass
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+SINK_DICT = {
+    "prometheus_file": PrometheusFileSink,
+    "prometheus_http": PrometheusHTTPSink,
+    "json": JSONSnapshotSink,
+}
+
+
+def start_sink(sink_type: str, target: str, interval: float = 15.0) -> MetricsSink:
+    """
+    Start a metrics sink of the given type on the global registry.
+    """
+    return SINK_DICT[sink_type](target=target, interval=interval).start()
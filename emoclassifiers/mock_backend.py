@@ -0,0 +1,357 @@
+"""
+A local stand-in for the chat completions API, for benchmarking the pipeline without API calls.
+
+It implements the requests `ModelWrapper` sends: structured outputs (`response_format` with a JSON
+schema, including packed and localized requests), single label token requests with logprobs, and `usage`.
+Labels are deterministic in the prompt, latency follows a configurable distribution, and 429
+and 500 responses can be injected.
+
+It can be used in-process, through the real openai client with a mock HTTP transport
+(`get_mock_client`), or as an HTTP server:
+
+    python -m emoclassifiers.mock_backend --port 8000 --latency_mean 0.5 --rate_limit_rate 0.01
+    OPENAI_BASE_URL=http://localhost:8000/v1 OPENAI_API_KEY=mock python examples/run_simple_classification.py ...
+
+With `--num_servers`, several backends are served on consecutive ports, as endpoints of a client pool.
+"""
+
+import argparse
+import asyncio
+import http.server
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+import httpx
+import openai
+import pydantic
+
+from emoclassifiers.chunking import estimate_num_tokens
+
+PACKED_TARGETS_PATTERN = re.compile(r"target message indices: ([\d, ]+)\.?\s*$")
+LABEL_TOKEN_LABELS_PATTERN = re.compile(r"exactly one of: (.+?)\.\s*$")
+NUMBERED_MESSAGE_PATTERN = re.compile(r"^\[(\d+)\] \[", re.MULTILINE)
+
+
+class MockBackendConfig(pydantic.BaseModel):
+    """
+    Configuration of the mock backend. Latency is `latency_mean` (plus `latency_per_1k_prompt_tokens`)
+    with noise from `latency_distribution`: "constant", "uniform" (+/- `latency_sigma` * mean) or
+    "lognormal" (with shape `latency_sigma`). Labels are drawn deterministically from a hash of the
+    prompt, with optional `label_weights`, and returned with probability `label_confidence`.
+    """
+    latency_distribution: str = "lognormal"
+    latency_mean: float = 0.5
+    latency_sigma: float = 0.5
+    latency_per_1k_prompt_tokens: float = 0.0
+    rate_limit_rate: float = 0.0
+    error_rate: float = 0.0
+    label_weights: dict[str, float] = {}
+    label_confidence: float = 0.9
+    seed: int = 0
+
+
+def find_enum(schema) -> list[str] | None:
+    """
+    Find the first list of enum values in a JSON schema.
+    """
+    if isinstance(schema, dict):
+        if "enum" in schema:
+            return schema["enum"]
+        values = schema.values()
+    elif isinstance(schema, list):
+        values = schema
+    else:
+        return None
+    for value in values:
+        found = find_enum(value)
+        if found is not None:
+            return found
+    return None
+
+
+class MockBackend:
+    def __init__(self, config: MockBackendConfig | None = None):
+        """
+        Request handling shared by the in-process transport and the HTTP server.
+        """
+        self.config = config or MockBackendConfig()
+        self.rng = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def sample_latency(self, prompt_tokens: int) -> float:
+        config = self.config
+        mean = config.latency_mean + config.latency_per_1k_prompt_tokens * prompt_tokens / 1000
+        with self.lock:
+            if config.latency_distribution == "constant":
+                return mean
+            elif config.latency_distribution == "uniform":
+                return max(0.0, self.rng.uniform(mean * (1 - config.latency_sigma), mean * (1 + config.latency_sigma)))
+            elif config.latency_distribution == "lognormal":
+                # Shift mu so that the mean of the distribution is `mean`.
+                mu = math.log(max(mean, 1e-6)) - config.latency_sigma ** 2 / 2
+                return self.rng.lognormvariate(mu, config.latency_sigma)
+            raise ValueError(f"Unknown latency distribution: {config.latency_distribution}")
+
+    def choose_label(self, key: str, labels: list[str]) -> str:
+        """
+        Choose a label deterministically from a hash of `key`.
+        """
+        weights = [self.config.label_weights.get(label, 1.0) for label in labels]
+        point = zlib.crc32(f"{self.config.seed}:{key}".encode()) / 2**32 * sum(weights)
+        for label, weight in zip(labels, weights):
+            point -= weight
+            if point < 0:
+                return label
+        return labels[-1]
+
+    def get_token_logprobs(self, tokens: list[str], label: str, labels: list[str], top_logprobs: int) -> list[dict]:
+        """
+        Logprobs for the response tokens: the label token has probability `label_confidence`,
+        and the remaining mass is shared by the other labels.
+        """
+        confidence = self.config.label_confidence
+        other_logprob = math.log(max((1 - confidence) / max(len(labels) - 1, 1), 1e-12))
+        content = []
+        for token in tokens:
+            if token != label:
+                content.append({"token": token, "logprob": 0.0, "bytes": None, "top_logprobs": []})
+                continue
+            alternatives = [{"token": label, "logprob": math.log(confidence), "bytes": None}] + [
+                {"token": other, "logprob": other_logprob, "bytes": None}
+                for other in labels if other != label
+            ]
+            content.append({
+                "token": label,
+                "logprob": math.log(confidence),
+                "bytes": None,
+                "top_logprobs": alternatives[:top_logprobs],
+            })
+        return content
+
+    def get_content(self, body: dict, prompt: str) -> tuple[str, list | None]:
+        """
+        Build the response content (and logprobs, if requested) for a request.
+        """
+        response_format = body.get("response_format")
+        top_logprobs = body.get("top_logprobs") or 0
+        if response_format and response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            labels = find_enum(schema)
+            if "responses" in schema.get("properties", {}):
+                match = PACKED_TARGETS_PATTERN.search(prompt)
+                target_ids = [int(idx) for idx in match.group(1).split(",")] if match else []
+                content = json.dumps({"responses": [
+                    {"index": idx, "response": self.choose_label(f"{prompt}:{idx}", labels)}
+                    for idx in target_ids
+                ]})
+                return content, None
+            label = self.choose_label(prompt, labels)
+            tokens = ['{"', "response", '":"', label, '"}']
+            if "message_indices" in schema.get("properties", {}):
+                # Localized requests: one or two of the numbered messages behind a "yes".
+                indices = [int(idx) for idx in NUMBERED_MESSAGE_PATTERN.findall(prompt)]
+                message_indices = []
+                if label == "yes" and indices:
+                    message_indices = sorted({
+                        indices[zlib.crc32(f"{prompt}:{i}".encode()) % len(indices)] for i in range(2)
+                    })
+                tokens = tokens[:-1] + ['","message_indices":', json.dumps(message_indices), "}"]
+        else:
+            match = LABEL_TOKEN_LABELS_PATTERN.search(prompt)
+            labels = match.group(1).split(", ") if match else ["yes", "no"]
+            label = self.choose_label(prompt, labels)
+            tokens = [label]
+        logprobs = None
+        if body.get("logprobs"):
+            logprobs = {"content": self.get_token_logprobs(tokens, label, labels, top_logprobs), "refusal": None}
+        return "".join(tokens), logprobs
+
+    def handle(self, body: dict) -> tuple[int, dict, dict, float]:
+        """
+        Handle a chat completions request body. Returns (status, headers, payload, latency);
+        the caller waits for `latency` seconds before responding.
+        """
+        prompt = body["messages"][-1]["content"]
+        prompt_tokens = estimate_num_tokens(prompt)
+        latency = self.sample_latency(prompt_tokens)
+        with self.lock:
+            draw = self.rng.random()
+            self.stats["requests"] += 1
+            request_id = self.stats["requests"]
+            if draw < self.config.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+            elif draw < self.config.rate_limit_rate + self.config.error_rate:
+                self.stats["errors"] += 1
+        if draw < self.config.rate_limit_rate:
+            error = {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}
+            return 429, {"retry-after-ms": "100"}, {"error": error}, min(latency, 0.05)
+        if draw < self.config.rate_limit_rate + self.config.error_rate:
+            error = {"message": "Internal error (mock)", "type": "server_error", "code": None}
+            return 500, {}, {"error": error}, latency
+        content, logprobs = self.get_content(body, prompt)
+        completion_tokens = estimate_num_tokens(content)
+        max_completion_tokens = body.get("max_completion_tokens")
+        finish_reason = "stop"
+        if max_completion_tokens is not None and completion_tokens > max_completion_tokens and logprobs is None:
+            finish_reason = "length"
+        payload = {
+            "id": f"chatcmpl-mock-{request_id}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "logprobs": logprobs,
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }
+        return 200, {}, payload, latency
+
+
+MODELS_PAYLOAD = {"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}]}
+
+
+def get_mock_transport(backend: MockBackend) -> httpx.MockTransport:
+    """
+    An httpx transport answering chat completions (and model list) requests with the mock backend.
+    """
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "GET" and request.url.path.rstrip("/").endswith("/models"):
+            return httpx.Response(200, json=MODELS_PAYLOAD)
+        if not request.url.path.endswith("/chat/completions"):
+            return httpx.Response(404, json={"error": {"message": "Not found (mock)"}})
+        status, headers, payload, latency = backend.handle(json.loads(request.content))
+        await asyncio.sleep(latency)
+        return httpx.Response(status, headers=headers, json=payload)
+
+    return httpx.MockTransport(handler)
+
+
+def get_backend_client(backend: MockBackend, max_retries: int = 2) -> openai.AsyncOpenAI:
+    """
+    An openai client backed in-process by `backend`.
+    """
+    return openai.AsyncOpenAI(
+        api_key="mock",
+        base_url="http://mock-backend/v1",
+        max_retries=max_retries,
+        http_client=httpx.AsyncClient(transport=get_mock_transport(backend)),
+    )
+
+
+def get_mock_client(
+    config: MockBackendConfig | None = None,
+    max_retries: int = 2,
+) -> tuple[openai.AsyncOpenAI, MockBackend]:
+    """
+    An openai client backed in-process by a mock backend (returned too, for its stats).
+    """
+    backend = MockBackend(config)
+    return get_backend_client(backend, max_retries=max_retries), backend
+
+
+def serve(config: MockBackendConfig, host: str = "127.0.0.1", port: int = 8000) -> http.server.ThreadingHTTPServer:
+    """
+    Create an HTTP server (one thread per connection) for the mock backend. Call `serve_forever` to run it.
+    """
+    backend = MockBackend(config)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                self.respond(200, {}, MODELS_PAYLOAD)
+            else:
+                self.respond(404, {}, {"error": {"message": "Not found (mock)"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path.rstrip("/").endswith("/chat/completions"):
+                status, headers, payload, latency = backend.handle(body)
+                time.sleep(latency)
+            else:
+                status, headers, payload = 404, {}, {"error": {"message": "Not found (mock)"}}
+            self.respond(status, headers, payload)
+
+        def respond(self, status: int, headers: dict, payload: dict):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.backend = backend
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock chat completions API.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--num_servers",
+        type=int,
+        default=1,
+        help="Serve several independent backends on consecutive ports, e.g. to test a client pool.",
+    )
+    parser.add_argument("--latency_distribution", type=str, default="lognormal", choices=["constant", "uniform", "lognormal"])
+    parser.add_argument("--latency_mean", type=float, default=0.5)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--latency_per_1k_prompt_tokens", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--label_weights", type=str, default="{}", help='JSON, e.g. \'{"yes": 0.2, "no": 1}\'')
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    config = MockBackendConfig(
+        latency_distribution=args.latency_distribution,
+        latency_mean=args.latency_mean,
+        latency_sigma=args.latency_sigma,
+        latency_per_1k_prompt_tokens=args.latency_per_1k_prompt_tokens,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        label_weights=json.loads(args.label_weights),
+        seed=args.seed,
+    )
+    servers = [
+        serve(config.model_copy(update={"seed": config.seed + i}), host=args.host, port=args.port + i)
+        for i in range(args.num_servers)
+    ]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Mock backend listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+            print(f"Served on port {server.server_address[1]}: {dict(server.backend.stats)}")
+
+if __name__ == "__main__":
+    main()
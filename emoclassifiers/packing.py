@@ -0,0 +1,154 @@
+"""
+Multi-chunk packing: classify several chunks of one conversation in a single request.
+
+Per-message chunkers produce one chunk per target message, and neighboring chunks overlap
+by their context messages. In packed mode, a window of the conversation is presented once,
+with every message numbered and the target messages marked, and the model returns one
+label per target index. Windows are split so that each stays under a token budget.
+"""
+
+from typing import Callable
+
+import pydantic
+
+import emoclassifiers.prompt_templates as prompt_templates
+from emoclassifiers.chunking import Chunk, estimate_num_tokens, truncate_string
+from emoclassifiers.compression import get_compressor
+
+# Chunkers whose chunk ids are the indices of the target messages.
+PACKABLE_CHUNKERS = {"user_message", "assistant_message", "u_a_exchange", "a_u_exchange"}
+
+
+class PackedWindow(pydantic.BaseModel):
+    """
+    A contiguous range of messages `[start, end]` containing one or more target messages.
+    """
+    start: int
+    end: int
+    target_ids: list[int]
+
+
+def render_message(
+    message: dict,
+    idx: int,
+    is_target: bool,
+    do_truncate: bool = False,
+    compressor: Callable[[str, str], str] | None = None,
+) -> str:
+    """
+    Render a single numbered message, in the same format (and truncation) as `Chunk.to_string`.
+    """
+    content = message["content"].strip()
+    if compressor is not None:
+        content = compressor(content, message["role"])
+    if do_truncate:
+        content = truncate_string(content, sep="[[...Long Message Truncated...]]")
+    return '[{idx}] [{marker}{role}{marker}] "{content}"'.format(
+        idx=idx,
+        marker="*" if is_target else "",
+        role=message["role"].upper(),
+        content=content,
+    )
+
+
+def plan_packed_windows(
+    simple_convo: list[dict],
+    chunks: dict[int, Chunk],
+    max_tokens: int = 6000,
+    n_context: int = 3,
+) -> list[PackedWindow]:
+    """
+    Greedily group the target messages (chunk ids) into windows whose rendered
+    messages stay under `max_tokens`. Each window starts with up to `n_context`
+    messages of context before its first target. A single target that exceeds the
+    budget on its own still gets its own window.
+    """
+    message_tokens = [
+        estimate_num_tokens(render_message(message, idx, is_target=True))
+        for idx, message in enumerate(simple_convo)
+    ]
+    windows = []
+    current = None
+    for target_id in sorted(chunks):
+        if current is not None:
+            num_tokens = sum(message_tokens[current.start : target_id + 1])
+            if num_tokens <= max_tokens:
+                current.end = target_id
+                current.target_ids.append(target_id)
+                continue
+            windows.append(current)
+        start = max(0, target_id - n_context)
+        current = PackedWindow(start=start, end=target_id, target_ids=[target_id])
+    if current is not None:
+        windows.append(current)
+    return windows
+
+
+def render_packed_window(
+    simple_convo: list[dict],
+    window: PackedWindow,
+    compressor: Callable[[str, str], str] | None = None,
+) -> str:
+    """
+    Render the messages of a window, numbered, with the target messages marked.
+    """
+    elems = []
+    if window.start == 0:
+        elems.append("(This is the start of the conversation.)")
+    target_ids = set(window.target_ids)
+    for idx in range(window.start, window.end + 1):
+        elems.append(render_message(
+            simple_convo[idx],
+            idx,
+            is_target=idx in target_ids,
+            compressor=compressor,
+        ))
+    return "\n".join(elems)
+
+
+def is_question_classifier(classifier_definition: dict) -> bool:
+    return classifier_definition["name"].startswith("IS_") and "QUESTION" in classifier_definition["name"]
+
+
+def get_packed_notes(classifier_definition: dict) -> str:
+    """
+    The notes of a packed prompt, by classifier set: the question set shares the v1_top_level
+    version with the emotional classifiers, but not their notes. Definitions without a set (custom
+    definitions) fall back to their version, with the same question special case as unpacked prompts.
+    """
+    classifier_set = classifier_definition.get("classifier_set")
+    if classifier_set in prompt_templates.PACKED_NOTES_DICT:
+        return prompt_templates.PACKED_NOTES_DICT[classifier_set]
+    if classifier_definition["version"] == "v1_top_level" and is_question_classifier(classifier_definition):
+        return prompt_templates.PACKED_NOTES_DICT["question"]
+    return prompt_templates.PACKED_NOTES_DICT[classifier_definition["version"]]
+
+
+def get_packed_prompt(
+    classifier_definition: dict,
+    simple_convo: list[dict],
+    window: PackedWindow,
+    labels: list[str],
+) -> str:
+    """
+    Construct a packed classification prompt for a window.
+    """
+    criteria = ""
+    if "criteria" in classifier_definition:
+        criteria = "\nThe following are the criteria for your classification:\n" + "\n".join(
+            f"- {line}" for line in classifier_definition["criteria"]
+        ) + "\n"
+    return prompt_templates.PACKED_PROMPT_TEMPLATE.format(
+        classifier_name=classifier_definition.get("full_name") or classifier_definition["name"],
+        prompt=classifier_definition["prompt"],
+        prompt_short=classifier_definition["prompt"].splitlines()[0],
+        criteria=criteria,
+        notes=get_packed_notes(classifier_definition),
+        conversation_string=render_packed_window(
+            simple_convo,
+            window,
+            compressor=get_compressor(classifier_definition),
+        ),
+        labels=", ".join(labels),
+        target_indices=", ".join(str(idx) for idx in window.target_ids),
+    )
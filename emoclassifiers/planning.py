@@ -0,0 +1,282 @@
+"""
+Dry-run planning: predict the API calls, tokens, cost and duration of a run without any network calls.
+
+Conversations are chunked and prompts rendered locally exactly as in a real run, and tokens are
+counted with the local estimator (`estimate_num_tokens`). Classifiers that run unconditionally get
+exact call counts, including localized ones (`localize`). Sub-classifiers gated on top-level
+results (the V1 dependency graph) get a lower bound (no top-level classifier fires) and an upper
+bound (all of them fire). With a gating neighborhood, sub-classifiers only classify the chunks near
+the messages behind a "yes", which the plan cannot know: the upper bound assumes all of them.
+"""
+
+import json
+from collections import defaultdict
+
+import pydantic
+
+import emoclassifiers.packing as packing
+import emoclassifiers.prompt_templates as prompt_templates
+from emoclassifiers.chunking import estimate_num_tokens, get_chunker
+from emoclassifiers.compression import COMPRESSION_STATS
+from emoclassifiers.classification import (
+    LABEL_TOKEN_DECODING,
+    STRUCTURED_DECODING,
+    get_emo_classifiers_prompt,
+    get_label_enum,
+    get_localized_prompt,
+    get_localized_response_format_for_label_enum,
+    get_packed_response_format_for_label_enum,
+    get_response_format,
+)
+from emoclassifiers.prescreen import prescreen_chunk
+from emoclassifiers.pricing import estimate_cost
+
+# Estimated completion tokens per call, e.g. '{"response":"unsure"}'.
+STRUCTURED_COMPLETION_TOKENS = 8
+PACKED_COMPLETION_TOKENS_PER_TARGET = 12
+# e.g. '{"response":"yes","message_indices":[3,7]}'.
+LOCALIZED_COMPLETION_TOKENS = 16
+# Estimated per-request overhead of the chat format (role markers etc.).
+MESSAGE_OVERHEAD_TOKENS = 7
+
+
+class CallEstimate(pydantic.BaseModel):
+    """
+    Estimated calls and tokens, summed over conversations.
+    """
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    prescreened_chunks: int = 0
+
+    def add(self, other: "CallEstimate"):
+        self.calls += other.calls
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.prescreened_chunks += other.prescreened_chunks
+
+
+def get_schema_tokens(response_format: type[pydantic.BaseModel]) -> int:
+    """
+    Estimate the tokens taken by the JSON schema of a structured response format.
+    """
+    return estimate_num_tokens(json.dumps(response_format.model_json_schema()))
+
+
+def estimate_classifier_calls(
+    classifier_definition: dict,
+    conversation: list[dict],
+    decoding_mode: str = STRUCTURED_DECODING,
+    packed_token_budget: int | None = None,
+    prescreen: bool = False,
+    localize: bool = False,
+) -> CallEstimate:
+    """
+    Estimate the calls and tokens of one classifier on one conversation, following
+    `EmoClassifier.classify_conversation_detailed`. Packed requests are assumed to return
+    all targets, and pre-screened chunks (if `prescreen` is set) make no call.
+    """
+    decoding_mode = classifier_definition.get("decoding", decoding_mode)
+    estimate = CallEstimate()
+    chunker = get_chunker(classifier_definition["chunker"], classifier_definition.get("chunker_kwargs"))
+    chunks = chunker.chunk_simple_convo(conversation)
+    if (
+        packed_token_budget is not None
+        and classifier_definition["chunker"] in packing.PACKABLE_CHUNKERS
+        and len(chunks) > 1
+    ):
+        label_enum = get_label_enum(classifier_definition)
+        schema_tokens = get_schema_tokens(get_packed_response_format_for_label_enum(label_enum))
+        windows = packing.plan_packed_windows(
+            simple_convo=conversation,
+            chunks=chunks,
+            max_tokens=packed_token_budget,
+        )
+        for window in windows:
+            prompt = packing.get_packed_prompt(
+                classifier_definition=classifier_definition,
+                simple_convo=conversation,
+                window=window,
+                labels=[label.value for label in label_enum],
+            )
+            estimate.calls += 1
+            estimate.prompt_tokens += estimate_num_tokens(prompt) + schema_tokens + MESSAGE_OVERHEAD_TOKENS
+            estimate.completion_tokens += PACKED_COMPLETION_TOKENS_PER_TARGET * len(window.target_ids)
+        return estimate
+
+    if localize and chunker.KEYED_BY_START_INDEX:
+        label_enum = get_label_enum(classifier_definition)
+        schema_tokens = get_schema_tokens(get_localized_response_format_for_label_enum(label_enum))
+        for chunk_id, chunk in chunks.items():
+            prompt = get_localized_prompt(classifier_definition=classifier_definition, chunk=chunk, start=chunk_id)
+            estimate.calls += 1
+            estimate.prompt_tokens += estimate_num_tokens(prompt) + schema_tokens + MESSAGE_OVERHEAD_TOKENS
+            estimate.completion_tokens += LOCALIZED_COMPLETION_TOKENS
+        return estimate
+
+    if decoding_mode == LABEL_TOKEN_DECODING:
+        label_enum = get_label_enum(classifier_definition)
+        extra_prompt_tokens = estimate_num_tokens(prompt_templates.LABEL_TOKEN_INSTRUCTION.format(
+            labels=", ".join(label.value for label in label_enum),
+        ))
+        completion_tokens = 1
+    elif decoding_mode == STRUCTURED_DECODING:
+        extra_prompt_tokens = get_schema_tokens(get_response_format(classifier_definition))
+        completion_tokens = STRUCTURED_COMPLETION_TOKENS
+    else:
+        raise ValueError(f"Unknown decoding mode: {decoding_mode}")
+    for chunk in chunks.values():
+        if prescreen and prescreen_chunk(classifier_definition, chunk)[0] is not None:
+            estimate.prescreened_chunks += 1
+            continue
+        prompt = get_emo_classifiers_prompt(classifier_definition=classifier_definition, chunk=chunk)
+        estimate.calls += 1
+        estimate.prompt_tokens += estimate_num_tokens(prompt) + extra_prompt_tokens + MESSAGE_OVERHEAD_TOKENS
+        estimate.completion_tokens += completion_tokens
+    return estimate
+
+
+class RunPlan:
+    """
+    Per-classifier lower and upper bounds of the calls and tokens of a run.
+    Bounds are equal for classifiers that are not gated. With a `gating_neighborhood`, the upper
+    bound of gated classifiers assumes every chunk is near a message behind a "yes".
+    """
+    def __init__(self, model: str, num_conversations: int, gating_neighborhood: int | None = None):
+        self.model = model
+        self.num_conversations = num_conversations
+        self.gating_neighborhood = gating_neighborhood
+        self.lower = defaultdict(CallEstimate)
+        self.upper = defaultdict(CallEstimate)
+        self.gated = set()
+
+    def total(self, bound: str) -> CallEstimate:
+        total = CallEstimate()
+        for estimate in getattr(self, bound).values():
+            total.add(estimate)
+        return total
+
+    def forecast_seconds(
+        self,
+        estimate: CallEstimate,
+        max_concurrent: int,
+        latency: float,
+        rpm: int | None = None,
+        tpm: int | None = None,
+    ) -> tuple[float, str]:
+        """
+        Forecast the duration of a run as the slowest of: concurrency-limited throughput
+        (`max_concurrent` requests of `latency` seconds each), requests per minute, and tokens per minute.
+        Returns (seconds, limiting factor).
+        """
+        candidates = [(estimate.calls * latency / max_concurrent, "concurrency")]
+        if rpm:
+            candidates.append((estimate.calls / rpm * 60, "requests per minute"))
+        if tpm:
+            candidates.append(((estimate.prompt_tokens + estimate.completion_tokens) / tpm * 60, "tokens per minute"))
+        return max(candidates)
+
+    def report(
+        self,
+        max_concurrent: int,
+        latency: float = 1.0,
+        rpm: int | None = None,
+        tpm: int | None = None,
+    ) -> dict:
+        report = {
+            "model": self.model,
+            "num_conversations": self.num_conversations,
+            "gating_neighborhood": self.gating_neighborhood,
+            "by_classifier": {
+                name: {
+                    "gated": name in self.gated,
+                    "lower": self.lower[name].model_dump(),
+                    "upper": self.upper[name].model_dump(),
+                }
+                for name in self.upper
+            },
+        }
+        for bound in ("lower", "upper"):
+            total = self.total(bound)
+            seconds, limited_by = self.forecast_seconds(
+                total,
+                max_concurrent=max_concurrent,
+                latency=latency,
+                rpm=rpm,
+                tpm=tpm,
+            )
+            report[bound] = {
+                **total.model_dump(),
+                "cost": estimate_cost(self.model, total.prompt_tokens, total.completion_tokens),
+                "seconds": seconds,
+                "limited_by": limited_by,
+            }
+        return report
+
+    def print_report(self, **kwargs):
+        report = self.report(**kwargs)
+        print(f"\nDry run: {report['num_conversations']} conversations, model {report['model']}")
+        print(f"{'classifier':<40} {'calls':>17} {'prompt tokens':>23} {'prescreened':>12}")
+        for name, row in report["by_classifier"].items():
+            lower, upper = row["lower"], row["upper"]
+            if row["gated"]:
+                calls = f"{lower['calls']}-{upper['calls']}"
+                prompt_tokens = f"{lower['prompt_tokens']}-{upper['prompt_tokens']}"
+            else:
+                calls, prompt_tokens = str(upper["calls"]), str(upper["prompt_tokens"])
+            print(f"{name[:40]:<40} {calls:>17} {prompt_tokens:>23} {upper['prescreened_chunks']:>12}")
+        for bound in ("lower", "upper"):
+            total = report[bound]
+            cost = "unknown (no pricing for model)" if total["cost"] is None else f"${total['cost']:.2f}"
+            print(
+                f"{bound.capitalize()} bound: {total['calls']} calls, {total['prompt_tokens']} prompt tokens,"
+                f" {total['completion_tokens']} completion tokens, cost {cost},"
+                f" ~{total['seconds'] / 60:.1f} min (limited by {total['limited_by']})"
+            )
+        if report["gating_neighborhood"] is not None and self.gated:
+            print(
+                f"Gated classifiers only classify chunks within {report['gating_neighborhood']} messages of a"
+                " message behind a \"yes\": the upper bound assumes every chunk is."
+            )
+
+
+def plan_run(
+    conversation_list: list[dict],
+    classifier_definitions: dict[str, dict],
+    model: str,
+    gated_definitions: dict[str, dict] | None = None,
+    dependency_graph: dict[str, list[str]] | None = None,
+    decoding_mode: str = STRUCTURED_DECODING,
+    packed_token_budget: int | None = None,
+    prescreen: bool = False,
+    localize: bool = False,
+    gating_neighborhood: int | None = None,
+) -> RunPlan:
+    """
+    Plan a run of `classifier_definitions` (always run, localized if `localize` is set) and,
+    optionally, `gated_definitions`, each of which runs only if one of the classifiers it depends
+    on in `dependency_graph` fires (near the messages behind it, with a `gating_neighborhood`).
+    """
+    plan = RunPlan(model=model, num_conversations=len(conversation_list), gating_neighborhood=gating_neighborhood)
+    kwargs = dict(
+        decoding_mode=decoding_mode,
+        packed_token_budget=packed_token_budget,
+        prescreen=prescreen,
+    )
+    gated_definitions = gated_definitions or {}
+    plan.gated.update(gated_definitions)
+    for name in [*classifier_definitions, *gated_definitions]:
+        plan.lower[name] = CallEstimate()
+        plan.upper[name] = CallEstimate()
+    # Prompts are rendered as in a real run, but nothing is sent: no compression savings.
+    with COMPRESSION_STATS.suspended():
+        for conversation in conversation_list:
+            for name, definition in classifier_definitions.items():
+                estimate = estimate_classifier_calls(definition, conversation, localize=localize, **kwargs)
+                plan.lower[name].add(estimate)
+                plan.upper[name].add(estimate)
+            for name, definition in gated_definitions.items():
+                # A classifier without dependencies is never run (see the hierarchical runners).
+                if dependency_graph[name]:
+                    plan.upper[name].add(estimate_classifier_calls(definition, conversation, **kwargs))
+    return plan
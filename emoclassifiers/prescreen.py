@@ -0,0 +1,275 @@
+"""
+Local pre-screening of conversation chunks.
+
+Some chunks can be decided without calling the model at all (e.g. an empty message
+can never contain a question). Rule sets are defined per classifier under the
+"prescreen" key of the classifier definition, e.g.
+
+    "prescreen": {
+        "label": "no_question",
+        "rules": [
+            {"type": "max_length", "max_chars": 1},
+            {"type": "regex", "pattern": "^\\W*(hi|hello)\\W*$"},
+            {"type": "no_interrogative", "max_chars": 40}
+        ]
+    }
+
+If any rule matches the last (target) message of a chunk, the chunk is assigned
+`label` locally. Classifiers without a "prescreen" key always go to the model.
+"""
+
+import random
+import re
+from collections import defaultdict
+
+from emoclassifiers.chunking import Chunk
+from emoclassifiers.classification import (
+    ChunkClassification,
+    ModelWrapper,
+    YesNoUnsureEnum,
+    QuestionTypeEnum,
+    IntentTypeEnum,
+    get_classifier_name,
+    parse_label,
+)
+
+QUESTION_MARKS = ("?", "？", "¿", "؟")
+INTERROGATIVE_OPENERS = {
+    "what", "whats", "what's", "why", "how", "hows", "how's", "who", "whom", "whose", "where",
+    "when", "which", "is", "are", "am", "was", "were", "do", "does", "did", "can", "could",
+    "would", "will", "shall", "should", "may", "might", "must", "have", "has", "had",
+    "isn't", "aren't", "don't", "doesn't", "didn't", "can't", "couldn't", "won't", "wouldn't",
+    "shouldn't", "any", "anyone",
+}
+INDIRECT_QUESTION_MARKERS = (
+    "wonder", "whether", "tell me", "explain", "curious", "any idea", "let me know",
+    "is there", "are there", "do you know", "help me",
+)
+SENTENCE_SPLIT_PATTERN = re.compile(r"[.!;:\n]+")
+
+
+def get_target_content(chunk: Chunk) -> str:
+    """
+    Get the stripped content of the message being classified (the last message of the chunk).
+    """
+    return chunk.chunk[-1]["content"].strip()
+
+
+def is_mostly_latin(string: str, threshold: float = 0.9) -> bool:
+    """
+    Check whether the letters in a string are mostly ASCII. Interrogative detection
+    is only reliable for (roughly) English text.
+    """
+    letters = [c for c in string if c.isalpha()]
+    if not letters:
+        return True
+    return sum(c.isascii() for c in letters) / len(letters) >= threshold
+
+
+def is_interrogative(string: str) -> bool:
+    """
+    Heuristic check for question syntax. Errs on the side of returning True:
+    non-Latin text is always treated as potentially interrogative.
+    """
+    if any(mark in string for mark in QUESTION_MARKS):
+        return True
+    if not is_mostly_latin(string):
+        return True
+    lowered = string.lower()
+    if any(marker in lowered for marker in INDIRECT_QUESTION_MARKERS):
+        return True
+    for sentence in SENTENCE_SPLIT_PATTERN.split(lowered):
+        words = sentence.split()
+        if words and words[0].strip("\"'([,") in INTERROGATIVE_OPENERS:
+            return True
+    return False
+
+
+class PreScreenRule:
+    """
+    Base class for pre-screen rules.
+    """
+    @classmethod
+    def matches(cls, content: str, rule_config: dict) -> bool:
+        """
+        Return True if the message can be decided locally.
+        """
+        raise NotImplementedError()
+
+
+class MaxLengthRule(PreScreenRule):
+    """
+    Matches messages no longer than `max_chars` characters.
+    """
+    @classmethod
+    def matches(cls, content: str, rule_config: dict) -> bool:
+        return len(content) <= rule_config["max_chars"]
+
+
+class RegexRule(PreScreenRule):
+    """
+    Matches messages matching `pattern` (case-insensitive).
+    """
+    @classmethod
+    def matches(cls, content: str, rule_config: dict) -> bool:
+        return re.search(rule_config["pattern"], content, flags=re.IGNORECASE) is not None
+
+
+class NoInterrogativeRule(PreScreenRule):
+    """
+    Matches messages of at most `max_chars` characters with no question syntax.
+    """
+    @classmethod
+    def matches(cls, content: str, rule_config: dict) -> bool:
+        max_chars = rule_config.get("max_chars")
+        if max_chars is not None and len(content) > max_chars:
+            return False
+        return not is_interrogative(content)
+
+
+RULE_DICT = {
+    "max_length": MaxLengthRule,
+    "regex": RegexRule,
+    "no_interrogative": NoInterrogativeRule,
+}
+
+
+def prescreen_chunk(classifier_definition: dict, chunk: Chunk) -> tuple[str | None, str | None]:
+    """
+    Apply the pre-screen rules of a classifier to a chunk.
+    Returns (label, rule_type) if decided locally, otherwise (None, None).
+    """
+    prescreen_config = classifier_definition.get("prescreen")
+    if not prescreen_config:
+        return None, None
+    content = get_target_content(chunk)
+    for rule_config in prescreen_config["rules"]:
+        if RULE_DICT[rule_config["type"]].matches(content, rule_config):
+            return prescreen_config["label"], rule_config["type"]
+    return None, None
+
+
+class PreScreenStats:
+    """
+    Skip and audit statistics for the pre-screen stage, per classifier.
+    """
+    def __init__(self, max_examples: int = 20):
+        self.max_examples = max_examples
+        self.total = defaultdict(int)
+        self.skipped = defaultdict(int)
+        self.skipped_by_rule = defaultdict(lambda: defaultdict(int))
+        self.audited = defaultdict(int)
+        self.agreed = defaultdict(int)
+        self.disagreements = defaultdict(list)
+
+    def report(self) -> dict:
+        """
+        Summarize skip rates and audit agreement per classifier.
+        """
+        report = {}
+        for name, total in self.total.items():
+            audited = self.audited[name]
+            report[name] = {
+                "total": total,
+                "skipped": self.skipped[name],
+                "skip_rate": self.skipped[name] / total if total else 0.0,
+                "skipped_by_rule": dict(self.skipped_by_rule[name]),
+                "audited": audited,
+                "audit_agreement": self.agreed[name] / audited if audited else None,
+                "disagreements": self.disagreements[name],
+            }
+        return report
+
+    def print_report(self):
+        print("\nPre-screen statistics:")
+        for name, stats in self.report().items():
+            agreement = stats["audit_agreement"]
+            agreement_str = "n/a" if agreement is None else f"{agreement:.1%}"
+            print(
+                f"- {name}: skipped {stats['skipped']}/{stats['total']} ({stats['skip_rate']:.1%}),"
+                f" audit agreement {agreement_str} over {stats['audited']} samples"
+            )
+
+
+class PreScreenModelWrapper:
+    # Packed and localized requests would bypass the pre-screen (see `EmoClassifier`).
+    PER_CHUNK_ONLY = True
+
+    def __init__(
+        self,
+        model_wrapper: ModelWrapper,
+        audit_rate: float = 0.0,
+        seed: int = 0,
+        enabled: bool = True,
+    ):
+        """
+        A pre-screen stage in front of a ModelWrapper. Chunks that match a local rule
+        are answered without an API call. A random `audit_rate` fraction of the skipped
+        chunks is still sent to the model to measure agreement with the local decision.
+        """
+        self.model_wrapper = model_wrapper
+        self.audit_rate = audit_rate
+        self.enabled = enabled
+        self.rng = random.Random(seed)
+        self.stats = PreScreenStats()
+
+    def __getattr__(self, name):
+        # Expose the wrapped ModelWrapper's attributes (model, scheduler, ...).
+        return getattr(self.model_wrapper, name)
+
+    async def classify_conversation_chunk(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        max_completion_tokens: int = 20,
+    ) -> YesNoUnsureEnum | QuestionTypeEnum | IntentTypeEnum:
+        """
+        Classify a single conversation chunk, locally if the pre-screen rules allow it.
+        """
+        result = await self.classify_conversation_chunk_detailed(
+            classifier_definition=classifier_definition,
+            chunk=chunk,
+            max_completion_tokens=max_completion_tokens,
+        )
+        return result.label
+
+    async def classify_conversation_chunk_detailed(
+        self,
+        classifier_definition: dict,
+        chunk: Chunk,
+        max_completion_tokens: int = 20,
+    ) -> ChunkClassification:
+        """
+        Classify a single conversation chunk, locally if the pre-screen rules allow it.
+        """
+        name = get_classifier_name(classifier_definition)
+        self.stats.total[name] += 1
+        label, rule_type = (None, None)
+        if self.enabled:
+            label, rule_type = prescreen_chunk(classifier_definition, chunk)
+        if label is None:
+            return await self.model_wrapper.classify_conversation_chunk_detailed(
+                classifier_definition=classifier_definition,
+                chunk=chunk,
+                max_completion_tokens=max_completion_tokens,
+            )
+        local_result = ChunkClassification(label=parse_label(label), probability=1.0, model="prescreen")
+        self.stats.skipped[name] += 1
+        self.stats.skipped_by_rule[name][rule_type] += 1
+        if self.audit_rate > 0 and self.rng.random() < self.audit_rate:
+            model_result = await self.model_wrapper.classify_conversation_chunk_detailed(
+                classifier_definition=classifier_definition,
+                chunk=chunk,
+                max_completion_tokens=max_completion_tokens,
+            )
+            self.stats.audited[name] += 1
+            if model_result.label == local_result.label:
+                self.stats.agreed[name] += 1
+            elif len(self.stats.disagreements[name]) < self.stats.max_examples:
+                self.stats.disagreements[name].append({
+                    "rule": rule_type,
+                    "content": get_target_content(chunk)[:200],
+                    "local": local_result.label.value,
+                    "model": model_result.label.value,
+                })
+        return local_result
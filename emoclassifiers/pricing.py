@@ -0,0 +1,55 @@
+"""
+Model prices, used to forecast and account for the cost of a run.
+Prices are in USD per 1M tokens and may be out of date; update `MODEL_PRICING_DICT` as needed.
+"""
+
+import pydantic
+
+
+class ModelPricing(pydantic.BaseModel):
+    """
+    Price per 1M input, cached input and output tokens.
+    """
+    input: float
+    cached_input: float
+    output: float
+
+
+MODEL_PRICING_DICT = {
+    "gpt-4o-mini": ModelPricing(input=0.15, cached_input=0.075, output=0.60),
+    "gpt-4o": ModelPricing(input=2.50, cached_input=1.25, output=10.00),
+    "gpt-4.1-nano": ModelPricing(input=0.10, cached_input=0.025, output=0.40),
+    "gpt-4.1-mini": ModelPricing(input=0.40, cached_input=0.10, output=1.60),
+    "gpt-4.1": ModelPricing(input=2.00, cached_input=0.50, output=8.00),
+}
+
+
+def get_model_pricing(model: str) -> ModelPricing | None:
+    """
+    Get the pricing of a model, matching dated snapshots (e.g. "gpt-4o-mini-2024-07-18")
+    to the longest known model name they start with.
+    """
+    matches = [name for name in MODEL_PRICING_DICT if model == name or model.startswith(name + "-")]
+    if not matches:
+        return None
+    return MODEL_PRICING_DICT[max(matches, key=len)]
+
+
+def estimate_cost(
+    model: str,
+    prompt_tokens: int,
+    completion_tokens: int,
+    cached_tokens: int = 0,
+) -> float | None:
+    """
+    Estimate the cost in USD of a number of tokens. `cached_tokens` is the part of
+    `prompt_tokens` served from the prompt cache. Returns None for unknown models.
+    """
+    pricing = get_model_pricing(model)
+    if pricing is None:
+        return None
+    return (
+        (prompt_tokens - cached_tokens) * pricing.input
+        + cached_tokens * pricing.cached_input
+        + completion_tokens * pricing.output
+    ) / 1e6
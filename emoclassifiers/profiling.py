@@ -0,0 +1,183 @@
+"""
+Event-loop lag monitoring and stage-restricted CPU profiling.
+
+All prompt rendering, JSON and pydantic work runs inline on the event loop, so CPU-heavy stages
+delay every in-flight request. `LoopLagMonitor` measures how late the loop wakes up (exported as
+a metric) and, from a watchdog thread, captures the stack of the loop thread when it stalls.
+`StageProfiler` runs cProfile only within chosen synchronous stages (see `STAGES`).
+"""
+
+import asyncio
+import cProfile
+import contextlib
+import io
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.metrics as metrics
+
+# Synchronous stages that can be profiled.
+STAGES = ("chunking", "render_prompt", "parse")
+
+LOOP_LAG = metrics.METRICS.histogram(
+    "emoclassifiers_event_loop_lag_seconds",
+    "Delay of event loop wake-ups beyond their scheduled time.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.1, stall_threshold: float = 0.25, max_stalls: int = 100):
+        """
+        Measure event loop lag every `interval` seconds. A watchdog thread records the stack of
+        the loop thread whenever the loop has not run for more than `stall_threshold` seconds
+        (at most `max_stalls` stalls are kept).
+        """
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.max_stalls = max_stalls
+        self.stalls = []
+        self.max_lag = 0.0
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.task = None
+        self.stop_event = threading.Event()
+        self.watchdog = None
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            lag = max(0.0, self.heartbeat - start - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+
+    def run_watchdog(self):
+        stall_start = None
+        while not self.stop_event.wait(self.stall_threshold / 2):
+            blocked_for = time.monotonic() - self.heartbeat - self.interval
+            if blocked_for <= self.stall_threshold:
+                stall_start = None
+                continue
+            if stall_start == self.heartbeat:
+                # Already recorded this stall.
+                continue
+            stall_start = self.heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None or len(self.stalls) >= self.max_stalls:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            self.stalls.append({"time": time.time(), "blocked_for": blocked_for, "stack": stack})
+            print(f"Event loop stalled for {blocked_for:.2f}s at:\n{stack}", file=sys.stderr)
+
+    def start(self) -> "LoopLagMonitor":
+        """
+        Start monitoring. Must be called from within the running event loop.
+        """
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        self.watchdog = threading.Thread(target=self.run_watchdog, daemon=True)
+        self.watchdog.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+        if self.watchdog is not None:
+            self.watchdog.join()
+
+    def report(self) -> dict:
+        return {
+            "interval": self.interval,
+            "stall_threshold": self.stall_threshold,
+            "max_lag": self.max_lag,
+            "lag": LOOP_LAG.snapshot(),
+            "stalls": self.stalls,
+        }
+
+    def save(self, path: str):
+        io_utils.save_json(self.report(), path)
+
+
+async def run_monitored(coroutine, monitor: LoopLagMonitor | None = None):
+    """
+    Await a coroutine, monitoring the event loop lag while it runs (if `monitor` is given).
+    """
+    if monitor is None:
+        return await coroutine
+    monitor.start()
+    try:
+        return await coroutine
+    finally:
+        monitor.stop()
+
+
+class StageProfiler:
+    def __init__(self, stages: list[str]):
+        """
+        A cProfile profiler that is only active within the given stages.
+        """
+        unknown_stages = set(stages) - set(STAGES)
+        assert not unknown_stages, f"Unknown stages: {unknown_stages}"
+        self.stages = set(stages)
+        self.profiler = cProfile.Profile()
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if name not in self.stages:
+            yield
+            return
+        if self.depth == 0:
+            self.profiler.enable()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profiler.disable()
+
+    def save(self, path_prefix: str, num_lines: int = 50):
+        """
+        Write `<path_prefix>.prof` (for pstats/snakeviz) and a text summary `<path_prefix>.txt`.
+        """
+        self.profiler.dump_stats(path_prefix + ".prof")
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(num_lines)
+        with open(path_prefix + ".txt", "w") as f:
+            f.write(f"Profiled stages: {', '.join(sorted(self.stages))}\n")
+            f.write(stream.getvalue())
+
+
+PROFILER = None
+
+
+def enable_profiler(stages: list[str]) -> StageProfiler:
+    """
+    Enable the global stage profiler.
+    """
+    global PROFILER
+    PROFILER = StageProfiler(stages)
+    return PROFILER
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Mark a synchronous stage, profiled if the global profiler is enabled for it.
+    Must not contain an await, since other tasks would be profiled too.
+    """
+    if PROFILER is None:
+        yield
+        return
+    with PROFILER.stage(name):
+        yield
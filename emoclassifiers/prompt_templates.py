@@ -162,3 +162,57 @@ Now, the following is the conversation snippet you will be analyzing:
 
 Once again, the classification task is: {prompt}
 Output your classification (yes, no, unsure)."""
+
+LABEL_TOKEN_INSTRUCTION = """
+
+Respond with only the label, exactly one of: {labels}."""
+
+LOCALIZATION_INSTRUCTION = """
+Each message is prefixed with its index in brackets. If your classification is "yes", also list in "message_indices" the indices of the messages that led to it (only the most relevant ones). Otherwise, leave "message_indices" empty."""
+
+PACKED_PROMPT_TEMPLATE = """You are a model for analyzing chatbot conversations.
+You will be presented with a conversation between a user and a chatbot ("assistant"). Each message is prefixed with its index in brackets.
+Your classification task is entitled '{classifier_name}'. Specifically, we want to know: {prompt}
+{criteria}
+Also, generally:
+{notes}
+
+Several target messages are marked with the [*USER*] or [*ASSISTANT*] tag. Classify each target message separately: each classification should only apply to that target message.
+The other messages (and the messages following a target) are only included to provide context.
+
+Now, the following is the conversation you will be analyzing:
+
+<conversation>
+{conversation_string}
+</conversation>
+
+Once again, the classification task is: {prompt_short}
+Output one classification ({labels}) for each of the target message indices: {target_indices}."""
+
+PACKED_EMOTIONAL_NOTES = """- If the user is asking for help with writing a fictional story, the story itself should not be considered in your classification.
+- Likewise, if the user is asking for help with generating an image, that prompt should not be considered either.
+- It is possible that a message has no emotional content. In this case, you should classify it as "no".
+- If a message is extremely short, you may classify it as "no" if you believe there is not enough information to make a classification."""
+
+PACKED_QUESTION_NOTES = """- Only consider the questions asked in the target message, if any.
+- If the target message contains no question, classify it as "no"."""
+
+PACKED_QUESTION_TREE_NOTES = """- If the message contain no structured of question at all, classify as "no_question"
+- If user question(s) explicitly seeks verification or factual accuracy, classify as "fact_checking"
+- If question(s) primarily imply assertion or test alignment, rather than asking for new information, classify as "rhetorical"
+- Otherwise, open-ended questions invite extended discussion, deeper thought or opinionated, classify as "exploratory\""""
+
+PACKED_INTENT_NOTES = """- Focus only on the user's message.
+- If the message matches the criteria, classify as "yes"
+- If the message does not match the criteria, classify as "no"
+- If you are unsure, classify as "unsure\""""
+
+# By classifier set (or version, for custom definitions).
+PACKED_NOTES_DICT = {
+    "v1": PACKED_EMOTIONAL_NOTES,
+    "v1_top_level": PACKED_EMOTIONAL_NOTES,
+    "v2": PACKED_EMOTIONAL_NOTES,
+    "question": PACKED_QUESTION_NOTES,
+    "question_tree": PACKED_QUESTION_TREE_NOTES,
+    "intent": PACKED_INTENT_NOTES,
+}
@@ -0,0 +1,174 @@
+"""
+Requests-per-minute and tokens-per-minute limits shared by the processes on one machine
+(`rate_limiter` of `ModelWrapper`, `--rpm`/`--tpm` of run_efficient_question_classification.py).
+
+`SharedTokenBucket` keeps a request bucket and a token bucket in a small state file, updated under
+an exclusive `fcntl.flock`. Workers classifying different shards of the input with the same state
+file (and the same limits) therefore stay within one budget together, however many there are.
+The lock is only held to refill and take from the buckets; a worker whose request does not fit
+sleeps until the buckets would have refilled enough, then tries again.
+
+A request takes its prompt's estimated tokens plus `max_completion_tokens` from the token bucket,
+which is how the API counts requests against the TPM limit. Retries count as requests too, so
+with a rate limiter `ModelWrapper` retries failed requests itself (`send_with_retries`) instead of
+the openai client, taking from the buckets again before each retry.
+
+The state file is locked with `fcntl`, so the rate limiter is only available on Unix. Locking and
+reading the file run in a worker thread, to not block the event loop while another process holds
+the lock.
+"""
+
+import asyncio
+import os
+import random
+import struct
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+import openai
+
+import emoclassifiers.metrics as metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_STATE_PATH = os.path.join(tempfile.gettempdir(), "emoclassifiers_rate_limit.bin")
+
+# Available requests, available tokens, and the (wall clock) time they were last refilled at.
+STATE_FORMAT = "ddd"
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+
+# Errors retried by `send_with_retries`, as the openai client would.
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+MAX_RETRY_DELAY = 8.0
+
+RATE_LIMIT_WAIT = metrics.METRICS.histogram(
+    "emoclassifiers_rate_limit_wait_seconds", "Time spent waiting for the shared rate limiter.",
+)
+RATE_LIMIT_RETRIES = metrics.METRICS.counter(
+    "emoclassifiers_rate_limit_retries_total", "Requests retried through the shared rate limiter, by error.",
+)
+
+
+def get_retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Seconds to wait before retrying after `error`: its Retry-After header if it has one, otherwise
+    an exponential backoff with jitter.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(MAX_RETRY_DELAY, float(response.headers.get("retry-after", "")))
+        except ValueError:
+            pass
+    return min(MAX_RETRY_DELAY, 0.5 * 2 ** attempt) * random.uniform(0.75, 1.0)
+
+
+class SharedTokenBucket:
+    def __init__(
+        self,
+        rpm: int | None = None,
+        tpm: int | None = None,
+        path: str = DEFAULT_STATE_PATH,
+        burst_seconds: float = 5.0,
+    ):
+        """
+        Token buckets refilled at `rpm` requests and `tpm` tokens per minute (None for no limit),
+        holding at most `burst_seconds` worth of each, shared through the state file at `path`.
+        """
+        if fcntl is None:
+            raise RuntimeError("The shared rate limiter locks its state file with fcntl, which is only available on Unix")
+        self.rpm = rpm
+        self.tpm = tpm
+        self.path = path
+        self.request_capacity = max(1.0, rpm * burst_seconds / 60) if rpm else 0.0
+        self.token_capacity = tpm * burst_seconds / 60 if tpm else 0.0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.num_waits = 0
+        self.total_wait = 0.0
+        self.num_retries = 0
+
+    def try_acquire(self, num_tokens: int) -> float:
+        """
+        Take one request and `num_tokens` tokens from the buckets if they are available, and
+        return 0. Otherwise take nothing and return the seconds until they should be.
+        """
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            state = os.pread(self.fd, STATE_SIZE, 0)
+            if len(state) < STATE_SIZE:
+                requests, tokens, refilled_at = self.request_capacity, self.token_capacity, now
+            else:
+                requests, tokens, refilled_at = struct.unpack(STATE_FORMAT, state)
+            elapsed = max(0.0, now - refilled_at)
+            wait = 0.0
+            if self.rpm:
+                requests = min(self.request_capacity, requests + elapsed * self.rpm / 60)
+                wait = max(wait, (1 - requests) * 60 / self.rpm)
+            if self.tpm:
+                tokens = min(self.token_capacity, tokens + elapsed * self.tpm / 60)
+                # A request larger than the bucket only waits for a full bucket.
+                wait = max(wait, (min(num_tokens, self.token_capacity) - tokens) * 60 / self.tpm)
+            if wait <= 0:
+                requests -= 1 if self.rpm else 0
+                tokens -= num_tokens if self.tpm else 0
+                wait = 0.0
+            os.pwrite(self.fd, struct.pack(STATE_FORMAT, requests, tokens, now), 0)
+            return wait
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    async def acquire(self, num_tokens: int):
+        """
+        Wait until a request of `num_tokens` tokens fits within the limits.
+        """
+        if not self.rpm and not self.tpm:
+            return
+        start_time = time.perf_counter()
+        waited = False
+        while (wait := await asyncio.to_thread(self.try_acquire, num_tokens)) > 0:
+            waited = True
+            await asyncio.sleep(wait)
+        if waited:
+            wait_time = time.perf_counter() - start_time
+            self.num_waits += 1
+            self.total_wait += wait_time
+            RATE_LIMIT_WAIT.observe(wait_time)
+
+    async def send_with_retries(
+        self,
+        send_request: Callable[[openai.AsyncOpenAI], Awaitable],
+        openai_client: openai.AsyncOpenAI,
+        num_tokens: int,
+    ):
+        """
+        Send a request with `send_request(client)`, where the client does not retry, retrying up to
+        the `max_retries` of `openai_client` times. The first attempt must already have been acquired;
+        every retry waits for the backoff and then acquires again.
+        """
+        max_retries = openai_client.max_retries
+        openai_client = openai_client.with_options(max_retries=0)
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                await self.acquire(num_tokens)
+            try:
+                return await send_request(openai_client)
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                self.num_retries += 1
+                RATE_LIMIT_RETRIES.inc(error_type=type(e).__name__)
+                await asyncio.sleep(get_retry_delay(e, attempt))
+
+    def close(self):
+        os.close(self.fd)
+
+    def print_report(self):
+        print(
+            f"Rate limiter: waited {self.num_waits} times, {self.total_wait:.1f}s in total,"
+            f" {self.num_retries} retries"
+        )
@@ -0,0 +1,129 @@
+"""
+Opt-in recording of the request workload of a run (`--record_path` of the runners), for replay
+against the mock backend (`benchmarks/replay_workload.py`).
+
+Each request sent by `ModelWrapper` is recorded with a fingerprint of its prompt (not the
+prompt itself), its size, the conversation and classifier it belongs to, when it was
+dispatched (before waiting for the semaphore), how long it waited and took, and its outcome.
+Latency and outcome are those seen by the pipeline, so they include the client's retries.
+"""
+
+import hashlib
+import threading
+import time
+
+import openai
+import pydantic
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.tracing as tracing
+from emoclassifiers.chunking import estimate_num_tokens
+
+OK_OUTCOME = "ok"
+
+
+class RequestRecord(pydantic.BaseModel):
+    fingerprint: str
+    model: str
+    classifier_set: str
+    classifier: str
+    conversation: str | None
+    prompt_chars: int
+    estimated_prompt_tokens: int
+    max_completion_tokens: int
+    structured: bool
+    # Seconds since the recorder started.
+    dispatch_time: float
+    semaphore_wait: float
+    latency: float
+    # OK_OUTCOME or the type of the raised exception.
+    outcome: str
+    status_code: int | None = None
+    prompt_tokens: int | None = None
+    cached_tokens: int | None = None
+    completion_tokens: int | None = None
+
+
+def get_prompt_fingerprint(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()[:16]
+
+
+class WorkloadRecorder:
+    def __init__(self):
+        """
+        Collects a `RequestRecord` per request.
+        """
+        self.origin = time.perf_counter()
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        model: str,
+        classifier_definition: dict,
+        prompt: str,
+        max_completion_tokens: int,
+        structured: bool,
+        dispatch_time: float,
+        start_time: float,
+        end_time: float,
+        response=None,
+        error: Exception | None = None,
+    ):
+        """
+        Record a request from its time.perf_counter() timestamps: dispatch (before the semaphore),
+        start (after it) and end, with either its response or the error it raised.
+        """
+        record = RequestRecord(
+            fingerprint=get_prompt_fingerprint(prompt),
+            model=model,
+            classifier_set=scheduling.get_classifier_set(classifier_definition),
+            classifier=classifier_definition.get("name") or classifier_definition["full_name"],
+            conversation=tracing.CONVERSATION_NAME.get(),
+            prompt_chars=len(prompt),
+            estimated_prompt_tokens=estimate_num_tokens(prompt),
+            max_completion_tokens=max_completion_tokens,
+            structured=structured,
+            dispatch_time=dispatch_time - self.origin,
+            semaphore_wait=start_time - dispatch_time,
+            latency=end_time - start_time,
+            outcome=OK_OUTCOME if error is None else type(error).__name__,
+            status_code=error.status_code if isinstance(error, openai.APIStatusError) else None,
+        )
+        if response is not None and response.usage is not None:
+            details = response.usage.prompt_tokens_details
+            record.prompt_tokens = response.usage.prompt_tokens
+            record.cached_tokens = (details.cached_tokens or 0) if details else 0
+            record.completion_tokens = response.usage.completion_tokens
+        with self.lock:
+            self.records.append(record)
+
+    def save(self, path: str):
+        with self.lock:
+            records = sorted(self.records, key=lambda record: record.dispatch_time)
+        io_utils.save_jsonl([record.model_dump() for record in records], path)
+
+
+def load_records(path: str) -> list[RequestRecord]:
+    return [RequestRecord(**record) for record in io_utils.load_jsonl(path)]
+
+
+RECORDER = None
+
+
+def enable() -> WorkloadRecorder:
+    """
+    Enable recording with a new global recorder.
+    """
+    global RECORDER
+    RECORDER = WorkloadRecorder()
+    return RECORDER
+
+
+def record_request(**kwargs):
+    """
+    Record a request with the global recorder, if enabled (see `WorkloadRecorder.record`).
+    """
+    if RECORDER is not None:
+        RECORDER.record(**kwargs)
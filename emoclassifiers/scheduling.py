@@ -0,0 +1,186 @@
+"""
+Schedulers for the concurrency slots of `ModelWrapper`.
+
+`FIFOScheduler` is a plain semaphore. `FairScheduler` serves waiting requests by strict priority
+class first (gating calls, such as the top-level classifiers of the hierarchical runner, before
+everything else), then by weighted fair sharing across classifier sets, then by fair sharing
+across conversations within a set. A heavy classifier set or a long conversation therefore
+cannot starve the others, and a conversation's requests are not queued behind all the requests
+of conversations that started earlier.
+
+Fair sharing is start-time fair queuing with unit cost per request: the group (or flow) with the
+least weighted service so far goes first, and a group that becomes backlogged starts from the
+least service among those already waiting, so idle groups cannot bank credit.
+
+The flow of a request is taken from the context set by `with_flow` (by the runners, once per
+conversation). Requests without one share a single flow.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+from collections import deque
+
+GATING_PRIORITY = 0
+DEFAULT_PRIORITY = 1
+
+FLOW = contextvars.ContextVar("emoclassifiers_flow", default=None)
+
+# Priority of classifier sets whose results gate other classifiers.
+CLASSIFIER_SET_PRIORITY_DICT = {
+    "v1_top_level": GATING_PRIORITY,
+}
+
+
+def get_classifier_set(classifier_definition: dict) -> str:
+    """
+    The classifier set of a definition. Sets can share a version (the question set uses
+    v1_top_level), so the version is only used for definitions not loaded from a predefined set.
+    """
+    return classifier_definition.get("classifier_set", classifier_definition["version"])
+
+
+async def with_flow(coroutine, flow: str):
+    """
+    Await a coroutine, scheduling its requests in the fair-sharing flow `flow` (e.g. its conversation).
+    """
+    token = FLOW.set(flow)
+    try:
+        return await coroutine
+    finally:
+        FLOW.reset(token)
+
+
+def get_priority(classifier_definition: dict) -> int:
+    """
+    Priority class of a classifier's requests (lower is served first): its "priority" key if
+    given, otherwise the one of its classifier set.
+    """
+    return classifier_definition.get(
+        "priority",
+        CLASSIFIER_SET_PRIORITY_DICT.get(get_classifier_set(classifier_definition), DEFAULT_PRIORITY),
+    )
+
+
+class FIFOScheduler:
+    def __init__(self, max_concurrent: int, group_weights: dict[str, float] | None = None):
+        """
+        First come, first served (`group_weights` is ignored).
+        """
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = DEFAULT_PRIORITY, group: str | None = None, flow: str | None = None):
+        async with self.semaphore:
+            yield
+
+
+class FlowQueue:
+    def __init__(self, service: float):
+        self.service = service
+        self.waiters = deque()
+
+
+class GroupQueue:
+    def __init__(self, service: float):
+        self.service = service
+        self.flows = {}
+
+
+class FairScheduler:
+    def __init__(self, max_concurrent: int, group_weights: dict[str, float] | None = None):
+        """
+        Strict priority classes, then weighted fair sharing across groups (weight 1 unless given
+        in `group_weights`), then fair sharing across flows within a group.
+        """
+        self.available = max_concurrent
+        self.group_weights = group_weights or {}
+        # Backlogged requests: priority -> group -> flow -> waiting futures.
+        self.queues = {}
+
+    @property
+    def num_waiting(self) -> int:
+        return sum(
+            len(flow.waiters)
+            for groups in self.queues.values()
+            for group in groups.values()
+            for flow in group.flows.values()
+        )
+
+    def enqueue(self, future: asyncio.Future, priority: int, group: str | None, flow: str | None):
+        groups = self.queues.setdefault(priority, {})
+        if group not in groups:
+            groups[group] = GroupQueue(service=min((g.service for g in groups.values()), default=0.0))
+        flows = groups[group].flows
+        if flow not in flows:
+            flows[flow] = FlowQueue(service=min((f.service for f in flows.values()), default=0.0))
+        flows[flow].waiters.append(future)
+
+    def remove_empty(self, priority: int, group: str | None, flow: str | None):
+        groups = self.queues[priority]
+        flows = groups[group].flows
+        if not flows[flow].waiters:
+            del flows[flow]
+            if not flows:
+                del groups[group]
+                if not groups:
+                    del self.queues[priority]
+
+    def discard(self, future: asyncio.Future, priority: int, group: str | None, flow: str | None):
+        """
+        Remove a cancelled waiter, unless `release` already skipped it.
+        """
+        group_queue = self.queues.get(priority, {}).get(group)
+        if group_queue is None or flow not in group_queue.flows or future not in group_queue.flows[flow].waiters:
+            return
+        group_queue.flows[flow].waiters.remove(future)
+        self.remove_empty(priority, group, flow)
+
+    def dequeue(self) -> asyncio.Future:
+        priority = min(self.queues)
+        groups = self.queues[priority]
+        group, group_queue = min(groups.items(), key=lambda item: item[1].service)
+        flow, flow_queue = min(group_queue.flows.items(), key=lambda item: item[1].service)
+        future = flow_queue.waiters.popleft()
+        group_queue.service += 1 / self.group_weights.get(group, 1.0)
+        flow_queue.service += 1
+        self.remove_empty(priority, group, flow)
+        return future
+
+    async def acquire(self, priority: int, group: str | None, flow: str | None):
+        if self.available > 0 and not self.queues:
+            self.available -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.enqueue(future, priority, group, flow)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the cancellation; pass it on.
+                self.release()
+            else:
+                self.discard(future, priority, group, flow)
+            raise
+
+    def release(self):
+        while self.queues:
+            future = self.dequeue()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.available += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = DEFAULT_PRIORITY, group: str | None = None, flow: str | None = None):
+        await self.acquire(priority, group, flow)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+SCHEDULER_DICT = {
+    "fifo": FIFOScheduler,
+    "fair": FairScheduler,
+}
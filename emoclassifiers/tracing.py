@@ -0,0 +1,198 @@
+"""
+Opt-in tracing of where time goes when classifying conversations, exported in the Chrome
+trace-event JSON format (open in chrome://tracing or https://ui.perfetto.dev).
+
+Each traced conversation is a process in the trace. Each classifier gets a lane (thread) in it,
+with chunking and the classification of the conversation, and each chunk gets a lane with prompt
+rendering, semaphore wait, the network request (including the client's response parsing)
+and label parsing.
+
+Tracing is off unless `enable` is called, and spans are only recorded within a sampled
+conversation (see `traced_conversation`). Sampling is deterministic in the conversation name,
+so all classifiers of a conversation are either traced or not.
+"""
+
+import contextlib
+import contextvars
+import itertools
+import json
+import time
+import zlib
+from typing import NamedTuple
+
+
+class TraceContext(NamedTuple):
+    pid: int
+    tid: int
+    lane_name: str
+
+
+# The lane of the current task, or None outside a sampled conversation.
+TRACE_CONTEXT = contextvars.ContextVar("emoclassifiers_trace_context", default=None)
+# The name of the current conversation (set whether or not it is sampled).
+CONVERSATION_NAME = contextvars.ContextVar("emoclassifiers_conversation_name", default=None)
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = 1.0, seed: int = 0, max_events: int = 1_000_000):
+        """
+        Collects trace events. A fraction `sample_rate` of conversations is traced, and at most
+        `max_events` events are kept (later ones are counted in `num_dropped_events`).
+        """
+        self.sample_rate = sample_rate
+        self.seed = seed
+        self.max_events = max_events
+        self.origin = time.perf_counter()
+        self.events = []
+        self.num_dropped_events = 0
+        self.pids = {}
+        self.next_pid = itertools.count(1)
+        self.next_tid = itertools.count(1)
+
+    def is_sampled(self, name: str) -> bool:
+        return zlib.crc32(f"{self.seed}:{name}".encode()) / 2**32 < self.sample_rate
+
+    def get_timestamp(self, perf_counter: float) -> float:
+        """
+        Convert a time.perf_counter() value to trace microseconds.
+        """
+        return (perf_counter - self.origin) * 1e6
+
+    def add_event(self, event: dict):
+        if len(self.events) >= self.max_events:
+            self.num_dropped_events += 1
+            return
+        self.events.append(event)
+
+    def get_conversation_context(self, name: str) -> TraceContext:
+        if name not in self.pids:
+            pid = next(self.next_pid)
+            self.pids[name] = pid
+            self.add_event({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}})
+        return TraceContext(pid=self.pids[name], tid=0, lane_name=name)
+
+    def new_lane(self, parent: TraceContext, name: str) -> TraceContext:
+        tid = next(self.next_tid)
+        lane_name = name if parent.tid == 0 else f"{parent.lane_name} / {name}"
+        self.add_event({"name": "thread_name", "ph": "M", "pid": parent.pid, "tid": tid, "args": {"name": lane_name}})
+        return TraceContext(pid=parent.pid, tid=tid, lane_name=lane_name)
+
+    def add_span(self, context: TraceContext, name: str, start: float, end: float, args: dict | None = None):
+        self.add_event({
+            "name": name,
+            "ph": "X",
+            "pid": context.pid,
+            "tid": context.tid,
+            "ts": self.get_timestamp(start),
+            "dur": (end - start) * 1e6,
+            "args": args or {},
+        })
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({
+                "traceEvents": self.events,
+                "displayTimeUnit": "ms",
+                "otherData": {
+                    "sample_rate": self.sample_rate,
+                    "num_dropped_events": self.num_dropped_events,
+                },
+            }, f)
+
+
+TRACER = None
+
+
+def enable(sample_rate: float = 1.0, seed: int = 0, max_events: int = 1_000_000) -> Tracer:
+    """
+    Enable tracing with a new global tracer.
+    """
+    global TRACER
+    TRACER = Tracer(sample_rate=sample_rate, seed=seed, max_events=max_events)
+    return TRACER
+
+
+@contextlib.contextmanager
+def conversation(name: str):
+    """
+    Trace the enclosed code as part of the conversation `name`, if it is sampled.
+    """
+    name_token = CONVERSATION_NAME.set(name)
+    if TRACER is None or not TRACER.is_sampled(name):
+        try:
+            yield
+        finally:
+            CONVERSATION_NAME.reset(name_token)
+        return
+    token = TRACE_CONTEXT.set(TRACER.get_conversation_context(name))
+    try:
+        yield
+    finally:
+        TRACE_CONTEXT.reset(token)
+        CONVERSATION_NAME.reset(name_token)
+
+
+async def traced_conversation(coroutine, name: str):
+    """
+    Await a coroutine within the trace of conversation `name`.
+    """
+    with conversation(name):
+        return await coroutine
+
+
+@contextlib.contextmanager
+def lane(name: str):
+    """
+    Record the enclosed spans (and those of tasks started within) in a new lane.
+    """
+    context = TRACE_CONTEXT.get()
+    if context is None:
+        yield
+        return
+    token = TRACE_CONTEXT.set(TRACER.new_lane(context, name))
+    try:
+        yield
+    finally:
+        TRACE_CONTEXT.reset(token)
+
+
+async def traced_lane(coroutine, name: str):
+    """
+    Await a coroutine in a new lane.
+    """
+    with lane(name):
+        return await coroutine
+
+
+def in_lane(coroutine, name: str):
+    """
+    Wrap a coroutine to run in a new lane, or return it unchanged when not tracing.
+    """
+    if TRACE_CONTEXT.get() is None:
+        return coroutine
+    return traced_lane(coroutine, name)
+
+
+@contextlib.contextmanager
+def span(name: str, **args):
+    """
+    Record the enclosed code as a span in the current lane.
+    """
+    context = TRACE_CONTEXT.get()
+    if context is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        TRACER.add_span(context, name, start, time.perf_counter(), args)
+
+
+def add_span(name: str, start: float, end: float, **args):
+    """
+    Record a span with explicit time.perf_counter() bounds in the current lane.
+    """
+    context = TRACE_CONTEXT.get()
+    if context is not None:
+        TRACER.add_span(context, name, start, end, args)
@@ -0,0 +1,174 @@
+"""
+Token and cost accounting, with an optional hard budget.
+
+A `UsageTracker` passed to `ModelWrapper` records the `usage` of every response (prompt, cached
+and completion tokens) per model and classifier. With a `budget` (USD), each request reserves its
+worst-case cost before it is sent. Once spent plus in-flight cost would exceed the budget, the
+tracker stops dispatching: that request and all later ones raise `BudgetExceededError`, and runners
+save the results completed so far together with the usage totals.
+"""
+
+import time
+from collections import defaultdict
+
+import pydantic
+
+import emoclassifiers.io_utils as io_utils
+from emoclassifiers.chunking import estimate_num_tokens
+from emoclassifiers.pricing import estimate_cost, get_model_pricing
+
+
+class BudgetExceededError(Exception):
+    """
+    Raised instead of sending a request once the budget of a UsageTracker is exhausted.
+    """
+
+
+class Usage(pydantic.BaseModel):
+    """
+    Token usage and cost, summed over calls.
+    """
+    calls: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+
+    def add(self, other: "Usage"):
+        self.calls += other.calls
+        self.prompt_tokens += other.prompt_tokens
+        self.cached_tokens += other.cached_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cost += other.cost
+
+    @classmethod
+    def from_response(cls, model: str, response_usage) -> "Usage":
+        """
+        Usage of a single response (an openai CompletionUsage, or None if missing).
+        The cost is 0 for models without pricing.
+        """
+        usage = cls(calls=1)
+        if response_usage is not None:
+            details = response_usage.prompt_tokens_details
+            usage.prompt_tokens = response_usage.prompt_tokens
+            usage.cached_tokens = (details.cached_tokens or 0) if details else 0
+            usage.completion_tokens = response_usage.completion_tokens
+            usage.cost = estimate_cost(model, usage.prompt_tokens, usage.completion_tokens, usage.cached_tokens) or 0.0
+        return usage
+
+
+class UsageTracker:
+    def __init__(self, budget: float | None = None):
+        """
+        Tracks token usage and cost of a run, keyed by (model, classifier set, classifier).
+        The classifier set is the "version" of a classifier definition.
+        """
+        self.budget = budget
+        self.started_at = time.time()
+        self.usage = defaultdict(Usage)
+        self.reserved = 0.0
+        self.exhausted = False
+        self.rejected_calls = 0
+        self.unpriced_models = set()
+
+    @property
+    def spent(self) -> float:
+        return sum(usage.cost for usage in self.usage.values())
+
+    def reserve(self, model: str, prompt: str, max_completion_tokens: int) -> float:
+        """
+        Reserve the worst-case cost of a request before sending it.
+        Raises BudgetExceededError (and stops all later requests) if it would exceed the budget.
+        """
+        if self.budget is None:
+            return 0.0
+        if self.exhausted:
+            self.rejected_calls += 1
+            raise BudgetExceededError(f"Budget of ${self.budget} exhausted")
+        cost = estimate_cost(model, estimate_num_tokens(prompt), max_completion_tokens)
+        if cost is None:
+            raise ValueError(f"No pricing for model {model}, cannot enforce a budget")
+        if self.spent + self.reserved + cost > self.budget:
+            self.exhausted = True
+            self.rejected_calls += 1
+            raise BudgetExceededError(
+                f"Projected spend ${self.spent + self.reserved + cost:.4f} exceeds budget of ${self.budget}"
+            )
+        self.reserved += cost
+        return cost
+
+    def try_reserve(self, model: str, prompt: str, max_completion_tokens: int) -> float | None:
+        """
+        Reserve the worst-case cost of an optional request (e.g. a hedge), returning None
+        instead of raising (and without stopping later requests) if it would exceed the budget.
+        """
+        if self.budget is None:
+            return 0.0
+        cost = estimate_cost(model, estimate_num_tokens(prompt), max_completion_tokens)
+        if self.exhausted or cost is None or self.spent + self.reserved + cost > self.budget:
+            return None
+        self.reserved += cost
+        return cost
+
+    def release(self, reservation: float):
+        self.reserved -= reservation
+
+    def record(self, model: str, classifier_definition: dict, response_usage):
+        """
+        Record the `usage` of a response (an openai CompletionUsage, or None if missing).
+        """
+        key = (
+            model,
+            classifier_definition["version"],
+            classifier_definition.get("name") or classifier_definition["full_name"],
+        )
+        if response_usage is not None and get_model_pricing(model) is None:
+            self.unpriced_models.add(model)
+        self.usage[key].add(Usage.from_response(model, response_usage))
+
+    def report(self) -> dict:
+        total = Usage()
+        by_model = defaultdict(Usage)
+        for (model, _, _), usage in self.usage.items():
+            total.add(usage)
+            by_model[model].add(usage)
+        return {
+            "started_at": self.started_at,
+            "budget": self.budget,
+            "stopped_by_budget": self.exhausted,
+            "rejected_calls": self.rejected_calls,
+            "unpriced_models": sorted(self.unpriced_models),
+            "total": total.model_dump(),
+            "by_model": {model: usage.model_dump() for model, usage in by_model.items()},
+            "by_classifier": [
+                {
+                    "model": model,
+                    "classifier_set": classifier_set,
+                    "classifier": classifier,
+                    **usage.model_dump(),
+                }
+                for (model, classifier_set, classifier), usage in self.usage.items()
+            ],
+        }
+
+    def save(self, path: str, **extra):
+        """
+        Save the usage report (and any extra fields, e.g. incomplete conversation ids) as JSON.
+        """
+        io_utils.save_json({**self.report(), **extra}, path)
+
+    def print_report(self):
+        report = self.report()
+        total = report["total"]
+        print(
+            f"\nUsage: {total['calls']} calls, {total['prompt_tokens']} prompt tokens"
+            f" ({total['cached_tokens']} cached), {total['completion_tokens']} completion tokens,"
+            f" cost ${total['cost']:.4f}"
+        )
+        if report["unpriced_models"]:
+            print(f"No pricing for: {', '.join(report['unpriced_models'])} (cost not counted)")
+        if report["stopped_by_budget"]:
+            print(
+                f"Stopped by budget of ${report['budget']}:"
+                f" {report['rejected_calls']} requests were not sent"
+            )
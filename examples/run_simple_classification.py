@@ -1,32 +1,70 @@
 import argparse
 import asyncio
+import json
 import openai
 
 import emoclassifiers.io_utils as io_utils
 import emoclassifiers.classification as classification
 import emoclassifiers.aggregation as aggregation
+import emoclassifiers.prescreen as prescreen
+import emoclassifiers.distillation as distillation
+import emoclassifiers.cascade as cascade
+import emoclassifiers.client_pool as client_pool
+import emoclassifiers.compression as compression
+import emoclassifiers.deadlines as deadlines
+import emoclassifiers.hedging as hedging
+import emoclassifiers.planning as planning
+import emoclassifiers.usage as usage
+import emoclassifiers.metrics as metrics
+import emoclassifiers.tracing as tracing
+import emoclassifiers.recording as recording
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.profiling as profiling
 
 
 async def run_classification(
     conversation_list: list[dict],
     classifiers: dict[str, classification.EmoClassifier],
     aggregator: aggregation.Aggregator,
+    conversation_timeout: float | None = None,
 ) -> list[dict]:
+    """
+    All conversations are started together, so `conversation_timeout` (seconds) bounds the run.
+    Classifiers cut off by it are listed under "timed_out" and score as negative.
+    """
     futures_keys = []
     futures = []
     print(f"Running {len(conversation_list)} conversations with {len(classifiers)} classifiers")
     for conversation_id, conversation in enumerate(conversation_list):
         for classifier_name, classifier in classifiers.items():
-            futures.append(classifier.classify_conversation(conversation))
+            if aggregator.requires_detailed_results:
+                future = classifier.classify_conversation_detailed(conversation)
+            else:
+                future = classifier.classify_conversation(conversation)
+            future = deadlines.with_deadline(future, timeout=conversation_timeout)
+            future = scheduling.with_flow(future, flow=f"conversation {conversation_id}")
+            futures.append(tracing.traced_conversation(future, name=f"conversation {conversation_id}"))
             futures_keys.append({
                 "conversation_id": conversation_id,
                 "classifier_name": classifier_name,
             })
-    raw_results = await asyncio.gather(*futures)
+    raw_results = await asyncio.gather(*futures, return_exceptions=True)
     results_by_conversation = [{} for _ in range(len(conversation_list))]
+    incomplete_conversation_ids = set()
     for key, raw_result in zip(futures_keys, raw_results):
+        if isinstance(raw_result, usage.BudgetExceededError):
+            incomplete_conversation_ids.add(key["conversation_id"])
+            continue
+        elif isinstance(raw_result, BaseException):
+            raise raw_result
         result = aggregator.aggregate(raw_result)
-        results_by_conversation[key["conversation_id"]][key["classifier_name"]] = result
+        conversation_results = results_by_conversation[key["conversation_id"]]
+        conversation_results[key["classifier_name"]] = result
+        if classification.get_timed_out_chunk_ids(raw_result):
+            conversation_results.setdefault("timed_out", []).append(key["classifier_name"])
+    # Conversations cut off by the budget are saved as null, to be re-run later.
+    for conversation_id in incomplete_conversation_ids:
+        results_by_conversation[conversation_id] = None
     return results_by_conversation
 
 
@@ -36,25 +74,241 @@ def main():
     parser.add_argument("--output_path", type=str, required=True)
     parser.add_argument("--classifier_set", type=str, default="v1")
     parser.add_argument("--aggregation_mode", type=str, default="any")
+    parser.add_argument("--model", type=str, default="gpt-4o-mini-2024-07-18")
+    parser.add_argument("--escalation_model", type=str, default=None)
+    parser.add_argument("--escalation_min_probability", type=float, default=None)
+    parser.add_argument(
+        "--decoding_mode",
+        type=str,
+        default=classification.STRUCTURED_DECODING,
+        choices=[classification.STRUCTURED_DECODING, classification.LABEL_TOKEN_DECODING],
+    )
+    parser.add_argument("--packed_token_budget", type=int, default=None)
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        help="JSON compression config applied to all classifiers, e.g. '{}' for the defaults.",
+    )
+    parser.add_argument("--prescreen", action="store_true")
+    parser.add_argument("--prescreen_audit_rate", type=float, default=0.0)
+    parser.add_argument("--distilled_model_dir", type=str, default=None)
+    parser.add_argument("--distilled_threshold", type=float, default=0.95)
+    parser.add_argument(
+        "--distilled_min_agreement",
+        type=float,
+        default=0.95,
+        help="Only use distilled models with at least this held-out agreement at --distilled_threshold.",
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="fifo",
+        choices=list(scheduling.SCHEDULER_DICT),
+        help="fair: gating classifiers first, then fair sharing across classifier sets and conversations.",
+    )
+    parser.add_argument("--request_timeout", type=float, default=None, help="Timeout (s) per request, including retries.")
+    parser.add_argument(
+        "--hedge_percentile",
+        type=float,
+        default=None,
+        help="Send a duplicate of requests slower than this percentile of recent latency and use the first answer.",
+    )
+    parser.add_argument("--max_hedge_rate", type=float, default=0.05, help="Maximum fraction of requests hedged.")
+    parser.add_argument(
+        "--endpoints_path",
+        type=str,
+        default=None,
+        help="JSON list of endpoints (see emoclassifiers/client_pool.py) to balance requests across.",
+    )
+    parser.add_argument(
+        "--conversation_timeout",
+        type=float,
+        default=None,
+        help="Deadline (s) per conversation. Unfinished classifiers are listed under \"timed_out\" in the output.",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Hard budget (USD). Once projected spend exceeds it, no more requests are sent.",
+    )
+    parser.add_argument("--metrics_sink", type=str, default=None, choices=list(metrics.SINK_DICT))
+    parser.add_argument(
+        "--metrics_target",
+        type=str,
+        default="metrics.prom",
+        help="Output file, or port (or host:port) for prometheus_http.",
+    )
+    parser.add_argument("--metrics_interval", type=float, default=15.0)
+    parser.add_argument("--trace_path", type=str, default=None, help="Save a Chrome trace-event JSON here.")
+    parser.add_argument("--trace_sample_rate", type=float, default=0.01)
+    parser.add_argument(
+        "--record_path",
+        type=str,
+        default=None,
+        help="Save a record of every request (JSONL), for replay with benchmarks/replay_workload.py.",
+    )
+    parser.add_argument(
+        "--loop_lag_threshold",
+        type=float,
+        default=None,
+        help="If set, monitor event loop lag and record the stack of stalls longer than this (s).",
+    )
+    parser.add_argument("--profile_stages", type=str, nargs="+", default=None, choices=profiling.STAGES)
+    parser.add_argument("--dry_run", action="store_true", help="Only forecast calls, tokens, cost and time.")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute limit, for the dry run forecast.")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute limit, for the dry run forecast.")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mean request latency (s), for the dry run forecast.")
     args = parser.parse_args()
+    if args.packed_token_budget is not None and args.prescreen:
+        parser.error("--prescreen only applies to single chunks and cannot be combined with --packed_token_budget")
+    if args.packed_token_budget is not None and args.distilled_model_dir is not None:
+        parser.error("--distilled_model_dir only applies to single chunks and cannot be combined with --packed_token_budget")
+    if args.packed_token_budget is not None and args.escalation_model is not None:
+        parser.error("--escalation_model only applies to single chunks and cannot be combined with --packed_token_budget")
     conversation_list = io_utils.load_jsonl(args.input_path)
+    classifier_definitions = classification.load_classifier_definitions(classifier_set=args.classifier_set)
+    if args.compression is not None:
+        compression_config = json.loads(args.compression)
+        classifier_definitions = {
+            name: {**definition, "compression": compression_config}
+            for name, definition in classifier_definitions.items()
+        }
+    if args.dry_run:
+        plan = planning.plan_run(
+            conversation_list=conversation_list,
+            classifier_definitions=classifier_definitions,
+            model=args.model,
+            decoding_mode=args.decoding_mode,
+            packed_token_budget=args.packed_token_budget,
+            prescreen=args.prescreen,
+        )
+        plan.print_report(max_concurrent=20, latency=args.latency, rpm=args.rpm, tpm=args.tpm)
+        return
+    usage_tracker = usage.UsageTracker(budget=args.budget)
+    pool = None
+    if args.endpoints_path is not None:
+        pool = client_pool.load_client_pool(args.endpoints_path)
+    openai_client = openai.AsyncOpenAI() if pool is None else None
+    hedging_policy = None
+    if args.hedge_percentile is not None:
+        hedging_policy = hedging.HedgingPolicy(percentile=args.hedge_percentile, max_hedge_rate=args.max_hedge_rate)
+    if args.trace_path is not None:
+        tracing.enable(sample_rate=args.trace_sample_rate)
+    if args.record_path is not None:
+        recording.enable()
+    if args.profile_stages is not None:
+        profiling.enable_profiler(args.profile_stages)
+    loop_lag_monitor = None
+    if args.loop_lag_threshold is not None:
+        loop_lag_monitor = profiling.LoopLagMonitor(stall_threshold=args.loop_lag_threshold)
+    metrics_sink = None
+    if args.metrics_sink is not None:
+        metrics_sink = metrics.start_sink(args.metrics_sink, args.metrics_target, args.metrics_interval)
     model_wrapper = classification.ModelWrapper(
-        openai_client=openai.AsyncOpenAI(),
-        model="gpt-4o-mini-2024-07-18",
-        max_concurrent=20,
-    )
-    classifiers = classification.load_classifiers(
-        classifier_set=args.classifier_set,
-        model_wrapper=model_wrapper,
+        openai_client=openai_client,
+        model=args.model,
+        max_concurrent=pool.max_concurrent if pool is not None else 20,
+        scheduler=args.scheduler,
+        request_logprobs=args.escalation_min_probability is not None,
+        decoding_modes={version: args.decoding_mode for version in classification.VERSION_LABEL_ENUM_DICT},
+        usage_tracker=usage_tracker,
+        request_timeout=args.request_timeout,
+        hedging_policy=hedging_policy,
+        client_pool=pool,
     )
+    if args.escalation_model is not None:
+        model_wrapper = cascade.CascadeModelWrapper(
+            tiers=[
+                model_wrapper,
+                classification.ModelWrapper(
+                    openai_client=openai_client,
+                    model=args.escalation_model,
+                    max_concurrent=20,
+                    scheduler=args.scheduler,
+                    usage_tracker=usage_tracker,
+                    request_timeout=args.request_timeout,
+                ),
+            ],
+            default_policy=cascade.EscalationPolicy(min_probability=args.escalation_min_probability),
+        )
+        cascade_wrapper = model_wrapper
+    if args.distilled_model_dir is not None:
+        model_wrapper = distillation.DistilledModelWrapper(
+            model_wrapper=model_wrapper,
+            models=distillation.load_distilled_models(
+                args.distilled_model_dir,
+                args.classifier_set,
+                threshold=args.distilled_threshold,
+                min_agreement=args.distilled_min_agreement,
+            ),
+            threshold=args.distilled_threshold,
+        )
+        distillation_wrapper = model_wrapper
+    if args.prescreen:
+        model_wrapper = prescreen.PreScreenModelWrapper(
+            model_wrapper=model_wrapper,
+            audit_rate=args.prescreen_audit_rate,
+        )
+    classifiers = {
+        name: classification.EmoClassifier(
+            classifier_definition=definition,
+            model_wrapper=model_wrapper,
+            packed_token_budget=args.packed_token_budget,
+        )
+        for name, definition in classifier_definitions.items()
+    }
     aggregator = aggregation.AGGREGATOR_DICT[args.aggregation_mode]
-    result = asyncio.run(run_classification(
-        conversation_list=conversation_list,
-        classifiers=classifiers,
-        aggregator=aggregator,
+    result = asyncio.run(profiling.run_monitored(
+        client_pool.with_client_pool(
+            run_classification(
+                conversation_list=conversation_list,
+                classifiers=classifiers,
+                aggregator=aggregator,
+                conversation_timeout=args.conversation_timeout,
+            ),
+            pool,
+        ),
+        monitor=loop_lag_monitor,
     ))
     io_utils.save_jsonl(result, args.output_path)
     print(f"Saved results to {args.output_path}")
+    usage_tracker.save(
+        args.output_path + ".usage.json",
+        incomplete_conversation_ids=[i for i, conversation_result in enumerate(result) if conversation_result is None],
+    )
+    usage_tracker.print_report()
+    if pool is not None:
+        pool.print_report()
+    if hedging_policy is not None:
+        hedging_policy.print_report()
+    num_timed_out = sum(conversation_result is not None and "timed_out" in conversation_result for conversation_result in result)
+    if num_timed_out:
+        metrics.TIMED_OUT_CONVERSATIONS.inc(num_timed_out)
+        print(f"{num_timed_out} conversations timed out (see \"timed_out\" in the results)")
+    if metrics_sink is not None:
+        metrics_sink.stop()
+    if args.trace_path is not None:
+        tracing.TRACER.save(args.trace_path)
+        print(f"Saved trace to {args.trace_path}")
+    if args.record_path is not None:
+        recording.RECORDER.save(args.record_path)
+        print(f"Saved {len(recording.RECORDER.records)} request records to {args.record_path}")
+    if loop_lag_monitor is not None:
+        loop_lag_monitor.save(args.output_path + ".loop_lag.json")
+        print(f"Max event loop lag: {loop_lag_monitor.max_lag:.3f}s, {len(loop_lag_monitor.stalls)} stalls")
+    if args.profile_stages is not None:
+        profiling.PROFILER.save(args.output_path + ".profile")
+        print(f"Saved profile to {args.output_path}.profile.txt")
+    if args.prescreen:
+        model_wrapper.stats.print_report()
+    if args.distilled_model_dir is not None:
+        print(f"Distilled cascade: {distillation_wrapper.report()}")
+    if args.escalation_model is not None:
+        cascade_wrapper.print_report()
+    if args.compression is not None:
+        compression.COMPRESSION_STATS.print_report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+"""
+Retry the chunks of a dead-letter file (see emoclassifiers/dead_letter.py) and patch their labels
+into the existing results, without re-classifying anything else. Chunks that fail again stay in
+the dead-letter file, so the command can be repeated.
+
+Results are JSONL records with "conversation_hash" and "classifications", keyed by chunk id
+(--layout chunk, e.g. run_efficient_question_classification.py) or by classifier key
+(--layout classifier, e.g. test_intent_classifiers.py).
+
+    python redrive_dead_letters.py --dead_letter_path classification_results.jsonl.dead_letters.jsonl \
+        --results_path classification_results.jsonl --conversations_path test_conversations.jsonl \
+        --classifier_set question_tree --layout chunk
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+import openai
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.classification as classification
+import emoclassifiers.dead_letter as dead_letter
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.usage as usage
+from emoclassifiers.chunking import get_chunker
+
+
+def get_timed_out_letters(results: list[dict], definitions: dict[str, dict], layout: str) -> list[dead_letter.DeadLetter]:
+    """
+    Dead letters for the chunks labeled "timeout" in the results.
+    """
+    timeout = classification.ClassificationStatusEnum.TIMEOUT.value
+    letters = []
+    for row in results:
+        if layout == "chunk":
+            assert len(definitions) == 1, "layout='chunk' requires a single-classifier set"
+            definition = next(iter(definitions.values()))
+            items = [(definition, int(chunk_id)) for chunk_id, label in row["classifications"].items() if label == timeout]
+        else:
+            # Classifier layout results hold the first chunk (e.g. single-message intent results).
+            items = [(definitions[key], 0) for key, label in row["classifications"].items() if label == timeout]
+        letters += [
+            dead_letter.DeadLetter(
+                conversation_hash=row["conversation_hash"],
+                classifier_set=scheduling.get_classifier_set(definition),
+                classifier=classification.get_classifier_name(definition),
+                chunk_id=chunk_id,
+                error_type="timeout",
+                error="",
+                failed_at=0.0,
+            )
+            for definition, chunk_id in items
+        ]
+    return letters
+
+
+async def redrive_letter(
+    letter: dead_letter.DeadLetter,
+    definition: dict,
+    conversation: list[dict],
+    model_wrapper: classification.ModelWrapper,
+) -> classification.ChunkClassification:
+    chunks = get_chunker(definition["chunker"], definition.get("chunker_kwargs")).chunk_simple_convo(conversation)
+    if letter.chunk_id not in chunks:
+        raise KeyError(f"Chunk {letter.chunk_id} not found, the conversation may have changed")
+    return await model_wrapper.classify_conversation_chunk_detailed(
+        classifier_definition=definition,
+        chunk=chunks[letter.chunk_id],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retry dead-lettered chunks and patch them into the results.")
+    parser.add_argument("--dead_letter_path", type=str, required=True)
+    parser.add_argument("--results_path", type=str, required=True)
+    parser.add_argument("--conversations_path", type=str, required=True)
+    parser.add_argument("--classifier_set", type=str, required=True, choices=list(classification.CLASSIFIER_DEFINITION_PATH_DICT))
+    parser.add_argument("--layout", type=str, default="classifier", choices=["classifier", "chunk"])
+    parser.add_argument("--output_path", type=str, default=None, help="Defaults to updating --results_path in place.")
+    parser.add_argument("--include_timeouts", action="store_true", help="Also retry chunks labeled \"timeout\".")
+    parser.add_argument("--model", type=str, default="gpt-4o-mini")
+    parser.add_argument("--max_concurrent", type=int, default=20)
+    args = parser.parse_args()
+
+    definitions = classification.load_classifier_definitions(classifier_set=args.classifier_set)
+    # Definitions of a predefined set are tagged with it, so letters of other sets (e.g. of
+    # run_multi_set_classification.py) never match, even if the sets share a version.
+    definitions_by_name = {
+        (scheduling.get_classifier_set(definition), classification.get_classifier_name(definition)): (key, definition)
+        for key, definition in definitions.items()
+    }
+    results = io_utils.load_jsonl(args.results_path)
+    letters = dead_letter.load_dead_letters(args.dead_letter_path)
+    if args.include_timeouts:
+        letters += get_timed_out_letters(results, definitions, args.layout)
+    hashes = {letter.conversation_hash for letter in letters}
+    conversations = {
+        row["conversation_hash"]: row["conversation"]
+        for row in io_utils.load_jsonl(args.conversations_path)
+        if row["conversation_hash"] in hashes
+    }
+
+    remaining = []
+    redriven = []
+    for letter in letters:
+        if (letter.classifier_set, letter.classifier) not in definitions_by_name or letter.conversation_hash not in conversations:
+            # Another classifier set, or a conversation that is not in this input.
+            remaining.append(letter)
+        else:
+            redriven.append(letter)
+    print(f"Retrying {len(redriven)} of {len(letters)} dead-lettered chunks")
+
+    usage_tracker = usage.UsageTracker()
+    model_wrapper = classification.ModelWrapper(
+        openai_client=openai.AsyncOpenAI(),
+        model=args.model,
+        max_concurrent=args.max_concurrent,
+        usage_tracker=usage_tracker,
+    )
+
+    async def redrive_all():
+        return await asyncio.gather(*(
+            redrive_letter(
+                letter=letter,
+                definition=definitions_by_name[(letter.classifier_set, letter.classifier)][1],
+                conversation=conversations[letter.conversation_hash],
+                model_wrapper=model_wrapper,
+            )
+            for letter in redriven
+        ), return_exceptions=True)
+
+    outcomes = asyncio.run(redrive_all())
+    rows = {row["conversation_hash"]: row for row in results}
+    num_patched = 0
+    for letter, outcome in zip(redriven, outcomes):
+        if isinstance(outcome, BaseException):
+            remaining.append(letter.model_copy(update={
+                "error_type": type(outcome).__name__,
+                "error": str(outcome),
+                "failed_at": time.time(),
+            }))
+            continue
+        if letter.conversation_hash not in rows:
+            # The conversation failed as a whole; start its result from the redriven chunks.
+            rows[letter.conversation_hash] = {"conversation_hash": letter.conversation_hash, "classifications": {}}
+            results.append(rows[letter.conversation_hash])
+        key = definitions_by_name[(letter.classifier_set, letter.classifier)][0]
+        classifications = rows[letter.conversation_hash]["classifications"]
+        classifications[str(letter.chunk_id) if args.layout == "chunk" else key] = outcome.label.value
+        num_patched += 1
+
+    output_path = args.output_path or args.results_path
+    io_utils.save_jsonl(results, output_path + ".tmp")
+    os.replace(output_path + ".tmp", output_path)
+    dead_letter.save_dead_letters(remaining, args.dead_letter_path)
+    print(f"Patched {num_patched} chunks into {output_path}; {len(remaining)} remain in {args.dead_letter_path}")
+    usage_tracker.print_report()
+
+
+if __name__ == "__main__":
+    main()
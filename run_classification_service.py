@@ -0,0 +1,415 @@
+"""
+A long-running classification service (HTTP/JSON on localhost), for classifying conversations
+online. It classifies with the classifier sets of run_multi_set_classification.py (v1 gated by
+v1_top_level when both are selected) through one model wrapper.
+
+    python run_classification_service.py --port 8080 --classifier_sets v1_top_level v1
+    curl -s localhost:8080/classify -d '{"conversation": [{"role": "user", "content": "hi"}]}'
+
+Endpoints:
+- POST /classify with {"conversation": [...], "conversation_hash": optional}: the combined record
+  of run_multi_set_classification.py. 400 for an invalid body, 503 (with Retry-After) when the
+  request is rejected or shed, 504 if it is not answered within --response_timeout.
+- GET /health, GET /stats (queue, deduplication and usage), GET /metrics (Prometheus).
+
+Identical conversations submitted concurrently are classified once, and identical model requests
+of different conversations (e.g. of a conversation classified again as it grows) are sent once
+(`dedupe.RequestDeduplicator`). Admission control and load shedding keep latency bounded under
+overload: at most --max_in_progress conversations are classified at a time, the others wait in
+the queue, a request arriving when --max_queue_size conversations are already queued is
+rejected, and a queued conversation that waited longer than --max_queue_wait is shed rather than
+classified after its client has likely given up.
+
+With --mock_backend, requests go to an in-process mock backend instead of the API, for load
+tests with benchmarks/run_service_load_test.py.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+
+import openai
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.classification as classification
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.client_pool as client_pool
+import emoclassifiers.dedupe as dedupe
+import emoclassifiers.deadlines as deadlines
+import emoclassifiers.metrics as metrics
+import emoclassifiers.mock_backend as mock_backend
+import emoclassifiers.rate_limiting as rate_limiting
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.usage as usage
+import run_multi_set_classification
+
+SERVICE_REQUESTS = metrics.METRICS.counter(
+    "emoclassifiers_service_requests_total", "Classification service requests, by status.",
+)
+QUEUED_CONVERSATIONS = metrics.METRICS.gauge(
+    "emoclassifiers_service_queued_conversations", "Conversations waiting to be dispatched.",
+)
+CONVERSATIONS_IN_PROGRESS = metrics.METRICS.gauge(
+    "emoclassifiers_service_conversations_in_progress", "Conversations being classified.",
+)
+QUEUE_WAIT = metrics.METRICS.histogram(
+    "emoclassifiers_service_queue_wait_seconds", "Time conversations waited in the queue before being dispatched.",
+)
+SHED_CONVERSATIONS = metrics.METRICS.counter(
+    "emoclassifiers_service_shed_conversations_total", "Conversations rejected or shed, by reason.",
+)
+
+STATUS_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class ServiceOverloadedError(Exception):
+    """
+    A conversation rejected (queue full) or shed (waited too long in the queue).
+    """
+
+
+def get_conversation_key(conversation: list[dict]) -> str:
+    return hashlib.sha256(json.dumps(conversation, sort_keys=True).encode()).hexdigest()
+
+
+class PendingConversation:
+    def __init__(self, key: str, conversation: list[dict]):
+        self.key = key
+        self.conversation = conversation
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+
+class ClassificationService:
+    def __init__(
+        self,
+        classifier_sets: dict[str, dict[str, classification.EmoClassifier]],
+        dependency_graphs: dict[str, dict],
+        aggregator: aggregation.Aggregator,
+        max_queue_size: int = 256,
+        max_in_progress: int = 64,
+        max_queue_wait: float = 10.0,
+        conversation_timeout: float | None = None,
+    ):
+        """
+        Classify submitted conversations, with at most `max_in_progress` conversations in progress
+        and `max_queue_size` waiting (for at most `max_queue_wait` seconds each).
+        """
+        self.classifier_sets = classifier_sets
+        self.dependency_graphs = dependency_graphs
+        self.aggregator = aggregator
+        self.max_queue_wait = max_queue_wait
+        self.conversation_timeout = conversation_timeout
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.capacity = asyncio.Semaphore(max_in_progress)
+        # Queued and in-progress conversations, by key.
+        self.pending = {}
+        self.tasks = set()
+        self.dispatcher_task = None
+        self.stats = {"submitted": 0, "coalesced": 0, "rejected": 0, "shed": 0, "classified": 0, "failed": 0}
+
+    def start(self):
+        self.dispatcher_task = asyncio.create_task(self.run_dispatcher())
+
+    async def submit(self, conversation: list[dict]) -> dict:
+        """
+        Classify a conversation, sharing the classification of an identical one queued or in progress.
+        Raises ServiceOverloadedError if the queue is full or the conversation is shed.
+        """
+        self.stats["submitted"] += 1
+        key = get_conversation_key(conversation)
+        pending = self.pending.get(key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+        else:
+            pending = PendingConversation(key, conversation)
+            try:
+                self.queue.put_nowait(pending)
+            except asyncio.QueueFull:
+                self.stats["rejected"] += 1
+                SHED_CONVERSATIONS.inc(reason="queue_full")
+                raise ServiceOverloadedError("Too many conversations queued") from None
+            self.pending[key] = pending
+            QUEUED_CONVERSATIONS.inc()
+        # Shielded: a client giving up does not cancel the classification shared with others.
+        return await asyncio.shield(pending.future)
+
+    async def run_dispatcher(self):
+        """
+        Start classifying queued conversations as capacity frees up. Conversations stay in the
+        queue (counting towards `max_queue_size`) until there is capacity for them, and those
+        that waited in the queue for too long are shed instead.
+        """
+        while True:
+            await self.capacity.acquire()
+            pending = await self.queue.get()
+            QUEUED_CONVERSATIONS.dec()
+            queue_wait = time.perf_counter() - pending.enqueued_at
+            QUEUE_WAIT.observe(queue_wait)
+            if queue_wait > self.max_queue_wait:
+                self.capacity.release()
+                self.stats["shed"] += 1
+                SHED_CONVERSATIONS.inc(reason="queue_wait")
+                self.finish(pending, error=ServiceOverloadedError(f"Shed after waiting {queue_wait:.1f}s in the queue"))
+                continue
+            task = asyncio.create_task(self.classify(pending))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def classify(self, pending: PendingConversation):
+        CONVERSATIONS_IN_PROGRESS.inc()
+        try:
+            result = await scheduling.with_flow(
+                deadlines.with_deadline(
+                    run_multi_set_classification.run_classification_on_single_conversation(
+                        row=pending.conversation,
+                        classifier_sets=self.classifier_sets,
+                        dependency_graphs=self.dependency_graphs,
+                        aggregator=self.aggregator,
+                    ),
+                    timeout=self.conversation_timeout,
+                ),
+                flow=pending.key,
+            )
+        except Exception as e:
+            self.stats["failed"] += 1
+            self.finish(pending, error=e)
+        else:
+            self.stats["classified"] += 1
+            self.finish(pending, result=result)
+        finally:
+            CONVERSATIONS_IN_PROGRESS.dec()
+            self.capacity.release()
+
+    def finish(self, pending: PendingConversation, result: dict | None = None, error: Exception | None = None):
+        self.pending.pop(pending.key, None)
+        if error is not None:
+            pending.future.set_exception(error)
+            # Retrieved by the waiting clients, if any are left.
+            pending.future.exception()
+        else:
+            pending.future.set_result(result)
+
+    def report(self) -> dict:
+        return {
+            **self.stats,
+            "queued": self.queue.qsize(),
+            "in_progress": len(self.tasks),
+        }
+
+
+def parse_body(body: bytes) -> dict:
+    row = json.loads(body)
+    if not isinstance(row, dict) or not isinstance(row.get("conversation"), list):
+        raise ValueError("Expected a JSON object with a \"conversation\" list")
+    for message in row["conversation"]:
+        if not isinstance(message, dict) or not isinstance(message.get("role"), str) or not isinstance(message.get("content"), str):
+            raise ValueError("Messages must have a \"role\" and a \"content\" string")
+    return row
+
+
+class ServiceServer:
+    def __init__(
+        self,
+        service: ClassificationService,
+        response_timeout: float | None = None,
+        extra_reports: dict | None = None,
+    ):
+        """
+        HTTP/1.1 (keep-alive) front end of a classification service. `extra_reports` maps names
+        to objects with a `report()` method, included in /stats.
+        """
+        self.service = service
+        self.response_timeout = response_timeout
+        self.extra_reports = extra_reports or {}
+
+    async def classify(self, body: bytes) -> tuple[int, dict, dict]:
+        try:
+            row = parse_body(body)
+        except ValueError as e:
+            return 400, {}, {"error": str(e)}
+        try:
+            async with asyncio.timeout(self.response_timeout):
+                result = await self.service.submit(row["conversation"])
+        except ServiceOverloadedError as e:
+            return 503, {"Retry-After": "1"}, {"error": str(e)}
+        except usage.BudgetExceededError as e:
+            return 503, {}, {"error": str(e)}
+        except TimeoutError:
+            return 504, {}, {"error": f"Not classified within {self.response_timeout}s"}
+        if "conversation_hash" in row:
+            result = {"conversation_hash": row["conversation_hash"], **result}
+        return 200, {}, result
+
+    async def route(self, method: str, path: str, body: bytes) -> tuple[int, dict, dict | str]:
+        if method == "POST" and path == "/classify":
+            return await self.classify(body)
+        if method == "GET" and path == "/health":
+            return 200, {}, {"status": "ok"}
+        if method == "GET" and path == "/stats":
+            return 200, {}, {
+                "service": self.service.report(),
+                **{name: reporter.report() for name, reporter in self.extra_reports.items()},
+            }
+        if method == "GET" and path == "/metrics":
+            return 200, {}, metrics.METRICS.to_prometheus()
+        return 404, {}, {"error": f"No route for {method} {path}"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, response_headers, payload = await self.route(method, path.split("?")[0], body)
+                except Exception as e:
+                    status, response_headers, payload = 500, {}, {"error": f"{type(e).__name__}: {e}"}
+                SERVICE_REQUESTS.inc(status=str(status))
+                if isinstance(payload, str):
+                    data, content_type = payload.encode(), "text/plain; version=0.0.4"
+                else:
+                    data, content_type = json.dumps(payload).encode(), "application/json"
+                keep_alive = headers.get("connection", "").lower() != "close"
+                lines = [
+                    f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}",
+                    f"Content-Type: {content_type}",
+                    f"Content-Length: {len(data)}",
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}",
+                ] + [f"{key}: {value}" for key, value in response_headers.items()]
+                writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        self.service.start()
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        print(f"Serving classifier sets {', '.join(self.service.classifier_sets)} on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve conversation classification over HTTP.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--classifier_sets",
+        type=str,
+        nargs="+",
+        default=["v1_top_level", "v1"],
+        choices=list(classification.CLASSIFIER_DEFINITION_PATH_DICT),
+    )
+    parser.add_argument("--model", type=str, default="gpt-4o-mini")
+    parser.add_argument("--max_concurrent", type=int, default=50, help="Concurrent API requests.")
+    parser.add_argument("--aggregation_mode", type=str, default="any", choices=list(aggregation.AGGREGATOR_DICT))
+    parser.add_argument(
+        "--packed_token_budget",
+        type=int,
+        default=None,
+        help="If set, classify the chunks of per-message classifiers in packed requests under this token estimate.",
+    )
+    parser.add_argument("--max_in_progress", type=int, default=64, help="Conversations classified at a time.")
+    parser.add_argument("--max_queue_size", type=int, default=256, help="Queued conversations before rejecting requests.")
+    parser.add_argument("--max_queue_wait", type=float, default=10.0, help="Queued conversations older than this (s) are shed.")
+    parser.add_argument("--response_timeout", type=float, default=60.0, help="Requests not answered within this (s) get a 504.")
+    parser.add_argument("--max_cached_requests", type=int, default=10000, help="Responses kept for deduplication.")
+    parser.add_argument("--request_timeout", type=float, default=None, help="Timeout (s) per API request, including retries.")
+    parser.add_argument(
+        "--conversation_timeout",
+        type=float,
+        default=None,
+        help="Deadline (s) per conversation. Unfinished classifiers are listed under \"timed_out\" in the response.",
+    )
+    parser.add_argument("--budget", type=float, default=None, help="Hard budget (USD) for the lifetime of the service.")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute, shared by all workers.")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute, shared by all workers.")
+    parser.add_argument("--rate_limit_path", type=str, default=rate_limiting.DEFAULT_STATE_PATH, help="Rate limiter state file.")
+    parser.add_argument(
+        "--endpoints_path",
+        type=str,
+        default=None,
+        help="JSON list of endpoints (see emoclassifiers/client_pool.py) to balance requests across.",
+    )
+    parser.add_argument("--mock_backend", action="store_true", help="Send requests to an in-process mock backend.")
+    parser.add_argument("--latency_mean", type=float, default=0.5, help="Mock backend latency (s).")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Mock backend 429 rate.")
+    args = parser.parse_args()
+    if args.mock_backend and args.endpoints_path is not None:
+        parser.error("--mock_backend cannot be combined with --endpoints_path")
+    set_names = list(dict.fromkeys(args.classifier_sets))
+
+    usage_tracker = usage.UsageTracker(budget=args.budget)
+    deduplicator = dedupe.RequestDeduplicator(max_cached=args.max_cached_requests)
+    pool = None
+    if args.endpoints_path is not None:
+        pool = client_pool.load_client_pool(args.endpoints_path)
+    rate_limiter = None
+    if args.rpm is not None or args.tpm is not None:
+        rate_limiter = rate_limiting.SharedTokenBucket(rpm=args.rpm, tpm=args.tpm, path=args.rate_limit_path)
+    if args.mock_backend:
+        openai_client, _ = mock_backend.get_mock_client(mock_backend.MockBackendConfig(
+            latency_mean=args.latency_mean,
+            rate_limit_rate=args.rate_limit_rate,
+        ))
+    else:
+        openai_client = openai.AsyncOpenAI() if pool is None else None
+    model_wrapper = classification.ModelWrapper(
+        openai_client=openai_client,
+        model=args.model,
+        max_concurrent=pool.max_concurrent if pool is not None else args.max_concurrent,
+        usage_tracker=usage_tracker,
+        request_timeout=args.request_timeout,
+        client_pool=pool,
+        rate_limiter=rate_limiter,
+        deduplicator=deduplicator,
+    )
+    classifier_sets = {
+        set_name: classification.load_classifiers(
+            classifier_set=set_name,
+            model_wrapper=model_wrapper,
+            packed_token_budget=args.packed_token_budget,
+        )
+        for set_name in set_names
+    }
+    dependency_graphs = {
+        set_name: io_utils.load_json(io_utils.get_path(dependency_path))["dependency"]
+        for set_name, (gating_set, dependency_path) in run_multi_set_classification.GATED_SET_DICT.items()
+        if set_name in classifier_sets and gating_set in classifier_sets
+    }
+    service = ClassificationService(
+        classifier_sets=classifier_sets,
+        dependency_graphs=dependency_graphs,
+        aggregator=aggregation.AGGREGATOR_DICT[args.aggregation_mode],
+        max_queue_size=args.max_queue_size,
+        max_in_progress=args.max_in_progress,
+        max_queue_wait=args.max_queue_wait,
+        conversation_timeout=args.conversation_timeout,
+    )
+    server = ServiceServer(
+        service,
+        response_timeout=args.response_timeout,
+        extra_reports={"deduplication": deduplicator, "usage": usage_tracker},
+    )
+    try:
+        asyncio.run(client_pool.with_client_pool(server.serve(args.host, args.port), pool))
+    except KeyboardInterrupt:
+        pass
+    usage_tracker.print_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import asyncio
 import json
 from typing import Any, Dict, List
@@ -7,6 +8,10 @@ from tqdm.auto import tqdm
 import emoclassifiers.io_utils as io_utils
 from emoclassifiers.classification import ModelWrapper, load_classifiers, QuestionTypeEnum
 from emoclassifiers.chunking import CHUNKER_DICT
+import emoclassifiers.dead_letter as dead_letter
+from emoclassifiers.deadlines import with_deadline
+from emoclassifiers.rate_limiting import DEFAULT_STATE_PATH, SharedTokenBucket
+from emoclassifiers.usage import UsageTracker
 
 def convert_enum_to_dict(results: Dict) -> Dict:
     """Convert QuestionTypeEnum values to strings for JSON serialization."""
@@ -58,14 +63,23 @@ async def process_conversation_batch(
     conversations: List[Dict[str, Any]],
     classifier: Any,
     batch_start_idx: int,
+    conversation_timeout: float | None = None,
 ) -> List[Dict[str, Any]]:
-    """Process a batch of conversations with the question tree classifier."""
+    """Process a batch of conversations with the question tree classifier.
+    Chunks not classified within `conversation_timeout` seconds are saved as "timeout", and
+    failed chunks as "error" (they are in the dead-letter file, see redrive_dead_letters.py)."""
     batch_results = []
     
     for i, conv_data in enumerate(conversations):
         try:
             # Get the classification result
-            raw_result = await classifier.classify_conversation(conv_data['conversation'])
+            raw_result = await dead_letter.with_conversation(
+                with_deadline(
+                    classifier.classify_conversation(conv_data['conversation']),
+                    timeout=conversation_timeout,
+                ),
+                conversation_hash=conv_data['conversation_hash'],
+            )
             # Convert enums to strings
             serializable_results = convert_enum_to_dict(raw_result)
             # Add conversation hash to results
@@ -80,7 +94,12 @@ async def process_conversation_batch(
     
     return batch_results
 
-async def process_all_conversations(conversations: List[Dict[str, Any]], classifier: Any, batch_size: int = 10):
+async def process_all_conversations(
+    conversations: List[Dict[str, Any]],
+    classifier: Any,
+    batch_size: int = 10,
+    conversation_timeout: float | None = None,
+):
     """Process all conversations in batches with progress bar."""
     all_results = []
     total_api_calls = 0
@@ -94,7 +113,8 @@ async def process_all_conversations(conversations: List[Dict[str, Any]], classif
             batch_results = await process_conversation_batch(
                 conversations=batch,
                 classifier=classifier,
-                batch_start_idx=batch_idx * batch_size
+                batch_start_idx=batch_idx * batch_size,
+                conversation_timeout=conversation_timeout,
             )
             
             all_results.extend(batch_results)
@@ -103,22 +123,65 @@ async def process_all_conversations(conversations: List[Dict[str, Any]], classif
     
     return all_results, total_api_calls
 
+def parse_args() -> argparse.Namespace:
+    """Parse arguments. Several workers can split the input with --num_shards/--shard_index and
+    share one RPM/TPM budget through the rate limiter state file."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", type=str, default="test_conversations.jsonl")
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default=None,
+        help="Defaults to classification_results.jsonl, or classification_results.<shard>-of-<num_shards>.jsonl.",
+    )
+    parser.add_argument(
+        "--dead_letter_path",
+        type=str,
+        default=None,
+        help="Where failed chunks are recorded for redrive_dead_letters.py. Defaults to <output_path>.dead_letters.jsonl.",
+    )
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--shard_index", type=int, default=0, help="Classify every num_shards-th conversation, from this one.")
+    parser.add_argument("--max_concurrent", type=int, default=50)
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute, shared by all workers.")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute, shared by all workers.")
+    parser.add_argument("--rate_limit_path", type=str, default=DEFAULT_STATE_PATH, help="Rate limiter state file.")
+    args = parser.parse_args()
+    assert 0 <= args.shard_index < args.num_shards, "--shard_index must be in [0, num_shards)"
+    if args.output_path is None:
+        if args.num_shards > 1:
+            args.output_path = f"classification_results.{args.shard_index}-of-{args.num_shards}.jsonl"
+        else:
+            args.output_path = "classification_results.jsonl"
+    if args.dead_letter_path is None:
+        args.dead_letter_path = args.output_path + ".dead_letters.jsonl"
+    return args
+
 async def main():
+    args = parse_args()
     # Load test conversations
     print("Loading conversations...")
     conversations = []
-    with open('test_conversations.jsonl', 'r') as f:
+    with open(args.input_path, 'r') as f:
         for line in f:
             conv_data = json.loads(line)
             conversations.append(conv_data)
+    conversations = conversations[args.shard_index::args.num_shards]
     
-    print(f"Loaded {len(conversations)} conversations")
+    print(f"Loaded {len(conversations)} conversations (shard {args.shard_index + 1} of {args.num_shards})")
     
     # Initialize model and classifier
+    usage_tracker = UsageTracker()
+    dead_letter_queue = dead_letter.enable(args.dead_letter_path)
+    rate_limiter = None
+    if args.rpm is not None or args.tpm is not None:
+        rate_limiter = SharedTokenBucket(rpm=args.rpm, tpm=args.tpm, path=args.rate_limit_path)
     model_wrapper = ModelWrapper(
         openai_client=openai.AsyncOpenAI(),
         model="gpt-4o-mini",
-        max_concurrent=50,
+        max_concurrent=args.max_concurrent,
+        usage_tracker=usage_tracker,
+        rate_limiter=rate_limiter,
     )
     
     classifiers = load_classifiers(
@@ -136,7 +199,7 @@ async def main():
     )
     
     # Save results
-    output_file = 'classification_results.jsonl'
+    output_file = args.output_path
     with open(output_file, 'w') as f:
         for result in all_results:
             f.write(json.dumps(result) + '\n')
@@ -145,6 +208,17 @@ async def main():
     print(f"Total API calls made: {total_api_calls}")
     print(f"Average API calls per conversation: {total_api_calls/len(conversations):.1f}")
     print(f"Results saved to {output_file}")
+    usage_tracker.save(output_file + ".usage.json")
+    usage_tracker.print_report()
+    dead_letter_queue.close()
+    if dead_letter_queue.num_letters:
+        print(
+            f"{dead_letter_queue.num_letters} failed chunks saved to {args.dead_letter_path};"
+            f" retry them with redrive_dead_letters.py --results_path {output_file} --layout chunk"
+        )
+    if rate_limiter is not None:
+        rate_limiter.print_report()
+        rate_limiter.close()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
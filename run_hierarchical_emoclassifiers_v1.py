@@ -6,6 +6,17 @@ from tqdm import tqdm
 import emoclassifiers.io_utils as io_utils
 import emoclassifiers.classification as classification
 import emoclassifiers.aggregation as aggregation
+import emoclassifiers.client_pool as client_pool
+import emoclassifiers.deadlines as deadlines
+import emoclassifiers.hedging as hedging
+import emoclassifiers.planning as planning
+import emoclassifiers.usage as usage
+import emoclassifiers.metrics as metrics
+import emoclassifiers.packing as packing
+import emoclassifiers.tracing as tracing
+import emoclassifiers.recording as recording
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.profiling as profiling
 
 
 async def run_classification_on_single_conversation(
@@ -14,15 +25,34 @@ async def run_classification_on_single_conversation(
     sub_classifiers: dict[str, classification.EmoClassifier],
     dependency_graph: dict,
     aggregator: aggregation.Aggregator,
+    gating_neighborhood: int | None = None,
 ) -> list[dict]:
+    """
+    If `gating_neighborhood` is set, the top-level classifiers must be localized (`localize`), and
+    sub-classifiers only classify the chunks within that many messages of the messages behind
+    their top-level classifiers' "yes" (all chunks if a "yes" came without message indices).
+    """
     top_level_futures_keys = []
     top_level_futures = []
     for top_level_classifier_name, top_level_classifier in top_level_classifiers.items():
-        top_level_futures.append(top_level_classifier.classify_conversation(conversation))
+        if gating_neighborhood is not None:
+            top_level_futures.append(top_level_classifier.classify_conversation_detailed(conversation))
+        else:
+            top_level_futures.append(top_level_classifier.classify_conversation(conversation))
         top_level_futures_keys.append({
             "classifier_name": top_level_classifier_name,
         })
-    top_level_raw_results = await asyncio.gather(*top_level_futures)
+    top_level_raw_results = await deadlines.gather_structured(top_level_futures)
+    top_level_detailed_results = {}
+    if gating_neighborhood is not None:
+        top_level_detailed_results = {
+            key["classifier_name"]: raw_result
+            for key, raw_result in zip(top_level_futures_keys, top_level_raw_results)
+        }
+        top_level_raw_results = [
+            {chunk_id: result.label for chunk_id, result in raw_result.items()}
+            for raw_result in top_level_raw_results
+        ]
     top_level_results = {
         key["classifier_name"]: aggregation.AnyAggregator.aggregate(raw_result)
         for key, raw_result in zip(top_level_futures_keys, top_level_raw_results)
@@ -34,19 +64,50 @@ async def run_classification_on_single_conversation(
         depends_on = dependency_graph[sub_classifier_name]
         if not any(top_level_results[dep] for dep in depends_on):
             continue
-        sub_futures.append(sub_classifier.classify_conversation(conversation))
+        chunk_ids = None
+        if gating_neighborhood is not None and sub_classifier.classifier_definition["chunker"] in packing.PACKABLE_CHUNKERS:
+            # Chunk ids of per-message chunkers are the indices of their target messages.
+            chunk_ids = classification.get_neighborhood_chunk_ids(
+                [top_level_detailed_results[dep] for dep in depends_on],
+                radius=gating_neighborhood,
+            )
+        if aggregator.requires_detailed_results:
+            sub_futures.append(sub_classifier.classify_conversation_detailed(conversation, chunk_ids=chunk_ids))
+        else:
+            sub_futures.append(sub_classifier.classify_conversation(conversation, chunk_ids=chunk_ids))
         sub_futures_keys.append({
             "classifier_name": sub_classifier_name,
         })
-    sub_level_raw_results = await asyncio.gather(*sub_futures)
+    sub_level_raw_results = await deadlines.gather_structured(sub_futures)
     sub_level_results = {
         key["classifier_name"]: aggregator.aggregate(raw_result)
         for key, raw_result in zip(sub_futures_keys, sub_level_raw_results)
     }
-    return {
+    metrics.CONVERSATIONS.inc()
+    result = {
         "top_level": top_level_results,
         "sub_level": sub_level_results,
     }
+    if gating_neighborhood is not None:
+        # Messages behind each top-level "yes".
+        result["trigger_indices"] = {
+            name: sorted({idx for chunk_result in raw_result.values() for idx in chunk_result.message_indices or []})
+            for name, raw_result in top_level_detailed_results.items()
+            if top_level_results[name]
+        }
+    # Classifiers with chunks cut off by the deadline or a request timeout.
+    timed_out = [
+        key["classifier_name"]
+        for key, raw_result in zip(
+            top_level_futures_keys + sub_futures_keys,
+            list(top_level_raw_results) + list(sub_level_raw_results),
+        )
+        if classification.get_timed_out_chunk_ids(raw_result)
+    ]
+    if timed_out:
+        metrics.TIMED_OUT_CONVERSATIONS.inc()
+        result["timed_out"] = timed_out
+    return result
 
 
 async def run_classification(
@@ -55,7 +116,15 @@ async def run_classification(
     sub_classifiers: dict[str, classification.EmoClassifier],
     dependency_graph: dict,
     aggregator: aggregation.Aggregator,
+    usage_tracker: usage.UsageTracker | None = None,
+    conversation_timeout: float | None = None,
+    gating_neighborhood: int | None = None,
 ) -> list[dict]:
+    """
+    Each conversation must complete within `conversation_timeout` seconds of being started;
+    classifiers cut off by it are listed under "timed_out" and score as negative.
+    Conversations cut off by the budget of `usage_tracker` are returned as None.
+    """
     print(
         f"Running {len(conversation_list)} conversations"
         f" with {len(top_level_classifiers)} top-level classifiers"
@@ -72,18 +141,37 @@ async def run_classification(
     for i in range(0, len(conversation_list), batch_size):
         batch = conversation_list[i:i + batch_size]
         futures = [
-            run_classification_on_single_conversation(
-                conversation=conversation,
-                top_level_classifiers=top_level_classifiers,
-                sub_classifiers=sub_classifiers,
-                dependency_graph=dependency_graph,
-                aggregator=aggregator,
+            tracing.traced_conversation(
+                scheduling.with_flow(
+                    deadlines.with_deadline(
+                        run_classification_on_single_conversation(
+                            conversation=conversation,
+                            top_level_classifiers=top_level_classifiers,
+                            sub_classifiers=sub_classifiers,
+                            dependency_graph=dependency_graph,
+                            aggregator=aggregator,
+                            gating_neighborhood=gating_neighborhood,
+                        ),
+                        timeout=conversation_timeout,
+                    ),
+                    flow=f"conversation {conversation_id}",
+                ),
+                name=f"conversation {conversation_id}",
             )
-            for conversation in batch
+            for conversation_id, conversation in enumerate(batch, start=i)
         ]
-        batch_results = await asyncio.gather(*futures)
-        results.extend(batch_results)
+        batch_results = await asyncio.gather(*futures, return_exceptions=True)
+        for batch_result in batch_results:
+            if isinstance(batch_result, usage.BudgetExceededError):
+                batch_result = None
+            elif isinstance(batch_result, BaseException):
+                raise batch_result
+            results.append(batch_result)
         pbar.update(len(batch))
+        if usage_tracker is not None and usage_tracker.exhausted:
+            # Stop dispatching; the remaining conversations are saved as None.
+            results.extend([None] * (len(conversation_list) - len(results)))
+            break
     
     pbar.close()
     return results
@@ -94,34 +182,190 @@ def main():
     parser.add_argument("--input_path", type=str, required=True)
     parser.add_argument("--output_path", type=str, required=True)
     parser.add_argument("--aggregation_mode", type=str, default="any")
-    args = parser.parse_args()
-    conversation_list = io_utils.load_jsonl(args.input_path)
-    model_wrapper = classification.ModelWrapper(
-        openai_client=openai.AsyncOpenAI(),
-        model="gpt-4o-mini",
-        max_concurrent=50,
+    parser.add_argument(
+        "--top_level_max_tokens",
+        type=int,
+        default=None,
+        help="If set, split top-level (whole conversation) chunks into windows under this token estimate.",
+    )
+    parser.add_argument(
+        "--gating_neighborhood",
+        type=int,
+        default=None,
+        help="If set, top-level classifiers also return the messages behind a \"yes\", and sub-classifiers"
+        " only classify chunks within this many messages of them.",
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="fifo",
+        choices=list(scheduling.SCHEDULER_DICT),
+        help="fair: gating classifiers first, then fair sharing across classifier sets and conversations.",
+    )
+    parser.add_argument("--request_timeout", type=float, default=None, help="Timeout (s) per request, including retries.")
+    parser.add_argument(
+        "--hedge_percentile",
+        type=float,
+        default=None,
+        help="Send a duplicate of requests slower than this percentile of recent latency and use the first answer.",
+    )
+    parser.add_argument("--max_hedge_rate", type=float, default=0.05, help="Maximum fraction of requests hedged.")
+    parser.add_argument(
+        "--endpoints_path",
+        type=str,
+        default=None,
+        help="JSON list of endpoints (see emoclassifiers/client_pool.py) to balance requests across.",
+    )
+    parser.add_argument(
+        "--conversation_timeout",
+        type=float,
+        default=None,
+        help="Deadline (s) per conversation. Unfinished classifiers are listed under \"timed_out\" in the output.",
     )
-    top_level_classifiers = classification.load_classifiers(
-        classifier_set="v1_top_level",
-        model_wrapper=model_wrapper,
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Hard budget (USD). Once projected spend exceeds it, no more requests are sent.",
     )
-    sub_classifiers = classification.load_classifiers(
-        classifier_set="v1",
-        model_wrapper=model_wrapper,
+    parser.add_argument("--metrics_sink", type=str, default=None, choices=list(metrics.SINK_DICT))
+    parser.add_argument(
+        "--metrics_target",
+        type=str,
+        default="metrics.prom",
+        help="Output file, or port (or host:port) for prometheus_http.",
     )
+    parser.add_argument("--metrics_interval", type=float, default=15.0)
+    parser.add_argument("--trace_path", type=str, default=None, help="Save a Chrome trace-event JSON here.")
+    parser.add_argument("--trace_sample_rate", type=float, default=0.01)
+    parser.add_argument(
+        "--record_path",
+        type=str,
+        default=None,
+        help="Save a record of every request (JSONL), for replay with benchmarks/replay_workload.py.",
+    )
+    parser.add_argument(
+        "--loop_lag_threshold",
+        type=float,
+        default=None,
+        help="If set, monitor event loop lag and record the stack of stalls longer than this (s).",
+    )
+    parser.add_argument("--profile_stages", type=str, nargs="+", default=None, choices=profiling.STAGES)
+    parser.add_argument("--dry_run", action="store_true", help="Only forecast calls, tokens, cost and time.")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute limit, for the dry run forecast.")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute limit, for the dry run forecast.")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mean request latency (s), for the dry run forecast.")
+    args = parser.parse_args()
+    conversation_list = io_utils.load_jsonl(args.input_path)
+    top_level_definitions = classification.load_classifier_definitions(classifier_set="v1_top_level")
+    if args.top_level_max_tokens is not None:
+        budgeted_chunker = {"chunker": "whole_budgeted", "chunker_kwargs": {"max_tokens": args.top_level_max_tokens}}
+        top_level_definitions = {
+            name: {**definition, **budgeted_chunker} if definition["chunker"] == "whole" else definition
+            for name, definition in top_level_definitions.items()
+        }
+    sub_definitions = classification.load_classifier_definitions(classifier_set="v1")
     dependency_graph = io_utils.load_json(io_utils.get_path(
         "assets/definitions/emoclassifiers_v1_dependency.json"
     ))["dependency"]
+    if args.dry_run:
+        plan = planning.plan_run(
+            conversation_list=conversation_list,
+            classifier_definitions=top_level_definitions,
+            model="gpt-4o-mini",
+            gated_definitions=sub_definitions,
+            dependency_graph=dependency_graph,
+            localize=args.gating_neighborhood is not None,
+            gating_neighborhood=args.gating_neighborhood,
+        )
+        plan.print_report(max_concurrent=50, latency=args.latency, rpm=args.rpm, tpm=args.tpm)
+        return
+    usage_tracker = usage.UsageTracker(budget=args.budget)
+    pool = None
+    if args.endpoints_path is not None:
+        pool = client_pool.load_client_pool(args.endpoints_path)
+    hedging_policy = None
+    if args.hedge_percentile is not None:
+        hedging_policy = hedging.HedgingPolicy(percentile=args.hedge_percentile, max_hedge_rate=args.max_hedge_rate)
+    if args.trace_path is not None:
+        tracing.enable(sample_rate=args.trace_sample_rate)
+    if args.record_path is not None:
+        recording.enable()
+    if args.profile_stages is not None:
+        profiling.enable_profiler(args.profile_stages)
+    loop_lag_monitor = None
+    if args.loop_lag_threshold is not None:
+        loop_lag_monitor = profiling.LoopLagMonitor(stall_threshold=args.loop_lag_threshold)
+    metrics_sink = None
+    if args.metrics_sink is not None:
+        metrics_sink = metrics.start_sink(args.metrics_sink, args.metrics_target, args.metrics_interval)
+    model_wrapper = classification.ModelWrapper(
+        openai_client=openai.AsyncOpenAI() if pool is None else None,
+        model="gpt-4o-mini",
+        max_concurrent=pool.max_concurrent if pool is not None else 50,
+        scheduler=args.scheduler,
+        usage_tracker=usage_tracker,
+        request_timeout=args.request_timeout,
+        hedging_policy=hedging_policy,
+        client_pool=pool,
+    )
+    top_level_classifiers = {
+        name: classification.EmoClassifier(
+            classifier_definition=definition,
+            model_wrapper=model_wrapper,
+            localize=args.gating_neighborhood is not None,
+        )
+        for name, definition in top_level_definitions.items()
+    }
+    sub_classifiers = {
+        name: classification.EmoClassifier(classifier_definition=definition, model_wrapper=model_wrapper)
+        for name, definition in sub_definitions.items()
+    }
     aggregator = aggregation.AGGREGATOR_DICT[args.aggregation_mode]
-    result = asyncio.run(run_classification(
-        conversation_list=conversation_list,
-        top_level_classifiers=top_level_classifiers,
-        sub_classifiers=sub_classifiers,
-        dependency_graph=dependency_graph,
-        aggregator=aggregator,
+    result = asyncio.run(profiling.run_monitored(
+        client_pool.with_client_pool(
+            run_classification(
+                conversation_list=conversation_list,
+                top_level_classifiers=top_level_classifiers,
+                sub_classifiers=sub_classifiers,
+                dependency_graph=dependency_graph,
+                aggregator=aggregator,
+                usage_tracker=usage_tracker,
+                conversation_timeout=args.conversation_timeout,
+                gating_neighborhood=args.gating_neighborhood,
+            ),
+            pool,
+        ),
+        monitor=loop_lag_monitor,
     ))
     io_utils.save_jsonl(result, args.output_path)
     print(f"Saved results to {args.output_path}")
+    usage_tracker.save(
+        args.output_path + ".usage.json",
+        incomplete_conversation_ids=[i for i, conversation_result in enumerate(result) if conversation_result is None],
+    )
+    usage_tracker.print_report()
+    if pool is not None:
+        pool.print_report()
+    if hedging_policy is not None:
+        hedging_policy.print_report()
+    num_timed_out = sum(conversation_result is not None and "timed_out" in conversation_result for conversation_result in result)
+    if num_timed_out:
+        print(f"{num_timed_out} conversations timed out (see \"timed_out\" in the results)")
+    if metrics_sink is not None:
+        metrics_sink.stop()
+    if args.trace_path is not None:
+        tracing.TRACER.save(args.trace_path)
+        print(f"Saved trace to {args.trace_path}")
+    if args.record_path is not None:
+        recording.RECORDER.save(args.record_path)
+        print(f"Saved {len(recording.RECORDER.records)} request records to {args.record_path}")
+    if loop_lag_monitor is not None:
+        loop_lag_monitor.save(args.output_path + ".loop_lag.json")
+        print(f"Max event loop lag: {loop_lag_monitor.max_lag:.3f}s, {len(loop_lag_monitor.stalls)} stalls")
+    if args.profile_stages is not None:
+        profiling.PROFILER.save(args.output_path + ".profile")
+        print(f"Saved profile to {args.output_path}.profile.txt")
 
 
 if __name__ == "__main__":
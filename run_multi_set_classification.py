@@ -0,0 +1,399 @@
+"""
+Run several classifier sets over the same conversations in one pass, e.g.
+
+    python run_multi_set_classification.py --classifier_sets v1_top_level v1 question_tree intent \
+        --input_path test_conversations.jsonl --output_path multi_set_results.jsonl
+
+Each conversation is read once and chunked once per chunker (see `chunking.ChunkPlan`): classifiers
+of any set using the same chunker share the chunks and their rendered strings. All requests go
+through one model wrapper, so the sets share its concurrency slots (fairly, by set, with the fair
+scheduler), usage budget, and rate limits. When both v1_top_level and v1 are selected, the v1
+classifiers are gated by the top-level results, as in run_hierarchical_emoclassifiers_v1.py.
+
+Every conversation gets one record with its "conversation_hash" (if the input rows have one) and a
+result per set: yes/no classifiers are aggregated (--aggregation_mode), other labels (e.g.
+question_tree) are kept per chunk id. Classifiers with chunks cut off by the conversation deadline
+are listed under "timed_out" as "<set>/<classifier>".
+"""
+
+import argparse
+import asyncio
+import openai
+from tqdm import tqdm
+
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.classification as classification
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.chunking as chunking
+import emoclassifiers.client_pool as client_pool
+import emoclassifiers.dead_letter as dead_letter
+import emoclassifiers.deadlines as deadlines
+import emoclassifiers.metrics as metrics
+import emoclassifiers.packing as packing
+import emoclassifiers.rate_limiting as rate_limiting
+import emoclassifiers.scheduling as scheduling
+import emoclassifiers.tracing as tracing
+import emoclassifiers.usage as usage
+
+# Classifier sets gated by another set when both are selected: set -> (gating set, dependency graph path).
+GATED_SET_DICT = {
+    "v1": ("v1_top_level", "assets/definitions/emoclassifiers_v1_dependency.json"),
+}
+
+
+def get_labels(raw_result: dict) -> dict:
+    """
+    Labels of (detailed or plain) classification results.
+    """
+    return {
+        chunk_id: result.label if isinstance(result, classification.ChunkClassification) else result
+        for chunk_id, result in raw_result.items()
+    }
+
+
+def format_set_result(
+    classifier: classification.EmoClassifier,
+    raw_result: dict,
+    aggregator: aggregation.Aggregator,
+):
+    """
+    Aggregate yes/no results, and keep other labels by chunk id.
+    """
+    if classification.get_label_enum(classifier.classifier_definition) is classification.YesNoUnsureEnum:
+        return aggregator.aggregate(raw_result if aggregator.requires_detailed_results else get_labels(raw_result))
+    return {str(chunk_id): label.value for chunk_id, label in get_labels(raw_result).items()}
+
+
+async def classify_set(
+    conversation: list[dict],
+    chunk_plan: chunking.ChunkPlan,
+    classifiers: dict[str, classification.EmoClassifier],
+    detailed: bool,
+    chunk_ids: dict[str, set[int] | None] | None = None,
+) -> dict[str, dict]:
+    """
+    Raw results of a classifier set, by classifier. `chunk_ids` optionally restricts the chunks
+    of each classifier.
+    """
+    chunk_ids = chunk_ids or {}
+    if detailed:
+        coroutines = [
+            classifier.classify_conversation_detailed(conversation, chunk_plan=chunk_plan, chunk_ids=chunk_ids.get(name))
+            for name, classifier in classifiers.items()
+        ]
+    else:
+        coroutines = [
+            classifier.classify_conversation(conversation, chunk_plan=chunk_plan, chunk_ids=chunk_ids.get(name))
+            for name, classifier in classifiers.items()
+        ]
+    return dict(zip(classifiers, await deadlines.gather_structured(coroutines)))
+
+
+async def classify_gated_sets(
+    conversation: list[dict],
+    chunk_plan: chunking.ChunkPlan,
+    gating_classifiers: dict[str, classification.EmoClassifier],
+    gated_classifiers: dict[str, classification.EmoClassifier],
+    dependency_graph: dict,
+    detailed: bool,
+    gating_neighborhood: int | None = None,
+) -> tuple[dict[str, dict], dict[str, dict]]:
+    """
+    Raw results of a gating set, then of the classifiers of the gated set it enables. With
+    `gating_neighborhood` (and localized gating classifiers), the enabled classifiers only
+    classify the chunks near the messages behind the "yes" of their gating classifiers.
+    """
+    gating_raw_results = await classify_set(
+        conversation, chunk_plan, gating_classifiers, detailed=gating_neighborhood is not None,
+    )
+    gating_results = {
+        name: aggregation.AnyAggregator.aggregate(get_labels(raw_result))
+        for name, raw_result in gating_raw_results.items()
+    }
+    enabled_classifiers = {
+        name: classifier
+        for name, classifier in gated_classifiers.items()
+        if any(gating_results[dep] for dep in dependency_graph[name])
+    }
+    chunk_ids = {}
+    if gating_neighborhood is not None:
+        chunk_ids = {
+            name: classification.get_neighborhood_chunk_ids(
+                [gating_raw_results[dep] for dep in dependency_graph[name]],
+                radius=gating_neighborhood,
+            )
+            for name, classifier in enabled_classifiers.items()
+            if classifier.classifier_definition["chunker"] in packing.PACKABLE_CHUNKERS
+        }
+    gated_raw_results = await classify_set(
+        conversation, chunk_plan, enabled_classifiers, detailed=detailed, chunk_ids=chunk_ids,
+    )
+    return gating_raw_results, gated_raw_results
+
+
+async def run_classification_on_single_conversation(
+    row: dict | list,
+    classifier_sets: dict[str, dict[str, classification.EmoClassifier]],
+    dependency_graphs: dict[str, dict],
+    aggregator: aggregation.Aggregator,
+    gating_neighborhood: int | None = None,
+) -> dict:
+    """
+    Classify a conversation with every set. Input rows are either conversations, or records
+    with "conversation" and "conversation_hash". See `classify_gated_sets` for `gating_neighborhood`.
+    """
+    conversation = row["conversation"] if isinstance(row, dict) else row
+    chunk_plan = chunking.ChunkPlan(conversation)
+    detailed = aggregator.requires_detailed_results
+    gated_sets = {
+        set_name: GATED_SET_DICT[set_name][0]
+        for set_name in classifier_sets
+        if set_name in dependency_graphs
+    }
+    independent_sets = [
+        set_name for set_name in classifier_sets
+        if set_name not in gated_sets and set_name not in gated_sets.values()
+    ]
+    coroutines = [
+        classify_set(conversation, chunk_plan, classifier_sets[set_name], detailed=detailed)
+        for set_name in independent_sets
+    ] + [
+        classify_gated_sets(
+            conversation,
+            chunk_plan,
+            gating_classifiers=classifier_sets[gating_set],
+            gated_classifiers=classifier_sets[set_name],
+            dependency_graph=dependency_graphs[set_name],
+            detailed=detailed,
+            gating_neighborhood=gating_neighborhood,
+        )
+        for set_name, gating_set in gated_sets.items()
+    ]
+    outcomes = await deadlines.gather_structured(coroutines)
+    raw_results = dict(zip(independent_sets, outcomes))
+    for (set_name, gating_set), (gating_raw_results, gated_raw_results) in zip(
+        gated_sets.items(), outcomes[len(independent_sets):]
+    ):
+        raw_results[gating_set] = gating_raw_results
+        raw_results[set_name] = gated_raw_results
+
+    result = {}
+    if isinstance(row, dict) and "conversation_hash" in row:
+        result["conversation_hash"] = row["conversation_hash"]
+    timed_out = []
+    # Keep the order of the sets on the command line.
+    for set_name, classifiers in classifier_sets.items():
+        # Gating sets are aggregated with `any`, as they were for gating.
+        set_aggregator = aggregation.AnyAggregator if set_name in gated_sets.values() else aggregator
+        result[set_name] = {
+            name: format_set_result(classifiers[name], raw_result, set_aggregator)
+            for name, raw_result in raw_results[set_name].items()
+        }
+        timed_out += [
+            f"{set_name}/{name}"
+            for name, raw_result in raw_results[set_name].items()
+            if classification.get_timed_out_chunk_ids(raw_result)
+        ]
+    metrics.CONVERSATIONS.inc()
+    if timed_out:
+        metrics.TIMED_OUT_CONVERSATIONS.inc()
+        result["timed_out"] = timed_out
+    return result
+
+
+async def run_classification(
+    conversation_list: list,
+    classifier_sets: dict[str, dict[str, classification.EmoClassifier]],
+    dependency_graphs: dict[str, dict],
+    aggregator: aggregation.Aggregator,
+    usage_tracker: usage.UsageTracker | None = None,
+    conversation_timeout: float | None = None,
+    batch_size: int = 10,
+    gating_neighborhood: int | None = None,
+) -> list[dict]:
+    """
+    Each conversation must complete within `conversation_timeout` seconds of being started.
+    Conversations cut off by the budget of `usage_tracker` are returned as None.
+    """
+    print(
+        f"Running {len(conversation_list)} conversations with "
+        + ", ".join(f"{len(classifiers)} {set_name} classifiers" for set_name, classifiers in classifier_sets.items())
+    )
+    pbar = tqdm(total=len(conversation_list), desc="Processing conversations")
+    results = []
+    for i in range(0, len(conversation_list), batch_size):
+        batch = conversation_list[i:i + batch_size]
+        futures = []
+        for conversation_id, row in enumerate(batch, start=i):
+            future = deadlines.with_deadline(
+                run_classification_on_single_conversation(
+                    row=row,
+                    classifier_sets=classifier_sets,
+                    dependency_graphs=dependency_graphs,
+                    aggregator=aggregator,
+                    gating_neighborhood=gating_neighborhood,
+                ),
+                timeout=conversation_timeout,
+            )
+            if isinstance(row, dict) and "conversation_hash" in row:
+                future = dead_letter.with_conversation(future, conversation_hash=row["conversation_hash"])
+            future = scheduling.with_flow(future, flow=f"conversation {conversation_id}")
+            futures.append(tracing.traced_conversation(future, name=f"conversation {conversation_id}"))
+        batch_results = await asyncio.gather(*futures, return_exceptions=True)
+        for batch_result in batch_results:
+            if isinstance(batch_result, usage.BudgetExceededError):
+                batch_result = None
+            elif isinstance(batch_result, BaseException):
+                raise batch_result
+            results.append(batch_result)
+        pbar.update(len(batch))
+        if usage_tracker is not None and usage_tracker.exhausted:
+            # Stop dispatching; the remaining conversations are saved as None.
+            results.extend([None] * (len(conversation_list) - len(results)))
+            break
+    pbar.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify conversations with several classifier sets in one pass.")
+    parser.add_argument(
+        "--classifier_sets",
+        type=str,
+        nargs="+",
+        required=True,
+        choices=list(classification.CLASSIFIER_DEFINITION_PATH_DICT),
+    )
+    parser.add_argument("--input_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--model", type=str, default="gpt-4o-mini")
+    parser.add_argument("--max_concurrent", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=10, help="Conversations classified at a time.")
+    parser.add_argument("--aggregation_mode", type=str, default="any", choices=list(aggregation.AGGREGATOR_DICT))
+    parser.add_argument(
+        "--packed_token_budget",
+        type=int,
+        default=None,
+        help="If set, classify the chunks of per-message classifiers in packed requests under this token estimate.",
+    )
+    parser.add_argument(
+        "--gating_neighborhood",
+        type=int,
+        default=None,
+        help="If set, gating classifiers (v1_top_level for v1) also return the messages behind a \"yes\","
+        " and gated classifiers only classify chunks within this many messages of them.",
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="fifo",
+        choices=list(scheduling.SCHEDULER_DICT),
+        help="fair: gating classifiers first, then fair sharing across classifier sets and conversations.",
+    )
+    parser.add_argument("--request_timeout", type=float, default=None, help="Timeout (s) per request, including retries.")
+    parser.add_argument(
+        "--conversation_timeout",
+        type=float,
+        default=None,
+        help="Deadline (s) per conversation. Unfinished classifiers are listed under \"timed_out\" in the output.",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Hard budget (USD). Once projected spend exceeds it, no more requests are sent.",
+    )
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute, shared by all workers.")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute, shared by all workers.")
+    parser.add_argument(
+        "--rate_limit_path",
+        type=str,
+        default=rate_limiting.DEFAULT_STATE_PATH,
+        help="Rate limiter state file.",
+    )
+    parser.add_argument(
+        "--endpoints_path",
+        type=str,
+        default=None,
+        help="JSON list of endpoints (see emoclassifiers/client_pool.py) to balance requests across.",
+    )
+    parser.add_argument(
+        "--dead_letter_path",
+        type=str,
+        default=None,
+        help="If set, record failed chunks here (for redrive_dead_letters.py) instead of failing their conversation.",
+    )
+    args = parser.parse_args()
+    # Drop repeated sets, keeping the command line order.
+    set_names = list(dict.fromkeys(args.classifier_sets))
+
+    conversation_list = io_utils.load_jsonl(args.input_path)
+    usage_tracker = usage.UsageTracker(budget=args.budget)
+    pool = None
+    if args.endpoints_path is not None:
+        pool = client_pool.load_client_pool(args.endpoints_path)
+    rate_limiter = None
+    if args.rpm is not None or args.tpm is not None:
+        rate_limiter = rate_limiting.SharedTokenBucket(rpm=args.rpm, tpm=args.tpm, path=args.rate_limit_path)
+    if args.dead_letter_path is not None:
+        dead_letter.enable(args.dead_letter_path)
+    model_wrapper = classification.ModelWrapper(
+        openai_client=openai.AsyncOpenAI() if pool is None else None,
+        model=args.model,
+        max_concurrent=pool.max_concurrent if pool is not None else args.max_concurrent,
+        scheduler=args.scheduler,
+        usage_tracker=usage_tracker,
+        request_timeout=args.request_timeout,
+        client_pool=pool,
+        rate_limiter=rate_limiter,
+    )
+    dependency_graphs = {
+        set_name: io_utils.load_json(io_utils.get_path(dependency_path))["dependency"]
+        for set_name, (gating_set, dependency_path) in GATED_SET_DICT.items()
+        if set_name in set_names and gating_set in set_names
+    }
+    gating_sets = {GATED_SET_DICT[set_name][0] for set_name in dependency_graphs}
+    classifier_sets = {
+        set_name: classification.load_classifiers(
+            classifier_set=set_name,
+            model_wrapper=model_wrapper,
+            packed_token_budget=args.packed_token_budget,
+            localize=args.gating_neighborhood is not None and set_name in gating_sets,
+        )
+        for set_name in set_names
+    }
+    result = asyncio.run(client_pool.with_client_pool(
+        run_classification(
+            conversation_list=conversation_list,
+            classifier_sets=classifier_sets,
+            dependency_graphs=dependency_graphs,
+            aggregator=aggregation.AGGREGATOR_DICT[args.aggregation_mode],
+            usage_tracker=usage_tracker,
+            conversation_timeout=args.conversation_timeout,
+            batch_size=args.batch_size,
+            gating_neighborhood=args.gating_neighborhood,
+        ),
+        pool,
+    ))
+    io_utils.save_jsonl(result, args.output_path)
+    print(f"Saved results to {args.output_path}")
+    usage_tracker.save(
+        args.output_path + ".usage.json",
+        incomplete_conversation_ids=[i for i, conversation_result in enumerate(result) if conversation_result is None],
+    )
+    usage_tracker.print_report()
+    if pool is not None:
+        pool.print_report()
+    if rate_limiter is not None:
+        rate_limiter.print_report()
+        rate_limiter.close()
+    if dead_letter.DEAD_LETTER_QUEUE is not None:
+        dead_letter.DEAD_LETTER_QUEUE.close()
+        print(f"{dead_letter.DEAD_LETTER_QUEUE.num_letters} chunks failed (see {args.dead_letter_path})")
+    num_timed_out = sum(conversation_result is not None and "timed_out" in conversation_result for conversation_result in result)
+    if num_timed_out:
+        print(f"{num_timed_out} conversations timed out (see \"timed_out\" in the results)")
+
+
+if __name__ == "__main__":
+    main()
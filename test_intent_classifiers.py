@@ -3,8 +3,11 @@ import json
 from pathlib import Path
 from typing import List, Dict, Any
 from tqdm import tqdm
-from emoclassifiers.classification import load_classifiers, ModelWrapper, YesNoUnsureEnum
+from emoclassifiers.classification import load_classifiers, ModelWrapper
+from emoclassifiers.usage import UsageTracker
+import emoclassifiers.dead_letter as dead_letter
 from collections import defaultdict
+from enum import Enum
 """
 This script classifies the intent of the user's questions in the conversation.
 It uses the intent classifiers defined in the definitions/intent_classifiers_definition.json file.
@@ -78,7 +81,7 @@ class APICallCounter:
 
 def format_result(result):
     """Format the classification result consistently."""
-    if isinstance(result, YesNoUnsureEnum):
+    if isinstance(result, Enum):
         return result.value
     return str(result)
 
@@ -94,9 +97,14 @@ async def process_conversation(
     
     for intent_type, classifier in classifiers.items():
         try:
-            classification_results = await classifier.classify_conversation(conversation)
+            classification_results = await dead_letter.with_conversation(
+                classifier.classify_conversation(conversation),
+                conversation_hash=conversation_hash,
+            )
             api_counter.increment(intent_type)
             results[intent_type] = format_result(classification_results[0])
+            if results[intent_type] == "error":
+                api_counter.increment_error(intent_type)
         except Exception as e:
             print(f"\nError processing {intent_type} for message: {user_message[:100]}...")
             print(f"Error: {str(e)}")
@@ -111,13 +119,15 @@ async def process_conversation(
 async def process_jsonl_file(
     file_path: str,
     batch_size: int = 5,
-    max_concurrent: int = 3
+    max_concurrent: int = 3,
+    usage_tracker: UsageTracker | None = None
 ) -> List[Dict[str, Any]]:
     """Process a JSONL file in parallel batches."""
     # Initialize the model wrapper and API counter
     model_wrapper = ModelWrapper(
         model="gpt-4o-mini",  # or your preferred model
-        max_concurrent=50
+        max_concurrent=50,
+        usage_tracker=usage_tracker
     )
     api_counter = APICallCounter()
     
@@ -171,17 +181,22 @@ async def process_jsonl_file(
 async def main():
     # Process the JSONL file
     file_path = "input_data/questions_first_turn_only.jsonl"
-    results = await process_jsonl_file(file_path)
-    
-    # Save results to a new JSONL file
     output_path = "output_data/intent_classifications.jsonl"
     Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    # Failed requests are labeled "error" and saved for redrive_dead_letters.py
+    dead_letter_queue = dead_letter.enable(output_path + ".dead_letters.jsonl")
+    usage_tracker = UsageTracker()
+    results = await process_jsonl_file(file_path, usage_tracker=usage_tracker)
+    dead_letter_queue.close()
     
+    # Save results to a new JSONL file
     with open(output_path, 'w', encoding='utf-8') as f:
         for result in results:
             json.dump(result, f, ensure_ascii=False)
             f.write('\n')
     
+    usage_tracker.save(output_path + ".usage.json")
+    usage_tracker.print_report()
     print(f"\nResults saved to {output_path}")
 
 if __name__ == "__main__":
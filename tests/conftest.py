@@ -0,0 +1,40 @@
+"""
+Shared fixtures: tests run the pipeline against the in-process mock backend (no API calls).
+"""
+
+import pytest
+
+import emoclassifiers.metrics as metrics
+import emoclassifiers.mock_backend as mock_backend
+
+CONVERSATION = [
+    {"role": "user", "content": "hi"},
+    {"role": "assistant", "content": "Hello! How can I help you today?"},
+    {"role": "user", "content": "Why do I always feel so lonely in the evenings?"},
+    {"role": "assistant", "content": "That sounds hard. Evenings can feel quiet after a busy day."},
+    {"role": "user", "content": "thanks"},
+    {"role": "assistant", "content": "You're welcome. I'm here whenever you want to talk."},
+    {"role": "user", "content": "Can you tell me what you think of me?"},
+    {"role": "assistant", "content": "I think you are thoughtful and kind."},
+]
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.METRICS.reset()
+
+
+@pytest.fixture
+def conversation() -> list[dict]:
+    return [dict(message) for message in CONVERSATION]
+
+
+@pytest.fixture
+def mock_client():
+    """
+    An openai client backed by an instant mock backend, without client retries, and the backend.
+    """
+    return mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0),
+        max_retries=0,
+    )
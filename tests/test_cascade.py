@@ -0,0 +1,76 @@
+import asyncio
+
+import emoclassifiers.cascade as cascade
+import emoclassifiers.classification as classification
+import emoclassifiers.mock_backend as mock_backend
+
+
+def get_tier(model: str, **config) -> tuple[classification.ModelWrapper, mock_backend.MockBackend]:
+    client, backend = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0, **config),
+        max_retries=0,
+    )
+    return classification.ModelWrapper(openai_client=client, model=model, request_logprobs=True), backend
+
+
+DEFINITION = classification.load_classifier_definitions("v2")["share_emotions"]
+NAME = classification.get_classifier_name(DEFINITION)
+
+
+def classify(model_wrapper, conversation: list[dict]) -> dict[int, classification.ChunkClassification]:
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=model_wrapper)
+    return asyncio.run(classifier.classify_conversation_detailed(conversation))
+
+
+def test_confident_answers_stay_on_the_first_tier(conversation):
+    small, small_backend = get_tier("small", label_weights={"unsure": 0.0})
+    large, large_backend = get_tier("large")
+    model_wrapper = cascade.CascadeModelWrapper([small, large])
+    results = classify(model_wrapper, conversation)
+
+    assert {result.model for result in results.values()} == {"small"}
+    assert small_backend.stats["requests"] == len(results)
+    assert large_backend.stats["requests"] == 0
+    assert model_wrapper.report()[0]["escalation_rate"] == 0.0
+
+
+def test_unsure_answers_escalate(conversation):
+    small, small_backend = get_tier("small", label_weights={"yes": 0.0, "no": 0.0})
+    large, large_backend = get_tier("large")
+    model_wrapper = cascade.CascadeModelWrapper([small, large])
+    results = classify(model_wrapper, conversation)
+
+    assert {result.model for result in results.values()} == {"large"}
+    assert small_backend.stats["requests"] == large_backend.stats["requests"] == len(results)
+    small_report, large_report = model_wrapper.report()
+    assert small_report["escalation_rate"] == 1.0
+    assert small_report["by_classifier"][NAME]["escalations"] == {"unsure": len(results)}
+    # The last tier's answer is always accepted.
+    assert large_report["calls"] == len(results)
+    assert large_report["escalations"] == 0
+
+
+def test_low_confidence_and_label_escalation(conversation):
+    small, _ = get_tier("small", label_weights={"unsure": 0.0}, label_confidence=0.6)
+    large, large_backend = get_tier("large")
+    model_wrapper = cascade.CascadeModelWrapper([small, large], default_policy=cascade.EscalationPolicy(min_probability=0.9))
+    results = classify(model_wrapper, conversation)
+    assert large_backend.stats["requests"] == len(results)
+    assert model_wrapper.report()[0]["by_classifier"][NAME]["escalations"] == {"low_confidence": len(results)}
+
+    small, _ = get_tier("small", label_weights={"no": 0.0, "unsure": 0.0})
+    large, large_backend = get_tier("large")
+    model_wrapper = cascade.CascadeModelWrapper(
+        [small, large],
+        policies={NAME: cascade.EscalationPolicy(escalate_labels=["yes"])},
+    )
+    results = classify(model_wrapper, conversation)
+    assert large_backend.stats["requests"] == len(results)
+    assert model_wrapper.report()[0]["by_classifier"][NAME]["escalations"] == {"label": len(results)}
+
+
+def test_tier_latencies_are_bounded():
+    stats = cascade.TierStats("small", reservoir_size=3)
+    stats.latencies.extend([1.0, 2.0, 3.0, 4.0])
+    assert list(stats.latencies) == [2.0, 3.0, 4.0]
+    assert stats.report()["latency_p50"] == 3.0
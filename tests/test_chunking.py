@@ -0,0 +1,190 @@
+import asyncio
+import json
+
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.chunking as chunking
+import emoclassifiers.classification as classification
+import emoclassifiers.compression as compression
+import emoclassifiers.mock_backend as mock_backend
+import run_multi_set_classification
+from emoclassifiers.chunking import CHUNKER_DICT, estimate_num_tokens
+
+
+def get_long_conversation(num_messages: int = 20) -> list[dict]:
+    return [
+        {"role": "user" if idx % 2 == 0 else "assistant", "content": " ".join([f"Message number {idx}."] * 10)}
+        for idx in range(num_messages)
+    ]
+
+
+def get_num_tokens(chunk: chunking.Chunk) -> int:
+    return sum(estimate_num_tokens(message["content"]) + 5 for message in chunk.chunk)
+
+
+def test_budgeted_windows_stay_under_the_budget_and_overlap():
+    conversation = get_long_conversation()
+    chunker = chunking.BudgetedWholeConversationChunker(max_tokens=300, overlap=2)
+    chunks = chunker.chunk_simple_convo(conversation)
+
+    starts = sorted(chunks)
+    assert len(starts) > 1
+    assert starts[0] == 0 and chunks[0].touches_start
+    for start, chunk in chunks.items():
+        assert chunk.chunk == conversation[start : start + len(chunk.chunk)]
+        assert get_num_tokens(chunk) <= 300
+        assert chunk.touches_start == (start == 0)
+    for start, next_start in zip(starts, starts[1:]):
+        assert start + len(chunks[start].chunk) - next_start == 2
+    last_start = starts[-1]
+    assert last_start + len(chunks[last_start].chunk) == len(conversation)
+
+
+def test_budgeted_windows_are_as_long_as_the_budget_allows():
+    conversation = get_long_conversation()
+    message_tokens = estimate_num_tokens(conversation[0]["content"]) + 5
+    chunker = chunking.BudgetedWholeConversationChunker(max_tokens=4 * message_tokens, overlap=1)
+    chunks = chunker.chunk_simple_convo(conversation)
+    assert sorted(chunks)[:3] == [0, 3, 6]
+    assert all(len(chunks[start].chunk) == 4 for start in (0, 3, 6))
+
+
+def test_short_conversation_is_a_single_chunk():
+    conversation = get_long_conversation(4)
+    chunks = CHUNKER_DICT["whole_budgeted"].chunk_simple_convo(conversation)
+    assert list(chunks) == [0]
+    assert chunks[0].chunk == conversation
+    assert CHUNKER_DICT["whole_budgeted"].chunk_simple_convo([]) == {}
+
+
+def test_long_messages_are_truncated_and_get_their_own_window():
+    conversation = get_long_conversation(6)
+    conversation[2]["content"] = "x" * 100_000
+    chunker = chunking.BudgetedWholeConversationChunker(max_tokens=300, overlap=1, max_message_chars=2000)
+    chunks = chunker.chunk_simple_convo(conversation)
+
+    assert [message["content"] for message in chunks[2].chunk] == [chunks[2].chunk[0]["content"]]
+    content = chunks[2].chunk[0]["content"]
+    assert "[[...Long Message Truncated...]]" in content
+    assert content.startswith("x" * 1000) and content.endswith("x" * 1000)
+    assert len(content) == 2000 + len("[[...Long Message Truncated...]]")
+    # Every message is still covered, and the original conversation is left as is.
+    covered = {start + i for start, chunk in chunks.items() for i in range(len(chunk.chunk))}
+    assert covered == set(range(6))
+    assert len(conversation[2]["content"]) == 100_000
+
+
+def test_chunker_kwargs_configure_a_new_chunker():
+    chunker = chunking.get_chunker("whole_budgeted", {"max_tokens": 100})
+    assert isinstance(chunker, chunking.BudgetedWholeConversationChunker)
+    assert chunker is not CHUNKER_DICT["whole_budgeted"]
+    assert chunker.max_tokens == 100
+    assert CHUNKER_DICT["whole_budgeted"].max_tokens == 8000
+    assert chunking.get_chunker("whole_budgeted") is CHUNKER_DICT["whole_budgeted"]
+
+
+def test_chunk_plan_keeps_chunks_of_each_chunker_configuration():
+    conversation = get_long_conversation()
+    chunk_plan = chunking.ChunkPlan(conversation)
+    default_chunks = chunk_plan.get_chunks("whole_budgeted")
+    budgeted_chunks = chunk_plan.get_chunks("whole_budgeted", {"max_tokens": 300})
+    assert list(default_chunks) == [0]
+    assert len(budgeted_chunks) > 1
+    assert chunk_plan.get_chunks("whole_budgeted", {"max_tokens": 300}) is budgeted_chunks
+
+
+def test_classifier_chunks_with_the_chunker_kwargs_of_its_definition(mock_client):
+    client, backend = mock_client
+    definition = classification.load_classifier_definitions("v1_top_level")["IS_PROBLEMATIC_USE"]
+    definition = {**definition, "chunker": "whole_budgeted", "chunker_kwargs": {"max_tokens": 300}}
+    classifier = classification.EmoClassifier(
+        definition, model_wrapper=classification.ModelWrapper(openai_client=client, model="gpt-4o-mini"),
+    )
+    conversation = get_long_conversation()
+    results = asyncio.run(classifier.classify_conversation(conversation, chunk_plan=chunking.ChunkPlan(conversation)))
+    expected_chunks = chunking.get_chunker("whole_budgeted", {"max_tokens": 300}).chunk_simple_convo(conversation)
+    assert list(results) == sorted(expected_chunks)
+    assert len(results) == backend.stats["requests"] > 1
+
+
+class CountingChunker(chunking.Chunker):
+    """
+    Counts the conversations chunked by a chunker.
+    """
+    def __init__(self, chunker: chunking.Chunker):
+        self.chunker = chunker
+        self.num_calls = 0
+        self.KEYED_BY_START_INDEX = chunker.KEYED_BY_START_INDEX
+
+    def chunk_simple_convo(self, simple_convo: list[dict], n_context: int = 3) -> dict:
+        self.num_calls += 1
+        return self.chunker.chunk_simple_convo(simple_convo, n_context=n_context)
+
+
+class PromptRecordingMockBackend(mock_backend.MockBackend):
+    def __init__(self, config: mock_backend.MockBackendConfig):
+        super().__init__(config)
+        self.prompts = []
+
+    def handle(self, body: dict) -> tuple[int, dict, dict, float]:
+        self.prompts.append(body["messages"][-1]["content"])
+        return super().handle(body)
+
+
+def classify_with_sets(conversation: list[dict], share_chunks: bool) -> tuple[dict, list[str]]:
+    backend = PromptRecordingMockBackend(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0),
+    )
+    model_wrapper = classification.ModelWrapper(
+        openai_client=mock_backend.get_backend_client(backend, max_retries=0), model="gpt-4o-mini",
+    )
+    classifier_sets = {
+        set_name: classification.load_classifiers(set_name, model_wrapper=model_wrapper)
+        for set_name in ("v2", "question_tree", "intent")
+    }
+    if share_chunks:
+        result = asyncio.run(run_multi_set_classification.run_classification_on_single_conversation(
+            row=conversation, classifier_sets=classifier_sets, dependency_graphs={},
+            aggregator=aggregation.AGGREGATOR_DICT["any"],
+        ))
+    else:
+        async def run():
+            return {
+                set_name: dict(zip(classifiers, await asyncio.gather(*(
+                    classifier.classify_conversation(conversation) for classifier in classifiers.values()
+                ))))
+                for set_name, classifiers in classifier_sets.items()
+            }
+        result = asyncio.run(run())
+    return result, backend.prompts
+
+
+def test_classifiers_sharing_a_chunker_share_its_chunks(monkeypatch, conversation):
+    counting_chunkers = {}
+    for name, chunker in list(CHUNKER_DICT.items()):
+        counting_chunkers[name] = CountingChunker(chunker)
+        monkeypatch.setitem(CHUNKER_DICT, name, counting_chunkers[name])
+    classify_with_sets(conversation, share_chunks=True)
+    # v2, question_tree and intent use four chunkers, each run once for the conversation.
+    assert {name: chunker.num_calls for name, chunker in counting_chunkers.items() if chunker.num_calls} == {
+        "user_message": 1, "assistant_message": 1, "u_a_exchange": 1, "a_u_exchange": 1,
+    }
+
+
+def test_shared_chunks_render_the_same_prompts(conversation):
+    _, shared_prompts = classify_with_sets(conversation, share_chunks=True)
+    _, unshared_prompts = classify_with_sets(conversation, share_chunks=False)
+    assert len(shared_prompts) > 100
+    assert sorted(shared_prompts) == sorted(unshared_prompts)
+
+
+def test_renderings_are_cached_per_compression_setting(conversation):
+    conversation[1]["content"] = "See https://example.com/a/long/path  now"
+    chunk = chunking.ChunkPlan(conversation).get_chunks("user_message")[2]
+    definition = classification.load_classifier_definitions("v2")["share_emotions"]
+    compressed_definition = {**definition, "compression": {}}
+    assert classification.render_chunk(definition, chunk) == chunk.to_string()
+    assert classification.render_chunk(compressed_definition, chunk) == chunk.to_string(
+        compressor=compression.get_compressor(compressed_definition),
+    )
+    assert "[link: example.com]" in classification.render_chunk(compressed_definition, chunk)
+    assert set(chunk._rendered) == {"", json.dumps({})}
@@ -0,0 +1,148 @@
+import asyncio
+import sys
+import threading
+
+import pytest
+
+import emoclassifiers.chunking as chunking
+import emoclassifiers.classification as classification
+import emoclassifiers.client_pool as client_pool
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.mock_backend as mock_backend
+from examples import run_simple_classification
+
+DEFINITION = classification.load_classifier_definitions("v2")["share_emotions"]
+
+
+@pytest.fixture
+def serve_mock_backend():
+    """
+    Start mock backends served over HTTP (one per endpoint of a pool), stopped after the test.
+    """
+    servers = []
+
+    def serve(**kwargs):
+        config = mock_backend.MockBackendConfig(latency_distribution="constant", **{"latency_mean": 0.0, **kwargs})
+        server = mock_backend.serve(config, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def get_endpoint_config(name: str, server, **kwargs) -> client_pool.EndpointConfig:
+    return client_pool.EndpointConfig(
+        name=name,
+        base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+        max_retries=0,
+        **kwargs,
+    )
+
+
+async def classify_chunks(pool: client_pool.ClientPool, conversation: list[dict], num_rounds: int) -> list:
+    """
+    Classify every user message of `conversation` `num_rounds` times, all chunks of a round concurrently.
+    """
+    model_wrapper = classification.ModelWrapper(client_pool=pool, model="gpt-4o-mini")
+    chunks = chunking.get_chunker(DEFINITION["chunker"]).chunk_simple_convo(conversation)
+    results = []
+    try:
+        for _ in range(num_rounds):
+            results += await asyncio.gather(
+                *(model_wrapper.classify_conversation_chunk_detailed(DEFINITION, chunk) for chunk in chunks.values()),
+                return_exceptions=True,
+            )
+    finally:
+        await pool.close()
+    return results
+
+
+def test_requests_are_spread_over_the_endpoints(serve_mock_backend, conversation):
+    servers = [serve_mock_backend(latency_mean=0.05) for _ in range(2)]
+    pool = client_pool.ClientPool([
+        client_pool.Endpoint(get_endpoint_config(name, server, max_concurrent=2))
+        for name, server in zip(("a", "b"), servers)
+    ])
+    results = asyncio.run(classify_chunks(pool, conversation, num_rounds=3))
+
+    assert not any(isinstance(result, BaseException) for result in results)
+    # 4 concurrent chunks per round, 2 slots per endpoint.
+    assert [server.backend.stats["requests"] for server in servers] == [6, 6]
+    assert pool.report() == {
+        "a": {"requests": 6, "failures": 0, "healthy": True},
+        "b": {"requests": 6, "failures": 0, "healthy": True},
+    }
+
+
+def test_failing_endpoint_is_taken_out_of_rotation(serve_mock_backend, conversation):
+    failing_server = serve_mock_backend(error_rate=1.0)
+    server = serve_mock_backend()
+    pool = client_pool.ClientPool(
+        [
+            client_pool.Endpoint(get_endpoint_config("failing", failing_server, max_concurrent=1)),
+            client_pool.Endpoint(get_endpoint_config("ok", server, max_concurrent=1)),
+        ],
+        max_consecutive_failures=2,
+        health_check_interval=60.0,
+    )
+    results = asyncio.run(classify_chunks(pool, conversation, num_rounds=3))
+
+    failures = [result for result in results if isinstance(result, BaseException)]
+    assert all(isinstance(failure, client_pool.FAILURE_ERRORS) for failure in failures)
+    assert 2 <= len(failures) < len(results)
+    assert failing_server.backend.stats["requests"] == len(failures)
+    assert server.backend.stats["requests"] == len(results) - len(failures)
+    report = pool.report()
+    assert report["failing"] == {"requests": 0, "failures": len(failures), "healthy": False}
+    assert report["ok"]["healthy"]
+
+
+def test_warm_up_takes_unreachable_endpoints_out_of_rotation(serve_mock_backend, conversation):
+    server = serve_mock_backend()
+    stopped_server = serve_mock_backend()
+    stopped_server.shutdown()
+    stopped_server.server_close()
+    pool = client_pool.ClientPool([
+        client_pool.Endpoint(get_endpoint_config("stopped", stopped_server, max_concurrent=2)),
+        client_pool.Endpoint(get_endpoint_config("ok", server, max_concurrent=2)),
+    ])
+
+    async def run():
+        await pool.warm_up()
+        return await classify_chunks(pool, conversation, num_rounds=2)
+
+    results = asyncio.run(run())
+    assert not any(isinstance(result, BaseException) for result in results)
+    assert server.backend.stats["requests"] == len(results)
+    assert not pool.report()["stopped"]["healthy"]
+
+
+def test_simple_runner_uses_only_the_pool(tmp_path, monkeypatch, serve_mock_backend, conversation):
+    servers = [serve_mock_backend(latency_mean=0.02) for _ in range(2)]
+    # No default client is created, so no API key is needed.
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.delenv("OPENAI_BASE_URL", raising=False)
+    endpoints_path = str(tmp_path / "endpoints.json")
+    io_utils.save_json(
+        [get_endpoint_config(name, server, max_concurrent=2).model_dump() for name, server in zip(("a", "b"), servers)],
+        endpoints_path,
+    )
+    input_path = str(tmp_path / "conversations.jsonl")
+    output_path = str(tmp_path / "results.jsonl")
+    io_utils.save_jsonl([conversation] * 3, input_path)
+    monkeypatch.setattr(sys, "argv", [
+        "run_simple_classification.py",
+        "--input_path", input_path,
+        "--output_path", output_path,
+        "--classifier_set", "question_tree",
+        "--endpoints_path", endpoints_path,
+    ])
+    run_simple_classification.main()
+
+    assert len(io_utils.load_jsonl(output_path)) == 3
+    assert all(server.backend.stats["requests"] > 0 for server in servers)
+    assert sum(server.backend.stats["requests"] for server in servers) == 12
@@ -0,0 +1,87 @@
+import pytest
+
+import emoclassifiers.classification as classification
+import emoclassifiers.compression as compression
+import emoclassifiers.planning as planning
+from emoclassifiers.chunking import CHUNKER_DICT, estimate_num_tokens
+
+BASE64_BLOB = "data:image/png;base64," + "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk" * 3
+
+
+@pytest.fixture(autouse=True)
+def reset_compression_stats():
+    compression.COMPRESSION_STATS.reset()
+
+
+def compress(content: str, role: str = "assistant", **kwargs) -> str:
+    return compression.CompressionConfig(**kwargs).compress(content, role)
+
+
+def test_code_blocks_are_elided():
+    content = "Try this:\n```python\nx = 1\nprint(x)\n```\nDone."
+    assert compress(content) == "Try this:\n[code block elided: 4 lines]\nDone."
+    # An unterminated block runs to the end of the message.
+    assert compress("Here:\n```\nx = 1") == "Here:\n[code block elided: 2 lines]"
+    assert compress(content, elide_code_blocks=False) == content
+
+
+def test_urls_keep_their_host():
+    content = "See https://example.com/some/long/path?query=1 and (http://docs.python.org/3/)."
+    assert compress(content) == "See [link: example.com] and ([link: docs.python.org])."
+
+
+def test_base64_is_elided_but_long_plain_runs_are_kept():
+    assert compress(f"Image: {BASE64_BLOB} end") == "Image: [encoded data elided] end"
+    plain = "a" * 200
+    assert compress(plain) == plain
+
+
+def test_repeated_paragraphs_are_elided_once_per_run():
+    content = "Hello there.\n\nI am sad.\n\nhello   THERE.\n\nHello there.\n\nBye."
+    assert compress(content) == "Hello there.\n\nI am sad.\n\n[repeated text elided]\n\nBye."
+
+
+def test_whitespace_is_collapsed():
+    assert compress("  a  \t b\n\n\n\n c  ") == "a b\n\n c"
+
+
+def test_role_budget_keeps_start_and_end():
+    content = "x" * 50 + "y" * 50
+    compressed = compress(content, role="assistant", role_max_chars={"assistant": 20})
+    assert compressed == "x" * 10 + "[[...Long Message Truncated...]]" + "y" * 10
+    assert compress(content, role="user", role_max_chars={"assistant": 20}) == content
+
+
+def test_compressor_only_for_definitions_with_compression():
+    assert compression.get_compressor({}) is None
+    assert compression.get_compressor({"compression": {}})("a  b", "user") == "a b"
+
+
+def test_stats_count_each_message_once(conversation):
+    conversation[1]["content"] = "Look: https://example.com/a/very/long/path/to/somewhere " * 4
+    definition = {**classification.load_classifier_definitions("v2")["share_emotions"], "compression": {}}
+    chunks = CHUNKER_DICT["user_message"].chunk_simple_convo(conversation)
+    # Message 1 is in the context of several (overlapping) chunks, and rendered by two classifiers.
+    for _ in range(2):
+        for chunk in chunks.values():
+            chunk.to_string(compressor=compression.get_compressor(definition))
+
+    report = compression.COMPRESSION_STATS.report()
+    # The last message (an assistant one) is in no chunk.
+    expected_before = sum(estimate_num_tokens(message["content"].strip()) for message in conversation[:-1])
+    assert report["tokens_before"] == expected_before
+    assert report["tokens_saved"] == report["tokens_saved_by_role"]["assistant"] > 0
+    compression.COMPRESSION_STATS.reset()
+    assert compression.COMPRESSION_STATS.report()["tokens_before"] == 0
+
+
+def test_planning_does_not_record_savings(conversation):
+    conversation[1]["content"] = "```\n" + "code\n" * 100 + "```"
+    definitions = {
+        name: {**definition, "compression": {}}
+        for name, definition in classification.load_classifier_definitions("v2").items()
+    }
+    plan = planning.plan_run([conversation], definitions, model="gpt-4o-mini")
+    assert plan.total("upper").calls > 0
+    assert compression.COMPRESSION_STATS.report()["tokens_before"] == 0
+    assert compression.COMPRESSION_STATS.enabled
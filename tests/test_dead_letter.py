@@ -0,0 +1,129 @@
+import asyncio
+import sys
+import threading
+
+import pytest
+
+import emoclassifiers.classification as classification
+import emoclassifiers.dead_letter as dead_letter
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.mock_backend as mock_backend
+import redrive_dead_letters
+
+DEFINITION = classification.load_classifier_definitions("question_tree")["QUESTION_TYPE"]
+ERROR = classification.ClassificationStatusEnum.ERROR
+
+
+@pytest.fixture
+def dead_letter_queue(tmp_path, monkeypatch):
+    queue = dead_letter.DeadLetterQueue(str(tmp_path / "dead_letters.jsonl"))
+    monkeypatch.setattr(dead_letter, "DEAD_LETTER_QUEUE", queue)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    """
+    A mock backend served over HTTP, for scripts that create their own openai client.
+    """
+    server = mock_backend.serve(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0),
+        port=0,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "mock")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_failing_model_wrapper(**kwargs) -> classification.ModelWrapper:
+    client, _ = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0, error_rate=1.0),
+        max_retries=0,
+    )
+    return classification.ModelWrapper(openai_client=client, model="gpt-4o-mini", **kwargs)
+
+
+def classify(classifier: classification.EmoClassifier, conversation: list[dict], conversation_hash: str) -> dict:
+    return asyncio.run(dead_letter.with_conversation(classifier.classify_conversation(conversation), conversation_hash))
+
+
+def test_failed_chunks_fail_the_conversation_by_default(conversation):
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=get_failing_model_wrapper())
+    with pytest.raises(Exception):
+        asyncio.run(classifier.classify_conversation(conversation))
+
+
+def test_failed_chunks_are_dead_lettered(dead_letter_queue, conversation):
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=get_failing_model_wrapper())
+    results = classify(classifier, conversation, "a")
+    assert results == {0: ERROR, 2: ERROR, 4: ERROR, 6: ERROR}
+
+    letters = dead_letter.load_dead_letters(dead_letter_queue.path)
+    assert [(letter.conversation_hash, letter.classifier, letter.chunk_id) for letter in letters] == [
+        ("a", "QUESTION_TYPE", chunk_id) for chunk_id in (0, 2, 4, 6)
+    ]
+    assert {letter.error_type for letter in letters} == {"InternalServerError"}
+    assert {letter.classifier_set for letter in letters} == {"question_tree"}
+
+
+def test_failed_packed_windows_dead_letter_every_target(dead_letter_queue, conversation):
+    definition = classification.load_classifier_definitions("v2")["share_emotions"]
+    classifier = classification.EmoClassifier(definition, model_wrapper=get_failing_model_wrapper(), packed_token_budget=6000)
+    results = classify(classifier, conversation, "a")
+    assert results == {0: ERROR, 2: ERROR, 4: ERROR, 6: ERROR}
+    assert sorted(letter.chunk_id for letter in dead_letter.load_dead_letters(dead_letter_queue.path)) == [0, 2, 4, 6]
+
+
+def test_timeouts_are_not_dead_lettered(dead_letter_queue, conversation):
+    client, _ = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=1.0),
+        max_retries=0,
+    )
+    model_wrapper = classification.ModelWrapper(openai_client=client, model="gpt-4o-mini", request_timeout=0.05)
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=model_wrapper)
+    results = classify(classifier, conversation, "a")
+    assert set(results.values()) == {classification.ClassificationStatusEnum.TIMEOUT}
+    assert dead_letter_queue.num_letters == 0
+
+
+def test_redrive_patches_results_and_empties_the_queue(tmp_path, monkeypatch, mock_server, dead_letter_queue, conversation):
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=get_failing_model_wrapper())
+    failed_results = classify(classifier, conversation, "a")
+    # A letter of another set sharing the version of the set being redriven is left alone.
+    question_definition = next(iter(classification.load_classifier_definitions("question").values()))
+    other_classifier = classification.EmoClassifier(question_definition, model_wrapper=get_failing_model_wrapper())
+    classify(other_classifier, conversation[:2], "a")
+    dead_letter_queue.close()
+    results_path = str(tmp_path / "results.jsonl")
+    conversations_path = str(tmp_path / "conversations.jsonl")
+    io_utils.save_jsonl([
+        {"conversation_hash": "a", "classifications": {str(chunk_id): label.value for chunk_id, label in failed_results.items()}},
+        {"conversation_hash": "b", "classifications": {"0": "timeout"}},
+    ], results_path)
+    io_utils.save_jsonl([
+        {"conversation_hash": "a", "conversation": conversation},
+        {"conversation_hash": "b", "conversation": conversation},
+    ], conversations_path)
+    monkeypatch.setattr(sys, "argv", [
+        "redrive_dead_letters.py",
+        "--dead_letter_path", dead_letter_queue.path,
+        "--results_path", results_path,
+        "--conversations_path", conversations_path,
+        "--classifier_set", "question_tree",
+        "--layout", "chunk",
+        "--include_timeouts",
+    ])
+    redrive_dead_letters.main()
+
+    labels = {label.value for label in classification.QuestionTypeEnum}
+    results = {row["conversation_hash"]: row["classifications"] for row in io_utils.load_jsonl(results_path)}
+    assert list(results["a"]) == ["0", "2", "4", "6"]
+    assert set(results["a"].values()) <= labels
+    assert results["b"]["0"] in labels
+    remaining = dead_letter.load_dead_letters(dead_letter_queue.path)
+    assert [(letter.classifier_set, letter.chunk_id) for letter in remaining] == [("question", 0)]
+    assert mock_server.backend.stats["requests"] == 5
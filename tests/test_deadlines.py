@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import pytest
+
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.classification as classification
+import emoclassifiers.deadlines as deadlines
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.mock_backend as mock_backend
+import run_hierarchical_emoclassifiers_v1
+
+DEFINITION = classification.load_classifier_definitions("v2")["share_emotions"]
+
+
+def get_slow_model_wrapper(latency: float, **kwargs) -> classification.ModelWrapper:
+    client, _ = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=latency),
+        max_retries=0,
+    )
+    return classification.ModelWrapper(openai_client=client, model="gpt-4o-mini", **kwargs)
+
+
+def test_deadline_marks_unfinished_chunks_as_timed_out(conversation):
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=get_slow_model_wrapper(1.0))
+    start_time = time.perf_counter()
+    results = asyncio.run(deadlines.with_deadline(classifier.classify_conversation(conversation), timeout=0.1))
+    assert time.perf_counter() - start_time < 0.9
+    assert set(results.values()) == {classification.ClassificationStatusEnum.TIMEOUT}
+    assert classification.get_timed_out_chunk_ids(results) == list(results)
+
+
+def test_request_timeout_marks_the_chunk_instead_of_failing(conversation):
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=get_slow_model_wrapper(1.0, request_timeout=0.1))
+    results = asyncio.run(classifier.classify_conversation(conversation))
+    assert set(results.values()) == {classification.ClassificationStatusEnum.TIMEOUT}
+
+
+def test_fast_requests_finish_before_the_deadline(mock_client, conversation):
+    client, _ = mock_client
+    model_wrapper = classification.ModelWrapper(openai_client=client, model="gpt-4o-mini")
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=model_wrapper)
+    results = asyncio.run(deadlines.with_deadline(classifier.classify_conversation(conversation), timeout=30))
+    assert classification.get_timed_out_chunk_ids(results) == []
+
+
+def test_nested_deadlines_keep_the_earliest():
+    async def run():
+        with deadlines.deadline(0.1):
+            outer = deadlines.DEADLINE.get()
+            with deadlines.deadline(10):
+                assert deadlines.DEADLINE.get() == outer
+            with deadlines.deadline(0.01):
+                assert deadlines.DEADLINE.get() < outer
+        assert deadlines.DEADLINE.get() is None
+
+    asyncio.run(run())
+
+
+def test_gather_structured_cancels_siblings_on_error():
+    cancelled = []
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def wait():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(ValueError):
+        asyncio.run(deadlines.gather_structured([wait(), fail()]))
+    assert cancelled == [True]
+
+
+def test_runner_lists_timed_out_classifiers(conversation):
+    model_wrapper = get_slow_model_wrapper(1.0)
+    top_level_classifiers = classification.load_classifiers("v1_top_level", model_wrapper=model_wrapper)
+    dependency_graph = io_utils.load_json(io_utils.get_path(
+        "assets/definitions/emoclassifiers_v1_dependency.json"
+    ))["dependency"]
+    results = asyncio.run(run_hierarchical_emoclassifiers_v1.run_classification(
+        conversation_list=[conversation],
+        top_level_classifiers=top_level_classifiers,
+        sub_classifiers=classification.load_classifiers("v1", model_wrapper=model_wrapper),
+        dependency_graph=dependency_graph,
+        aggregator=aggregation.AGGREGATOR_DICT["any"],
+        conversation_timeout=0.1,
+    ))
+    # Timed out gating classifiers score as negative, so no sub-classifier runs.
+    assert results[0]["timed_out"] == list(top_level_classifiers)
+    assert not any(results[0]["top_level"].values())
+    assert results[0]["sub_level"] == {}
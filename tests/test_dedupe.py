@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import emoclassifiers.classification as classification
+import emoclassifiers.dedupe as dedupe
+
+
+def get_sender(sent: list, result="response", delay: float = 0.01):
+    async def send():
+        sent.append(result)
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return send
+
+
+def test_identical_requests_in_flight_are_sent_once():
+    deduplicator = dedupe.RequestDeduplicator()
+    sent = []
+
+    async def run():
+        return await asyncio.gather(*(deduplicator.run("key", get_sender(sent)) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["response"] * 3
+    assert sent == ["response"]
+    assert deduplicator.report() == {"requests": 3, "in_flight_hits": 2, "cache_hits": 0, "cached": 1}
+
+
+def test_answered_requests_are_cached_up_to_max_cached():
+    deduplicator = dedupe.RequestDeduplicator(max_cached=1)
+    sent = []
+
+    async def run():
+        await deduplicator.run("a", get_sender(sent, "a"))
+        await deduplicator.run("a", get_sender(sent, "a"))
+        await deduplicator.run("b", get_sender(sent, "b"))
+        # "a" was evicted by "b".
+        await deduplicator.run("a", get_sender(sent, "a"))
+
+    asyncio.run(run())
+    assert sent == ["a", "b", "a"]
+    assert deduplicator.num_cache_hits == 1
+
+
+def test_errors_are_shared_but_not_cached():
+    deduplicator = dedupe.RequestDeduplicator()
+    sent = []
+
+    async def run():
+        results = await asyncio.gather(
+            *(deduplicator.run("key", get_sender(sent, ValueError("failed"))) for _ in range(2)),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+        return await deduplicator.run("key", get_sender(sent))
+
+    assert asyncio.run(run()) == "response"
+    assert len(sent) == 2
+    assert deduplicator.num_cache_hits == 0
+
+
+def test_cancelling_one_caller_keeps_the_shared_request():
+    deduplicator = dedupe.RequestDeduplicator()
+    sent = []
+
+    async def run():
+        first = asyncio.create_task(deduplicator.run("key", get_sender(sent, delay=0.05)))
+        second = asyncio.create_task(deduplicator.run("key", get_sender(sent, delay=0.05)))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "response"
+    assert len(sent) == 1
+
+
+def test_cancelling_every_caller_cancels_the_shared_request():
+    deduplicator = dedupe.RequestDeduplicator()
+
+    async def run():
+        task = asyncio.create_task(deduplicator.run("key", get_sender([], delay=10)))
+        await asyncio.sleep(0.01)
+        shared = deduplicator.in_flight["key"]
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+        return shared
+
+    shared = asyncio.run(run())
+    assert shared.task.cancelled()
+    assert deduplicator.cache == {}
+
+
+def test_growing_conversation_only_sends_new_chunks(mock_client, conversation):
+    client, backend = mock_client
+    model_wrapper = classification.ModelWrapper(
+        openai_client=client,
+        model="gpt-4o-mini",
+        deduplicator=dedupe.RequestDeduplicator(),
+    )
+    definition = classification.load_classifier_definitions("v2")["share_emotions"]
+    classifier = classification.EmoClassifier(definition, model_wrapper=model_wrapper)
+
+    async def run():
+        prefix_results = await classifier.classify_conversation(conversation[:4])
+        results = await classifier.classify_conversation(conversation)
+        return prefix_results, results
+
+    prefix_results, results = asyncio.run(run())
+    assert backend.stats["requests"] == len(results) == 4
+    assert {chunk_id: results[chunk_id] for chunk_id in prefix_results} == prefix_results
+    assert model_wrapper.deduplicator.num_cache_hits == 2
@@ -0,0 +1,123 @@
+import asyncio
+import os
+
+import numpy as np
+
+import emoclassifiers.classification as classification
+import emoclassifiers.distillation as distillation
+import emoclassifiers.io_utils as io_utils
+from emoclassifiers.chunking import Chunk
+
+LABELS = ["no_question", "fact_checking", "rhetorical", "exploratory"]
+TEXTS = ["thanks a lot", "ok sounds good", "what year did the war end", "what is the capital of peru"] * 10
+TEXT_LABELS = ["no_question", "no_question", "fact_checking", "fact_checking"] * 10
+
+
+def get_trained_model() -> distillation.HashedLogisticRegression:
+    model = distillation.HashedLogisticRegression(labels=LABELS, num_features=2 ** 12)
+    return model.fit(TEXTS, TEXT_LABELS, num_epochs=20)
+
+
+def save_evaluation_report(model_dir: str, local_agreement: float):
+    io_utils.save_json(
+        {"QUESTION_TYPE": {"thresholds": [{"threshold": 0.9, "local_agreement": local_agreement}]}},
+        os.path.join(model_dir, "evaluation_report.json"),
+    )
+
+
+def test_fit_predict_and_save_round_trip(tmp_path):
+    model = get_trained_model()
+    predictions = model.predict(["thanks a lot", "what year did the war end"])
+    assert [label for label, _ in predictions] == ["no_question", "fact_checking"]
+    assert all(probability > 0.9 for _, probability in predictions)
+
+    path = str(tmp_path / "model.npz")
+    model.save(path)
+    loaded = distillation.HashedLogisticRegression.load(path)
+    assert loaded.labels == LABELS
+    np.testing.assert_allclose(loaded.predict_proba(TEXTS[:4]), model.predict_proba(TEXTS[:4]))
+
+
+def test_load_training_examples_by_chunk(tmp_path):
+    conversations_path = str(tmp_path / "conversations.jsonl")
+    results_path = str(tmp_path / "results.jsonl")
+    io_utils.save_jsonl([{"conversation_hash": "a", "conversation": [
+        {"role": "user", "content": "What is the capital of Peru?"},
+        {"role": "assistant", "content": "Lima."},
+        {"role": "user", "content": "thanks"},
+    ]}], conversations_path)
+    io_utils.save_jsonl([
+        {"conversation_hash": "a", "classifications": {"0": "fact_checking", "2": "no_question"}},
+        # Failed results and unknown conversations are skipped.
+        {"conversation_hash": "a", "classifications": {"0": "error"}},
+        {"conversation_hash": "b", "classifications": {"0": "no_question"}},
+    ], results_path)
+    examples = distillation.load_training_examples(results_path, conversations_path, "question_tree", layout="chunk")
+    assert examples == {"QUESTION_TYPE": (["What is the capital of Peru?", "thanks"], ["fact_checking", "no_question"])}
+
+
+def test_evaluate_thresholds_and_held_out_agreement():
+    model = get_trained_model()
+    evaluation = {"thresholds": distillation.evaluate_thresholds(
+        model, TEXTS[:4], ["no_question", "fact_checking", "fact_checking", "fact_checking"], thresholds=[0.0, 0.5],
+    )}
+    assert evaluation["thresholds"][0] == {
+        "threshold": 0.0,
+        "calls_saved": 1.0,
+        "local_agreement": 0.75,
+        "overall_agreement": 0.75,
+    }
+    assert distillation.get_held_out_agreement(evaluation, 0.5) == evaluation["thresholds"][1]["local_agreement"]
+    # Agreement at other thresholds does not bound the agreement at one not evaluated.
+    assert distillation.get_held_out_agreement(evaluation, 0.7) is None
+    assert distillation.get_held_out_agreement(evaluation, -1.0) is None
+
+
+def test_load_distilled_models_requires_held_out_agreement(tmp_path):
+    model_dir = str(tmp_path)
+    get_trained_model().save(os.path.join(model_dir, "QUESTION_TYPE.npz"))
+    # No evaluation report: agreement unknown.
+    assert distillation.load_distilled_models(model_dir, "question_tree", threshold=0.9) == {}
+    save_evaluation_report(model_dir, local_agreement=0.8)
+    assert distillation.load_distilled_models(model_dir, "question_tree", threshold=0.9) == {}
+    save_evaluation_report(model_dir, local_agreement=0.99)
+    models = distillation.load_distilled_models(model_dir, "question_tree", threshold=0.9)
+    assert list(models) == ["QUESTION_TYPE"]
+    # Not evaluated at the serving threshold.
+    assert distillation.load_distilled_models(model_dir, "question_tree", threshold=0.95) == {}
+
+
+def test_wrapper_serves_confident_chunks_locally(mock_client):
+    client, backend = mock_client
+    definition = classification.load_classifier_definitions("question_tree")["QUESTION_TYPE"]
+    model_wrapper = distillation.DistilledModelWrapper(
+        classification.ModelWrapper(openai_client=client, model="gpt-4o-mini"),
+        models={"QUESTION_TYPE": get_trained_model()},
+        threshold=0.9,
+    )
+    conversation = [
+        {"role": "user", "content": "thanks a lot"},
+        {"role": "assistant", "content": "You're welcome."},
+        {"role": "user", "content": "Should I forgive my brother for what he said to me?"},
+    ]
+    classifier = classification.EmoClassifier(definition, model_wrapper=model_wrapper)
+    results = asyncio.run(classifier.classify_conversation_detailed(conversation))
+
+    assert results[0].label == classification.QuestionTypeEnum.NO_QUESTION
+    assert results[0].model == "distilled"
+    assert results[2].model == "gpt-4o-mini"
+    assert backend.stats["requests"] == 1
+    assert model_wrapper.report() == {"QUESTION_TYPE": {"local": 1, "escalated": 1, "local_rate": 0.5}}
+
+
+def test_wrapper_escalates_classifiers_without_a_model(mock_client):
+    client, backend = mock_client
+    definition = classification.load_classifier_definitions("question_tree")["QUESTION_TYPE"]
+    model_wrapper = distillation.DistilledModelWrapper(
+        classification.ModelWrapper(openai_client=client, model="gpt-4o-mini"),
+        models={},
+    )
+    chunk = Chunk.from_simple_convo([{"role": "user", "content": "thanks a lot"}], idx=0)
+    result = asyncio.run(model_wrapper.classify_conversation_chunk_detailed(definition, chunk))
+    assert result.model == "gpt-4o-mini"
+    assert backend.stats["requests"] == 1
@@ -0,0 +1,157 @@
+import asyncio
+from types import SimpleNamespace
+
+import emoclassifiers.classification as classification
+import emoclassifiers.hedging as hedging
+import emoclassifiers.mock_backend as mock_backend
+import emoclassifiers.usage as usage
+
+
+def get_warm_policy(holdout_rate: float = 0.0, **kwargs) -> hedging.HedgingPolicy:
+    """
+    A policy that hedges requests slower than 20ms, having seen enough fast requests.
+    """
+    policy = hedging.HedgingPolicy(percentile=50, min_delay=0.02, min_samples=10, holdout_rate=holdout_rate, **kwargs)
+    for _ in range(10):
+        policy.observe(0.001)
+    return policy
+
+
+def get_sender(latency: float, name: str, sent: list):
+    async def send():
+        sent.append(name)
+        await asyncio.sleep(latency)
+        return name, SimpleNamespace(usage=None)
+
+    return send
+
+
+def test_no_hedging_before_enough_samples():
+    policy = hedging.HedgingPolicy(min_samples=10)
+    sent = []
+    result = asyncio.run(policy.send(get_sender(0.05, "original", sent), model="mock"))
+    assert result[0] == "original"
+    assert sent == ["original"]
+    assert policy.delay is None
+
+
+def test_slow_request_is_hedged_and_the_loser_cancelled():
+    policy = get_warm_policy(max_hedge_rate=1.0)
+    sent = []
+    cancelled = []
+
+    async def send_original():
+        sent.append("original")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append("original")
+            raise
+
+    result = asyncio.run(policy.send(send_original, model="mock", send_hedge=get_sender(0.0, "hedge", sent)))
+    assert result[0] == "hedge"
+    assert sent == ["original", "hedge"]
+    assert cancelled == ["original"]
+    assert policy.num_hedges == policy.num_hedge_wins == policy.num_censored == 1
+    # The cancelled original only gives a lower bound, for the delay; the unhedged latency is unknown.
+    assert 0.02 <= policy.recent_latencies[-1] < 1.0
+    assert len(policy.unhedged_latencies) == 0
+
+
+def test_report_compares_held_out_requests_with_hedged_ones():
+    policy = get_warm_policy(holdout_rate=0.5, max_hedge_rate=1.0)
+
+    async def run():
+        for _ in range(20):
+            await policy.send(get_sender(0.1, "original", []), model="mock", send_hedge=get_sender(0.0, "hedge", []))
+
+    asyncio.run(run())
+    report = policy.report()
+    assert 0 < len(policy.unhedged_latencies) < 20
+    assert len(policy.unhedged_latencies) + len(policy.hedged_latencies) == 20
+    # Held out requests wait for the slow original; the others get the hedge's answer after the delay.
+    assert report["latency_without_hedging"]["p50"] >= 0.1
+    assert report["latency_with_hedging"]["p50"] < 0.08
+    # The delay stays computed from original requests, not from the hedges' faster answers.
+    assert policy.delay >= 0.02
+    assert min(list(policy.recent_latencies)[10:]) >= 0.02
+
+
+def test_failed_copy_falls_back_to_the_other():
+    policy = get_warm_policy(max_hedge_rate=1.0)
+
+    async def send_hedge():
+        raise RuntimeError("hedge failed")
+
+    result = asyncio.run(policy.send(get_sender(0.05, "original", []), model="mock", send_hedge=send_hedge))
+    assert result[0] == "original"
+    assert policy.num_hedges == 1
+    assert policy.num_hedge_wins == 0
+
+
+def test_answered_loser_is_recorded_as_extra_usage():
+    policy = get_warm_policy(max_hedge_rate=1.0)
+    original_answer = asyncio.Event()
+    extra_results = []
+    response = SimpleNamespace(usage=SimpleNamespace(prompt_tokens=100, completion_tokens=5, prompt_tokens_details=None))
+
+    async def send_original():
+        await original_answer.wait()
+        return "gpt-4o-mini", response
+
+    async def send_hedge():
+        # Both copies answer in the same iteration of the event loop.
+        original_answer.set()
+        await asyncio.sleep(0)
+        return "gpt-4o-mini", response
+
+    asyncio.run(policy.send(send_original, model="mock", send_hedge=send_hedge, on_extra_result=extra_results.append))
+    assert extra_results == [("gpt-4o-mini", response)]
+    assert policy.extra_usage.prompt_tokens == 100
+
+
+def test_hedges_are_capped_and_need_a_reservation():
+    policy = get_warm_policy(max_hedge_rate=0.25)
+    sent = []
+
+    async def run():
+        for _ in range(8):
+            await policy.send(get_sender(0.03, "original", sent), model="mock", send_hedge=get_sender(0.0, "hedge", sent))
+
+    asyncio.run(run())
+    assert policy.num_hedges == 2
+    assert sent.count("hedge") == 2
+
+    policy = get_warm_policy(max_hedge_rate=1.0)
+    result = asyncio.run(policy.send(get_sender(0.03, "original", []), model="mock", reserve_hedge=lambda: False))
+    assert result[0] == "original"
+    assert policy.num_hedges == 0
+
+
+def test_model_wrapper_hedges_within_its_slots_and_budget(conversation):
+    client, backend = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="lognormal", latency_mean=0.02, latency_sigma=1.0),
+        max_retries=0,
+    )
+    usage_tracker = usage.UsageTracker(budget=10.0)
+    policy = hedging.HedgingPolicy(percentile=50, max_hedge_rate=0.5, min_delay=0.0, min_samples=5, holdout_rate=0.0)
+    model_wrapper = classification.ModelWrapper(
+        openai_client=client,
+        model="gpt-4o-mini",
+        max_concurrent=3,
+        scheduler="fair",
+        usage_tracker=usage_tracker,
+        hedging_policy=policy,
+    )
+    definition = classification.load_classifier_definitions("v2")["share_emotions"]
+    classifier = classification.EmoClassifier(definition, model_wrapper=model_wrapper)
+    results = asyncio.run(classifier.classify_conversation(conversation * 10))
+
+    assert len(results) == 40
+    assert 0 < policy.num_hedges <= 0.5 * policy.num_requests
+    # A hedge waits for its own slot, and is dropped if the original answers first.
+    assert policy.num_requests <= backend.stats["requests"] <= policy.num_requests + policy.num_hedges
+    assert model_wrapper.scheduler.available == 3
+    assert usage_tracker.reserved == 0.0
+    # Hedges that answered are counted in the usage, on top of one call per chunk.
+    assert usage_tracker.report()["total"]["calls"] == 40 + policy.extra_usage.calls
@@ -0,0 +1,130 @@
+import asyncio
+import enum
+import math
+from types import SimpleNamespace
+
+import pytest
+
+import emoclassifiers.classification as classification
+import emoclassifiers.metrics as metrics
+import emoclassifiers.mock_backend as mock_backend
+from emoclassifiers.chunking import CHUNKER_DICT
+
+DEFINITION = classification.load_classifier_definitions("question_tree")["QUESTION_TYPE"]
+LABELS = [label.value for label in classification.QuestionTypeEnum]
+
+
+def get_top_logprobs(probabilities: dict[str, float]) -> list:
+    return [SimpleNamespace(token=token, logprob=math.log(prob)) for token, prob in probabilities.items()]
+
+
+class DroppingMockBackend(mock_backend.MockBackend):
+    """
+    Leaves the chosen label (and, with `drop_all`, every label) out of the top logprobs.
+    """
+    def __init__(self, config: mock_backend.MockBackendConfig, drop_all: bool = False):
+        super().__init__(config)
+        self.drop_all = drop_all
+
+    def get_token_logprobs(self, tokens, label, labels, top_logprobs):
+        content = super().get_token_logprobs(tokens, label, labels, top_logprobs)
+        for token_logprob in content:
+            token_logprob["top_logprobs"] = [
+                alternative for alternative in token_logprob["top_logprobs"]
+                if alternative["token"] != label and not self.drop_all
+            ] + [{"token": "Sorry", "logprob": math.log(0.05), "bytes": None}]
+        return content
+
+
+def get_model_wrapper(backend: mock_backend.MockBackend, **kwargs) -> classification.ModelWrapper:
+    return classification.ModelWrapper(
+        openai_client=mock_backend.get_backend_client(backend, max_retries=0),
+        model="gpt-4o-mini",
+        decoding_modes={"question_tree": classification.LABEL_TOKEN_DECODING},
+        **kwargs,
+    )
+
+
+def get_config(**kwargs) -> mock_backend.MockBackendConfig:
+    return mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0, **kwargs)
+
+
+def classify_chunks(model_wrapper: classification.ModelWrapper, conversation: list[dict]) -> dict:
+    chunks = CHUNKER_DICT[DEFINITION["chunker"]].chunk_simple_convo(conversation)
+
+    async def run():
+        results = await asyncio.gather(*(
+            model_wrapper.classify_conversation_chunk_detailed(DEFINITION, chunk) for chunk in chunks.values()
+        ))
+        return dict(zip(chunks, results))
+
+    return asyncio.run(run())
+
+
+def test_label_distribution_matches_labels_and_prefixes():
+    top_logprobs = get_top_logprobs({" Fact": 0.5, '"no_question"': 0.3, "RHET": 0.1, "?": 0.1})
+    distribution = classification.get_label_distribution(top_logprobs, classification.QuestionTypeEnum)
+    # "?" is no label (nor a prefix of one), and is left out before renormalizing.
+    assert distribution == pytest.approx({"fact_checking": 0.5 / 0.9, "no_question": 0.3 / 0.9, "rhetorical": 0.1 / 0.9})
+    # An ambiguous prefix counts towards no label.
+    label_enum = enum.Enum("LabelEnum", {"ADVICE": "advice", "ADVOCACY": "advocacy"})
+    distribution = classification.get_label_distribution(get_top_logprobs({"adv": 0.6, "advo": 0.2}), label_enum)
+    assert distribution == pytest.approx({"advocacy": 1.0})
+
+
+def test_label_distribution_temperature_and_missing_labels():
+    top_logprobs = get_top_logprobs({"yes": 0.6, "no": 0.2})
+    sharpened = classification.get_label_distribution(top_logprobs, classification.YesNoUnsureEnum, temperature=0.5)
+    assert sharpened == pytest.approx({"yes": 0.9, "no": 0.1})
+    assert classification.get_label_distribution(get_top_logprobs({"maybe": 0.9}), classification.YesNoUnsureEnum) == {}
+
+
+def test_label_probability_spans_the_label_tokens():
+    tokens = [
+        SimpleNamespace(token=token, logprob=math.log(prob))
+        for token, prob in [('{"', 1.0), ("response", 1.0), ('":"', 1.0), ("fact", 0.8), ("_checking", 0.9), ('"}', 1.0)]
+    ]
+    assert classification.get_label_probability(tokens, "fact_checking") == pytest.approx(0.72)
+    assert classification.get_label_probability(tokens, "no_question") is None
+
+
+def test_label_token_decoding_reads_the_distribution(conversation):
+    backend = mock_backend.MockBackend(get_config(label_confidence=0.6))
+    results = classify_chunks(get_model_wrapper(backend), conversation)
+
+    assert backend.stats["requests"] == len(results) == 4
+    for result in results.values():
+        assert result.label_probabilities[result.label.value] == result.probability == pytest.approx(0.6)
+        assert set(result.label_probabilities) == set(LABELS)
+        assert sum(result.label_probabilities.values()) == pytest.approx(1.0)
+        assert result.model == "gpt-4o-mini"
+
+
+def test_label_token_decoding_falls_back_to_the_labels_in_the_top_logprobs(conversation):
+    backend = DroppingMockBackend(get_config(label_confidence=0.6))
+    results = classify_chunks(get_model_wrapper(backend), conversation)
+
+    # The other labels share the remaining mass equally; the first of them wins.
+    for result in results.values():
+        assert len(result.label_probabilities) == len(LABELS) - 1
+        assert result.probability == pytest.approx(1 / (len(LABELS) - 1))
+        assert result.label.value in result.label_probabilities
+
+
+def test_label_token_decoding_without_any_label_is_unparseable(conversation):
+    backend = DroppingMockBackend(get_config(), drop_all=True)
+    with pytest.raises(AssertionError):
+        classify_chunks(get_model_wrapper(backend), conversation)
+    assert metrics.ERRORS.total(error_type="unparseable_response") >= 1
+
+
+def test_structured_decoding_reads_the_label_probability(conversation):
+    backend = mock_backend.MockBackend(get_config(label_confidence=0.8))
+    model_wrapper = classification.ModelWrapper(
+        openai_client=mock_backend.get_backend_client(backend, max_retries=0),
+        model="gpt-4o-mini",
+        request_logprobs=True,
+    )
+    results = classify_chunks(model_wrapper, conversation)
+    assert all(result.probability == pytest.approx(0.8) for result in results.values())
+    assert all(result.label_probabilities is None for result in results.values())
@@ -0,0 +1,117 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.classification as classification
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.mock_backend as mock_backend
+import examples.run_hierarchical_emoclassifiers_v1
+import run_hierarchical_emoclassifiers_v1
+from emoclassifiers.chunking import Chunk
+
+YES = classification.YesNoUnsureEnum.YES
+NO = classification.YesNoUnsureEnum.NO
+TOP_LEVEL_DEFINITION = next(iter(classification.load_classifier_definitions("v1_top_level").values()))
+
+
+def get_long_conversation(num_messages: int = 30) -> list[dict]:
+    return [
+        {"role": "user" if idx % 2 == 0 else "assistant", "content": f"This is message {idx}."}
+        for idx in range(num_messages)
+    ]
+
+
+def get_yes_model_wrapper() -> tuple[classification.ModelWrapper, mock_backend.MockBackend]:
+    client, backend = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(
+            latency_distribution="constant",
+            latency_mean=0.0,
+            label_weights={"no": 0.0, "unsure": 0.0},
+        ),
+        max_retries=0,
+    )
+    return classification.ModelWrapper(openai_client=client, model="gpt-4o-mini"), backend
+
+
+class FixedResponseModelWrapper(classification.ModelWrapper):
+    """
+    Answers every request with a localized "yes" pointing at `message_indices`.
+    """
+    def __init__(self, message_indices: list[int]):
+        super().__init__(openai_client=SimpleNamespace())
+        self.message_indices = message_indices
+
+    async def request_completion(self, **kwargs):
+        parsed = SimpleNamespace(response=YES, message_indices=self.message_indices)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed, refusal=None))])
+
+
+def test_localized_prompt_numbers_messages_by_conversation_index():
+    conversation = get_long_conversation(6)
+    chunk = Chunk(chunk=conversation[2:5], touches_start=False)
+    prompt = classification.get_localized_prompt(TOP_LEVEL_DEFINITION, chunk, start=2)
+    assert '[2] [USER] "This is message 2."' in prompt
+    assert '[4] [USER] "This is message 4."' in prompt
+    assert "[5]" not in prompt
+    assert "(This is the start of the conversation.)" not in prompt
+
+
+def test_localized_yes_carries_message_indices():
+    model_wrapper, _ = get_yes_model_wrapper()
+    conversation = get_long_conversation()
+    classifier = classification.EmoClassifier(TOP_LEVEL_DEFINITION, model_wrapper=model_wrapper, localize=True)
+    results = asyncio.run(classifier.classify_conversation_detailed(conversation))
+    assert list(results) == [0]
+    assert results[0].label == YES
+    assert results[0].message_indices
+    assert all(0 <= idx < len(conversation) for idx in results[0].message_indices)
+
+
+def test_indices_outside_the_chunk_are_dropped():
+    model_wrapper = FixedResponseModelWrapper(message_indices=[1, 3, 7, 40])
+    chunk = Chunk(chunk=get_long_conversation(8)[2:8], touches_start=False)
+    result = asyncio.run(model_wrapper.classify_conversation_chunk_localized(TOP_LEVEL_DEFINITION, chunk, start=2))
+    assert result.message_indices == [3, 7]
+
+
+def test_neighborhood_chunk_ids():
+    localized = {0: classification.ChunkClassification(label=YES, message_indices=[5, 20])}
+    negative = {0: classification.ChunkClassification(label=NO, message_indices=[])}
+    assert classification.get_neighborhood_chunk_ids([localized, negative], radius=1) == {4, 5, 6, 19, 20, 21}
+    assert classification.get_neighborhood_chunk_ids([negative], radius=1) == set()
+    # A "yes" without indices cannot be localized: every chunk is classified.
+    unlocalized = {0: classification.ChunkClassification(label=YES)}
+    assert classification.get_neighborhood_chunk_ids([localized, unlocalized], radius=1) is None
+
+
+def run_hierarchical(runner, conversation: list[dict], gating_neighborhood: int | None) -> tuple[dict, int]:
+    model_wrapper, backend = get_yes_model_wrapper()
+    dependency_graph = io_utils.load_json(io_utils.get_path(
+        "assets/definitions/emoclassifiers_v1_dependency.json"
+    ))["dependency"]
+    result = asyncio.run(runner.run_classification_on_single_conversation(
+        conversation=conversation,
+        top_level_classifiers=classification.load_classifiers(
+            "v1_top_level", model_wrapper=model_wrapper, localize=gating_neighborhood is not None,
+        ),
+        sub_classifiers=classification.load_classifiers("v1", model_wrapper=model_wrapper),
+        dependency_graph=dependency_graph,
+        aggregator=aggregation.AGGREGATOR_DICT["any"],
+        gating_neighborhood=gating_neighborhood,
+    ))
+    return result, backend.stats["requests"]
+
+
+@pytest.mark.parametrize("runner", [run_hierarchical_emoclassifiers_v1, examples.run_hierarchical_emoclassifiers_v1])
+def test_gating_neighborhood_skips_distant_chunks(runner):
+    conversation = get_long_conversation()
+    result, num_requests = run_hierarchical(runner, conversation, gating_neighborhood=None)
+    localized_result, localized_num_requests = run_hierarchical(runner, conversation, gating_neighborhood=1)
+
+    assert "trigger_indices" not in result
+    assert localized_result["top_level"] == result["top_level"]
+    assert set(localized_result["trigger_indices"]) == set(result["top_level"])
+    assert all(localized_result["trigger_indices"].values())
+    assert localized_num_requests < num_requests
@@ -0,0 +1,97 @@
+import asyncio
+
+import emoclassifiers.classification as classification
+import emoclassifiers.packing as packing
+import emoclassifiers.prompt_templates as prompt_templates
+from emoclassifiers.chunking import CHUNKER_DICT, estimate_num_tokens
+
+DEFINITION = classification.load_classifier_definitions("v2")["share_emotions"]
+
+
+def get_long_conversation(num_messages: int = 40) -> list[dict]:
+    return [
+        {"role": "user" if idx % 2 == 0 else "assistant", "content": f"Message number {idx}. " * 10}
+        for idx in range(num_messages)
+    ]
+
+
+class DroppingModelWrapper(classification.ModelWrapper):
+    """
+    Drops the first target of every packed response, as a model leaving out an index would.
+    """
+    async def classify_packed_window(self, classifier_definition, simple_convo, window, **kwargs):
+        results = await super().classify_packed_window(classifier_definition, simple_convo, window, **kwargs)
+        results.pop(window.target_ids[0], None)
+        return results
+
+
+def test_windows_cover_every_target_once_within_budget():
+    conversation = get_long_conversation()
+    chunks = CHUNKER_DICT["user_message"].chunk_simple_convo(conversation)
+    windows = packing.plan_packed_windows(conversation, chunks, max_tokens=300)
+
+    assert len(windows) > 1
+    assert sorted(target_id for window in windows for target_id in window.target_ids) == sorted(chunks)
+    for window in windows:
+        assert window.start == max(0, window.target_ids[0] - 3)
+        assert window.end == window.target_ids[-1]
+        if len(window.target_ids) > 1 and window.start > 0:
+            assert estimate_num_tokens(packing.render_packed_window(conversation, window)) <= 300
+
+
+def test_oversized_target_gets_its_own_window():
+    conversation = get_long_conversation(6)
+    conversation[2]["content"] = "word " * 5000
+    chunks = CHUNKER_DICT["user_message"].chunk_simple_convo(conversation)
+    windows = packing.plan_packed_windows(conversation, chunks, max_tokens=500)
+    assert [window.target_ids for window in windows] == [[0], [2], [4]]
+
+
+def test_rendered_window_marks_targets_without_truncating():
+    conversation = get_long_conversation(6)
+    conversation[3]["content"] = "x" * 5000
+    window = packing.PackedWindow(start=0, end=4, target_ids=[2, 4])
+    lines = packing.render_packed_window(conversation, window).split("\n")
+    assert lines[0] == "(This is the start of the conversation.)"
+    assert lines[1].startswith('[0] [USER] "')
+    assert lines[3].startswith('[2] [*USER*] "')
+    assert lines[4] == '[3] [ASSISTANT] "' + "x" * 5000 + '"'
+    assert lines[5].startswith('[4] [*USER*] "')
+
+
+def test_packed_notes_by_classifier_set():
+    question_definition = next(iter(classification.load_classifier_definitions("question").values()))
+    assert question_definition["version"] == "v1_top_level"
+    assert packing.get_packed_notes(question_definition) == prompt_templates.PACKED_QUESTION_NOTES
+    # Custom definitions fall back to their version.
+    custom_definition = {key: value for key, value in question_definition.items() if key != "classifier_set"}
+    assert packing.get_packed_notes(custom_definition) == prompt_templates.PACKED_QUESTION_NOTES
+    top_level_definition = next(iter(classification.load_classifier_definitions("v1_top_level").values()))
+    assert packing.get_packed_notes(top_level_definition) == prompt_templates.PACKED_EMOTIONAL_NOTES
+
+
+def test_packed_classification_round_trip(mock_client):
+    client, backend = mock_client
+    conversation = get_long_conversation()
+    model_wrapper = classification.ModelWrapper(openai_client=client, model="gpt-4o-mini")
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=model_wrapper, packed_token_budget=300)
+    results = asyncio.run(classifier.classify_conversation_detailed(conversation))
+
+    chunks = CHUNKER_DICT[DEFINITION["chunker"]].chunk_simple_convo(conversation)
+    windows = packing.plan_packed_windows(conversation, chunks, max_tokens=300)
+    assert list(results) == list(chunks)
+    assert all(isinstance(result.label, classification.YesNoUnsureEnum) for result in results.values())
+    assert backend.stats["requests"] == len(windows) < len(chunks)
+
+
+def test_missing_targets_are_classified_individually(mock_client):
+    client, backend = mock_client
+    conversation = get_long_conversation()
+    model_wrapper = DroppingModelWrapper(openai_client=client, model="gpt-4o-mini")
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=model_wrapper, packed_token_budget=300)
+    results = asyncio.run(classifier.classify_conversation_detailed(conversation))
+
+    chunks = CHUNKER_DICT[DEFINITION["chunker"]].chunk_simple_convo(conversation)
+    windows = packing.plan_packed_windows(conversation, chunks, max_tokens=300)
+    assert list(results) == list(chunks)
+    assert backend.stats["requests"] == 2 * len(windows)
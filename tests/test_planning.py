@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import emoclassifiers.classification as classification
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.mock_backend as mock_backend
+import emoclassifiers.planning as planning
+from emoclassifiers.chunking import CHUNKER_DICT, estimate_num_tokens
+
+DEPENDENCY_GRAPH = io_utils.load_json(io_utils.get_path(
+    "assets/definitions/emoclassifiers_v1_dependency.json"
+))["dependency"]
+
+
+class RequestRecordingMockBackend(mock_backend.MockBackend):
+    def __init__(self, config: mock_backend.MockBackendConfig):
+        super().__init__(config)
+        self.bodies = []
+
+    def handle(self, body: dict) -> tuple[int, dict, dict, float]:
+        self.bodies.append(body)
+        return super().handle(body)
+
+
+def get_estimated_prompt_tokens(body: dict) -> int:
+    """
+    The planner's estimate of the prompt tokens of a request actually sent.
+    """
+    schema_tokens = estimate_num_tokens(json.dumps(body["response_format"]["json_schema"]["schema"]))
+    return estimate_num_tokens(body["messages"][-1]["content"]) + schema_tokens + planning.MESSAGE_OVERHEAD_TOKENS
+
+
+def run_classifiers(definitions: dict[str, dict], conversation: list[dict], **kwargs) -> RequestRecordingMockBackend:
+    backend = RequestRecordingMockBackend(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0),
+    )
+    model_wrapper = classification.ModelWrapper(
+        openai_client=mock_backend.get_backend_client(backend, max_retries=0), model="gpt-4o-mini",
+    )
+
+    async def run():
+        for definition in definitions.values():
+            classifier = classification.EmoClassifier(definition, model_wrapper=model_wrapper, **kwargs)
+            await classifier.classify_conversation_detailed(conversation)
+
+    asyncio.run(run())
+    return backend
+
+
+def test_plan_of_a_fixed_conversation(conversation):
+    definitions = {"share_emotions": classification.load_classifier_definitions("v2")["share_emotions"]}
+    plan = planning.plan_run([conversation], definitions, model="gpt-4o-mini")
+    estimate = plan.upper["share_emotions"]
+
+    assert (estimate.calls, estimate.prompt_tokens, estimate.completion_tokens) == (4, 2514, 32)
+    assert plan.lower["share_emotions"] == estimate
+    backend = run_classifiers(definitions, conversation)
+    assert len(backend.bodies) == estimate.calls
+    assert sum(get_estimated_prompt_tokens(body) for body in backend.bodies) == estimate.prompt_tokens
+
+
+def test_plan_of_localized_top_level_classifiers(conversation):
+    definitions = classification.load_classifier_definitions("v1_top_level")
+    plan = planning.plan_run([conversation], definitions, model="gpt-4o-mini", localize=True)
+    unlocalized_plan = planning.plan_run([conversation], definitions, model="gpt-4o-mini")
+
+    backend = run_classifiers(definitions, conversation, localize=True)
+    assert plan.total("upper").calls == len(backend.bodies) == len(definitions)
+    assert plan.total("upper").prompt_tokens == sum(get_estimated_prompt_tokens(body) for body in backend.bodies)
+    assert plan.total("upper").prompt_tokens > unlocalized_plan.total("upper").prompt_tokens
+    assert plan.total("upper").completion_tokens == planning.LOCALIZED_COMPLETION_TOKENS * len(definitions)
+
+
+def test_plan_bounds_of_gated_classifiers(conversation, capsys):
+    top_level_definitions = classification.load_classifier_definitions("v1_top_level")
+    sub_definitions = classification.load_classifier_definitions("v1")
+    plan = planning.plan_run(
+        [conversation], top_level_definitions, model="gpt-4o-mini",
+        gated_definitions=sub_definitions, dependency_graph=DEPENDENCY_GRAPH,
+        localize=True, gating_neighborhood=1,
+    )
+
+    num_sub_chunks = sum(
+        len(CHUNKER_DICT[definition["chunker"]].chunk_simple_convo(conversation))
+        for name, definition in sub_definitions.items() if DEPENDENCY_GRAPH[name]
+    )
+    assert plan.total("lower").calls == len(top_level_definitions)
+    assert plan.total("upper").calls == len(top_level_definitions) + num_sub_chunks
+    assert all(plan.lower[name].calls == 0 for name in sub_definitions)
+    plan.print_report(max_concurrent=10)
+    assert "the upper bound assumes every chunk is" in capsys.readouterr().out
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import emoclassifiers.classification as classification
+import emoclassifiers.prescreen as prescreen
+from emoclassifiers.chunking import Chunk
+
+
+def get_definition() -> dict:
+    return classification.load_classifier_definitions("question_tree")["QUESTION_TYPE"]
+
+
+def get_chunk(content: str) -> Chunk:
+    return Chunk.from_simple_convo([{"role": "user", "content": content}], idx=0)
+
+
+@pytest.mark.parametrize("content, rule_type", [
+    ("", "max_length"),
+    ("...!! 42", "regex"),
+    ("Thank you!", "regex"),
+    ("I had a long day at work", "no_interrogative"),
+])
+def test_prescreen_chunk_decides_trivial_messages(content, rule_type):
+    assert prescreen.prescreen_chunk(get_definition(), get_chunk(content)) == ("no_question", rule_type)
+
+
+@pytest.mark.parametrize("content", [
+    "Is it normal to feel this way",
+    "I wonder whether I should call her",
+    "Warum bin ich so müde? Ich schlafe genug",
+    "Мне грустно сегодня",
+    "I had a long day at work and now I just want to sit quietly and not think about anything",
+])
+def test_prescreen_chunk_sends_possible_questions_to_the_model(content):
+    assert prescreen.prescreen_chunk(get_definition(), get_chunk(content)) == (None, None)
+
+
+def test_prescreen_chunk_without_rules():
+    definition = classification.load_classifier_definitions("v2")
+    definition = next(iter(definition.values()))
+    assert prescreen.prescreen_chunk(definition, get_chunk("")) == (None, None)
+
+
+def test_wrapper_skips_api_calls_for_decided_chunks(mock_client, conversation):
+    client, backend = mock_client
+    model_wrapper = prescreen.PreScreenModelWrapper(classification.ModelWrapper(openai_client=client, model="gpt-4o-mini"))
+    classifier = classification.EmoClassifier(get_definition(), model_wrapper=model_wrapper)
+    results = asyncio.run(classifier.classify_conversation_detailed(conversation))
+
+    # "hi" and "thanks" are decided locally; the two questions go to the model.
+    assert results[0].label == classification.QuestionTypeEnum.NO_QUESTION
+    assert results[0].model == "prescreen"
+    assert results[4].model == "prescreen"
+    assert results[2].model == results[6].model == "gpt-4o-mini"
+    assert backend.stats["requests"] == 2
+    stats = model_wrapper.stats.report()["QUESTION_TYPE"]
+    assert stats["total"] == 4
+    assert stats["skipped"] == 2
+    assert stats["skipped_by_rule"] == {"regex": 2}
+
+
+def test_wrapper_audits_skipped_chunks(mock_client, conversation):
+    client, backend = mock_client
+    model_wrapper = prescreen.PreScreenModelWrapper(
+        classification.ModelWrapper(openai_client=client, model="gpt-4o-mini"),
+        audit_rate=1.0,
+    )
+    classifier = classification.EmoClassifier(get_definition(), model_wrapper=model_wrapper)
+    results = asyncio.run(classifier.classify_conversation_detailed(conversation))
+
+    # Audits are only measured: the local decision is still returned.
+    assert results[0].model == "prescreen"
+    assert backend.stats["requests"] == 4
+    stats = model_wrapper.stats.report()["QUESTION_TYPE"]
+    assert stats["audited"] == 2
+    assert stats["audit_agreement"] == (2 - len(stats["disagreements"])) / 2
+
+
+def test_disabled_wrapper_sends_every_chunk(mock_client, conversation):
+    client, backend = mock_client
+    model_wrapper = prescreen.PreScreenModelWrapper(
+        classification.ModelWrapper(openai_client=client, model="gpt-4o-mini"),
+        enabled=False,
+    )
+    classifier = classification.EmoClassifier(get_definition(), model_wrapper=model_wrapper)
+    asyncio.run(classifier.classify_conversation(conversation))
+    assert backend.stats["requests"] == 4
+    assert model_wrapper.stats.report()["QUESTION_TYPE"]["skipped"] == 0
+
+
+def test_wrapper_rejects_packed_and_localized_classifiers(mock_client):
+    client, _ = mock_client
+    model_wrapper = prescreen.PreScreenModelWrapper(classification.ModelWrapper(openai_client=client))
+    with pytest.raises(ValueError):
+        classification.EmoClassifier(get_definition(), model_wrapper=model_wrapper, packed_token_budget=1000)
+    top_level_definition = next(iter(classification.load_classifier_definitions("v1_top_level").values()))
+    with pytest.raises(ValueError):
+        classification.EmoClassifier(top_level_definition, model_wrapper=model_wrapper, localize=True)
@@ -0,0 +1,128 @@
+import asyncio
+import subprocess
+import sys
+import time
+
+import httpx
+import openai
+import pytest
+
+import emoclassifiers.classification as classification
+import emoclassifiers.mock_backend as mock_backend
+import emoclassifiers.rate_limiting as rate_limiting
+
+
+def get_rate_limit_error(retry_after: str | None = None) -> openai.RateLimitError:
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "http://mock-backend/v1/chat/completions"))
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def test_request_bucket_allows_a_burst_then_waits(tmp_path):
+    bucket = rate_limiting.SharedTokenBucket(rpm=60, path=str(tmp_path / "state"))
+    assert [bucket.try_acquire(1) for _ in range(5)] == [0.0] * 5
+    assert bucket.try_acquire(1) == pytest.approx(1.0, abs=0.05)
+
+
+def test_token_bucket_counts_tokens(tmp_path):
+    bucket = rate_limiting.SharedTokenBucket(tpm=600, path=str(tmp_path / "state"))
+    assert bucket.try_acquire(40) == 0.0
+    # 10 tokens left, refilled at 10 per second.
+    assert bucket.try_acquire(40) == pytest.approx(3.0, abs=0.05)
+    # A request larger than the bucket only waits for a full one.
+    assert bucket.try_acquire(1000) == pytest.approx(4.0, abs=0.05)
+
+
+def test_buckets_are_shared_across_processes(tmp_path):
+    path = str(tmp_path / "state")
+    # 5 requests, refilled slowly enough that starting the process does not matter.
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import emoclassifiers.rate_limiting as rate_limiting;"
+            f"bucket = rate_limiting.SharedTokenBucket(rpm=6, burst_seconds=50, path={path!r});"
+            "assert [bucket.try_acquire(1) for _ in range(3)] == [0.0] * 3",
+        ],
+        check=True,
+    )
+    bucket = rate_limiting.SharedTokenBucket(rpm=6, burst_seconds=50, path=path)
+    assert [bucket.try_acquire(1) for _ in range(2)] == [0.0] * 2
+    assert bucket.try_acquire(1) > 0
+
+
+def test_acquire_waits_for_the_bucket(tmp_path):
+    bucket = rate_limiting.SharedTokenBucket(rpm=600, path=str(tmp_path / "state"), burst_seconds=0.1)
+
+    async def run():
+        for _ in range(3):
+            await bucket.acquire(1)
+
+    start_time = time.perf_counter()
+    asyncio.run(run())
+    assert time.perf_counter() - start_time >= 0.18
+    assert bucket.num_waits == 2
+
+
+def test_retry_delay_honours_retry_after():
+    assert rate_limiting.get_retry_delay(get_rate_limit_error("2"), attempt=0) == 2.0
+    assert rate_limiting.get_retry_delay(get_rate_limit_error("60"), attempt=0) == rate_limiting.MAX_RETRY_DELAY
+    assert 0.75 <= rate_limiting.get_retry_delay(get_rate_limit_error(), attempt=1) <= 1.0
+    assert rate_limiting.get_retry_delay(ValueError(), attempt=10) <= rate_limiting.MAX_RETRY_DELAY
+
+
+def test_retries_are_rate_limited(tmp_path):
+    bucket = rate_limiting.SharedTokenBucket(rpm=60, path=str(tmp_path / "state"))
+    openai_client = openai.AsyncOpenAI(api_key="mock", base_url="http://mock-backend/v1", max_retries=2)
+    attempts = []
+
+    async def send_request(client):
+        # The client itself must not retry.
+        assert client.max_retries == 0
+        attempts.append(time.perf_counter())
+        if len(attempts) < 3:
+            raise get_rate_limit_error("0")
+        return "response"
+
+    assert asyncio.run(bucket.send_with_retries(send_request, openai_client, num_tokens=10)) == "response"
+    assert len(attempts) == 3
+    assert bucket.num_retries == 2
+    # The first attempt was acquired by the caller; each retry took a request from the bucket.
+    assert [bucket.try_acquire(1) for _ in range(3)] == [0.0] * 3
+    assert bucket.try_acquire(1) > 0
+
+
+def test_retries_give_up_after_max_retries(tmp_path):
+    bucket = rate_limiting.SharedTokenBucket(path=str(tmp_path / "state"))
+    openai_client = openai.AsyncOpenAI(api_key="mock", base_url="http://mock-backend/v1", max_retries=1)
+
+    async def send_request(client):
+        raise get_rate_limit_error("0")
+
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(bucket.send_with_retries(send_request, openai_client, num_tokens=10))
+    assert bucket.num_retries == 1
+
+    async def fail(client):
+        raise ValueError("not retryable")
+
+    with pytest.raises(ValueError):
+        asyncio.run(bucket.send_with_retries(fail, openai_client, num_tokens=10))
+    assert bucket.num_retries == 1
+
+
+def test_model_wrapper_retries_429s_through_the_limiter(tmp_path, conversation):
+    client, backend = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0, rate_limit_rate=0.3, seed=1),
+        max_retries=5,
+    )
+    bucket = rate_limiting.SharedTokenBucket(rpm=6000, tpm=10_000_000, path=str(tmp_path / "state"))
+    model_wrapper = classification.ModelWrapper(openai_client=client, model="gpt-4o-mini", rate_limiter=bucket)
+    definition = classification.load_classifier_definitions("v2")["share_emotions"]
+    classifier = classification.EmoClassifier(definition, model_wrapper=model_wrapper)
+    results = asyncio.run(classifier.classify_conversation(conversation))
+
+    assert len(results) == 4
+    assert backend.stats["rate_limited"] > 0
+    assert bucket.num_retries == backend.stats["rate_limited"]
+    assert backend.stats["requests"] == 4 + backend.stats["rate_limited"]
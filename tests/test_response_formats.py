@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import pydantic
+import pytest
+
+import emoclassifiers.classification as classification
+import emoclassifiers.mock_backend as mock_backend
+from emoclassifiers.chunking import CHUNKER_DICT
+
+LABEL_ENUMS = [classification.YesNoUnsureEnum, classification.QuestionTypeEnum, classification.IntentTypeEnum]
+
+
+class RecordingMockBackend(mock_backend.MockBackend):
+    """
+    Keeps the response formats sent and the contents answered.
+    """
+    def __init__(self, config: mock_backend.MockBackendConfig):
+        super().__init__(config)
+        self.response_formats = []
+        self.contents = []
+
+    def handle(self, body: dict) -> tuple[int, dict, dict, float]:
+        self.response_formats.append(body.get("response_format"))
+        status, headers, payload, latency = super().handle(body)
+        self.contents.append(payload["choices"][0]["message"]["content"])
+        return status, headers, payload, latency
+
+
+@pytest.mark.parametrize("label_enum", LABEL_ENUMS)
+def test_narrowed_format_admits_only_its_labels(label_enum):
+    response_format = classification.get_response_format_for_label_enum(label_enum)
+    assert response_format is classification.get_response_format_for_label_enum(label_enum)
+    for label in label_enum:
+        assert response_format.model_validate_json(json.dumps({"response": label.value})).response == label
+    other_labels = {label.value for other in LABEL_ENUMS for label in other} - {label.value for label in label_enum}
+    for value in other_labels:
+        with pytest.raises(pydantic.ValidationError):
+            response_format.model_validate({"response": value})
+    with pytest.raises(pydantic.ValidationError):
+        response_format.model_validate({"response": next(iter(label_enum)).value, "reasoning": "because"})
+    with pytest.raises(pydantic.ValidationError):
+        response_format.model_validate({})
+
+
+@pytest.mark.parametrize("label_enum", LABEL_ENUMS)
+def test_narrowed_format_parses_like_the_union_format(label_enum):
+    response_format = classification.get_response_format_for_label_enum(label_enum)
+    for label in label_enum:
+        content = json.dumps({"response": label.value})
+        assert response_format.model_validate_json(content).response == classification.ResponseFormat.model_validate_json(content).response
+
+
+def test_label_sets_of_definitions():
+    definitions = classification.load_classifier_definitions("v1")
+    definition = next(iter(definitions.values()))
+    assert classification.get_label_enum(definition) is classification.YesNoUnsureEnum
+    assert classification.get_label_enum({**definition, "label_set": "intent_type"}) is classification.IntentTypeEnum
+    question_definition = classification.load_classifier_definitions("question_tree")["QUESTION_TYPE"]
+    assert classification.get_label_enum(question_definition) is classification.QuestionTypeEnum
+
+
+@pytest.mark.parametrize("classifier_set", ["v2", "question_tree"])
+def test_requests_send_the_narrowed_schema(classifier_set, conversation):
+    backend = RecordingMockBackend(mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0))
+    model_wrapper = classification.ModelWrapper(
+        openai_client=mock_backend.get_backend_client(backend, max_retries=0), model="gpt-4o-mini",
+    )
+    definition = next(iter(classification.load_classifier_definitions(classifier_set).values()))
+    chunks = CHUNKER_DICT[definition["chunker"]].chunk_simple_convo(conversation)
+
+    async def run():
+        return await asyncio.gather(*(
+            model_wrapper.classify_conversation_chunk_detailed(definition, chunk) for chunk in chunks.values()
+        ))
+
+    results = asyncio.run(run())
+    label_values = [label.value for label in classification.get_label_enum(definition)]
+    for response_format in backend.response_formats:
+        schema = response_format["json_schema"]["schema"]
+        assert set(schema["properties"]) == {"response"}
+        assert schema["required"] == ["response"]
+        assert schema["additionalProperties"] is False
+        assert mock_backend.find_enum(schema) == label_values
+    # The labels parsed match what the unnarrowed format parses from the same responses.
+    assert [result.label for result in results] == [
+        classification.ResponseFormat.model_validate_json(content).response for content in backend.contents
+    ]
@@ -0,0 +1,136 @@
+import asyncio
+
+import emoclassifiers.classification as classification
+import emoclassifiers.scheduling as scheduling
+
+
+async def get_service_order(scheduler, requests: list[tuple[str, int, str | None, str | None]]) -> list[str]:
+    """
+    Queue `requests` (name, priority, group, flow) behind a held slot of a single-slot
+    scheduler, and return the order in which they are served.
+    """
+    order = []
+
+    async def request(name: str, priority: int, group: str | None, flow: str | None):
+        async with scheduler.slot(priority=priority, group=group, flow=flow):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async with scheduler.slot():
+        tasks = [asyncio.create_task(request(*args)) for args in requests]
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def get_requests(group: str, num_requests: int, flow: str | None = None, priority: int = scheduling.DEFAULT_PRIORITY):
+    return [(f"{group}{i}", priority, group, flow) for i in range(num_requests)]
+
+
+def test_fifo_serves_in_arrival_order():
+    requests = get_requests("a", 3) + get_requests("b", 2) + get_requests("gate", 1, priority=scheduling.GATING_PRIORITY)
+    order = asyncio.run(get_service_order(scheduling.FIFOScheduler(1), requests))
+    assert order == ["a0", "a1", "a2", "b0", "b1", "gate0"]
+
+
+def test_fair_serves_gating_first_then_alternates_groups():
+    requests = get_requests("a", 4) + get_requests("b", 2) + get_requests("gate", 1, priority=scheduling.GATING_PRIORITY)
+    order = asyncio.run(get_service_order(scheduling.FairScheduler(1), requests))
+    assert order == ["gate0", "a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+def test_fair_weights_groups():
+    requests = get_requests("a", 4) + get_requests("b", 4)
+    order = asyncio.run(get_service_order(scheduling.FairScheduler(1, group_weights={"a": 2.0}), requests))
+    assert order[:6] == ["a0", "b0", "a1", "a2", "b1", "a3"]
+
+
+def test_fair_alternates_flows_within_a_group():
+    requests = get_requests("long", 3, flow="conversation 0") + get_requests("short", 1, flow="conversation 1")
+    requests = [(name, priority, "v2", flow) for name, priority, _, flow in requests]
+    order = asyncio.run(get_service_order(scheduling.FairScheduler(1), requests))
+    assert order == ["long0", "short0", "long1", "long2"]
+
+
+def test_cancelled_waiters_do_not_leak_slots():
+    async def run():
+        scheduler = scheduling.FairScheduler(2)
+        served = []
+
+        async def request(name: str):
+            async with scheduler.slot(group=name):
+                served.append(name)
+                await asyncio.sleep(0.01)
+
+        tasks = [asyncio.create_task(request(f"r{i}")) for i in range(6)]
+        await asyncio.sleep(0)
+        tasks[3].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return scheduler, served
+
+    scheduler, served = asyncio.run(run())
+    assert sorted(served) == ["r0", "r1", "r2", "r4", "r5"]
+    assert scheduler.available == 2
+    assert scheduler.num_waiting == 0
+
+
+def test_priority_by_classifier_set():
+    top_level_definition = next(iter(classification.load_classifier_definitions("v1_top_level").values()))
+    question_definition = next(iter(classification.load_classifier_definitions("question").values()))
+    # The question set shares the v1_top_level version, but does not gate anything.
+    assert question_definition["version"] == top_level_definition["version"]
+    assert scheduling.get_priority(top_level_definition) == scheduling.GATING_PRIORITY
+    assert scheduling.get_priority(question_definition) == scheduling.DEFAULT_PRIORITY
+    assert scheduling.get_classifier_set(question_definition) == "question"
+    assert scheduling.get_priority({**question_definition, "priority": 0}) == 0
+    # Custom definitions fall back to their version.
+    assert scheduling.get_classifier_set({"version": "v2"}) == "v2"
+
+
+def test_fair_model_wrapper_releases_every_slot(mock_client, conversation):
+    client, backend = mock_client
+    model_wrapper = classification.ModelWrapper(openai_client=client, model="gpt-4o-mini", max_concurrent=2, scheduler="fair")
+    classifiers = list(classification.load_classifiers("v1_top_level", model_wrapper=model_wrapper).values())
+    classifiers += list(classification.load_classifiers("v2", model_wrapper=model_wrapper).values())[:3]
+
+    async def run():
+        return await asyncio.gather(*(classifier.classify_conversation(conversation) for classifier in classifiers))
+
+    results = asyncio.run(run())
+    assert len(results) == len(classifiers)
+    assert model_wrapper.scheduler.available == 2
+    assert model_wrapper.scheduler.num_waiting == 0
+
+
+def test_fair_model_wrapper_shares_slots_across_conversations(mock_client, conversation):
+    client, _ = mock_client
+    model_wrapper = classification.ModelWrapper(openai_client=client, model="gpt-4o-mini", max_concurrent=1, scheduler="fair")
+    classifiers = list(classification.load_classifiers("v2", model_wrapper=model_wrapper).values())[:6]
+    long_conversation = conversation * 4
+    flows = []
+    slot = model_wrapper.scheduler.slot
+
+    def recording_slot(**kwargs):
+        flows.append(kwargs["flow"])
+        return slot(**kwargs)
+
+    model_wrapper.scheduler.slot = recording_slot
+    finished = []
+
+    async def classify(name: str, conversation: list[dict]):
+        await asyncio.gather(*(classifier.classify_conversation(conversation) for classifier in classifiers))
+        finished.append(name)
+
+    async def run():
+        # No tracing: the flow comes from `with_flow` alone.
+        await asyncio.gather(
+            scheduling.with_flow(classify("long", long_conversation), flow="long"),
+            scheduling.with_flow(classify("short", conversation), flow="short"),
+        )
+
+    asyncio.run(run())
+    assert set(flows) == {"long", "short"}
+    assert flows.count("long") == 4 * flows.count("short")
+    # The short conversation is not queued behind all the requests of the long one.
+    assert finished == ["short", "long"]
+    assert scheduling.FLOW.get() is None
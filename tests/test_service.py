@@ -0,0 +1,86 @@
+import asyncio
+import sys
+
+import pytest
+
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.classification as classification
+import emoclassifiers.mock_backend as mock_backend
+import run_classification_service
+
+
+def get_service(latency: float = 0.05, **kwargs) -> run_classification_service.ClassificationService:
+    client, _ = mock_backend.get_mock_client(
+        mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=latency),
+        max_retries=0,
+    )
+    model_wrapper = classification.ModelWrapper(openai_client=client, model="gpt-4o-mini")
+    return run_classification_service.ClassificationService(
+        classifier_sets={"question_tree": classification.load_classifiers("question_tree", model_wrapper=model_wrapper)},
+        dependency_graphs={},
+        aggregator=aggregation.AGGREGATOR_DICT["any"],
+        **kwargs,
+    )
+
+
+def get_conversations(conversation: list[dict], num_conversations: int) -> list[list[dict]]:
+    return [conversation + [{"role": "user", "content": f"Question {idx}?"}] for idx in range(num_conversations)]
+
+
+def test_conversations_wait_in_the_queue_for_capacity(conversation):
+    async def run():
+        service = get_service(max_in_progress=2)
+        service.start()
+        tasks = [asyncio.create_task(service.submit(row)) for row in get_conversations(conversation, 5)]
+        await asyncio.sleep(0.01)
+        report = service.report()
+        results = await asyncio.gather(*tasks)
+        service.dispatcher_task.cancel()
+        return report, results, service.report()
+
+    report, results, final_report = asyncio.run(run())
+    assert (report["in_progress"], report["queued"]) == (2, 3)
+    assert all("question_tree" in result for result in results)
+    assert final_report["classified"] == 5 and final_report["queued"] == final_report["in_progress"] == 0
+
+
+def test_identical_conversations_are_classified_once(conversation):
+    async def run():
+        service = get_service()
+        service.start()
+        results = await asyncio.gather(*(service.submit(conversation) for _ in range(3)))
+        service.dispatcher_task.cancel()
+        return results, service.report()
+
+    results, report = asyncio.run(run())
+    assert results[0] == results[1] == results[2]
+    assert (report["submitted"], report["coalesced"], report["classified"]) == (3, 2, 1)
+
+
+def test_full_queue_rejects_and_stale_conversations_are_shed(conversation):
+    async def run():
+        service = get_service(latency=0.2, max_in_progress=1, max_queue_size=2, max_queue_wait=0.1)
+        service.start()
+        rows = get_conversations(conversation, 4)
+        first = asyncio.create_task(service.submit(rows[0]))
+        await asyncio.sleep(0.01)
+        queued = [asyncio.create_task(service.submit(row)) for row in rows[1:3]]
+        await asyncio.sleep(0)
+        with pytest.raises(run_classification_service.ServiceOverloadedError):
+            await service.submit(rows[3])
+        outcomes = await asyncio.gather(first, *queued, return_exceptions=True)
+        service.dispatcher_task.cancel()
+        return outcomes, service.report()
+
+    outcomes, report = asyncio.run(run())
+    assert "question_tree" in outcomes[0]
+    assert all(isinstance(outcome, run_classification_service.ServiceOverloadedError) for outcome in outcomes[1:])
+    assert (report["rejected"], report["shed"], report["classified"]) == (1, 2, 1)
+
+
+def test_mock_backend_cannot_be_combined_with_endpoints(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys, "argv", [
+        "run_classification_service.py", "--mock_backend", "--endpoints_path", str(tmp_path / "endpoints.json"),
+    ])
+    with pytest.raises(SystemExit):
+        run_classification_service.main()
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+import emoclassifiers.aggregation as aggregation
+import emoclassifiers.classification as classification
+import emoclassifiers.io_utils as io_utils
+import emoclassifiers.mock_backend as mock_backend
+import emoclassifiers.usage as usage
+import run_hierarchical_emoclassifiers_v1
+
+DEFINITION = classification.load_classifier_definitions("v2")["share_emotions"]
+
+
+def get_model_wrapper(client, usage_tracker: usage.UsageTracker) -> classification.ModelWrapper:
+    return classification.ModelWrapper(openai_client=client, model="gpt-4o-mini", usage_tracker=usage_tracker)
+
+
+async def classify_share_emotions(model_wrapper: classification.ModelWrapper, conversation_list: list[list[dict]]):
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=model_wrapper)
+    for conversation in conversation_list:
+        await classifier.classify_conversation(conversation)
+
+
+async def classify_hierarchical(
+    model_wrapper: classification.ModelWrapper,
+    conversation_list: list[list[dict]],
+    usage_tracker: usage.UsageTracker | None = None,
+) -> list[dict]:
+    dependency_graph = io_utils.load_json(io_utils.get_path(
+        "assets/definitions/emoclassifiers_v1_dependency.json"
+    ))["dependency"]
+    return await run_hierarchical_emoclassifiers_v1.run_classification(
+        conversation_list=conversation_list,
+        top_level_classifiers=classification.load_classifiers("v1_top_level", model_wrapper=model_wrapper),
+        sub_classifiers=classification.load_classifiers("v1", model_wrapper=model_wrapper),
+        dependency_graph=dependency_graph,
+        aggregator=aggregation.AGGREGATOR_DICT["any"],
+        usage_tracker=usage_tracker,
+    )
+
+
+def test_usage_is_recorded_per_classifier(mock_client, conversation):
+    client, backend = mock_client
+    usage_tracker = usage.UsageTracker()
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=get_model_wrapper(client, usage_tracker))
+    asyncio.run(classifier.classify_conversation(conversation))
+
+    report = usage_tracker.report()
+    assert report["total"]["calls"] == backend.stats["requests"] == 4
+    assert report["total"]["prompt_tokens"] > 0
+    assert report["total"]["cost"] > 0
+    assert report["by_classifier"] == [{
+        "model": "gpt-4o-mini",
+        "classifier_set": "v2",
+        "classifier": classification.get_classifier_name(DEFINITION),
+        **report["total"],
+    }]
+    assert not report["stopped_by_budget"]
+
+
+def get_spend(conversation_list: list[list[dict]], classify) -> float:
+    """
+    Spend of a run without a budget, to size budgets that cut it off partway.
+    """
+    client, _ = mock_backend.get_mock_client(mock_backend.MockBackendConfig(latency_distribution="constant", latency_mean=0.0))
+    usage_tracker = usage.UsageTracker()
+    asyncio.run(classify(get_model_wrapper(client, usage_tracker), conversation_list))
+    return usage_tracker.spent
+
+
+def test_budget_stops_dispatching(mock_client, conversation):
+    client, backend = mock_client
+    usage_tracker = usage.UsageTracker(budget=get_spend([conversation * 5], classify_share_emotions) / 2)
+    classifier = classification.EmoClassifier(DEFINITION, model_wrapper=get_model_wrapper(client, usage_tracker))
+    with pytest.raises(usage.BudgetExceededError):
+        asyncio.run(classifier.classify_conversation(conversation * 5))
+
+    assert 0 < backend.stats["requests"] < 20
+    assert usage_tracker.exhausted
+    assert usage_tracker.spent <= usage_tracker.budget
+    assert usage_tracker.reserved == pytest.approx(0.0)
+    # Once exhausted, every later request is rejected, however cheap.
+    with pytest.raises(usage.BudgetExceededError):
+        usage_tracker.reserve("gpt-4o-mini", "hi", 1)
+    report = usage_tracker.report()
+    assert report["stopped_by_budget"]
+    assert report["rejected_calls"] >= 2
+
+
+def test_optional_reservations_do_not_stop_the_run():
+    usage_tracker = usage.UsageTracker(budget=1e-4)
+    assert usage_tracker.try_reserve("gpt-4o-mini", "word " * 10000, 20) is None
+    assert not usage_tracker.exhausted
+    reservation = usage_tracker.reserve("gpt-4o-mini", "hi", 20)
+    assert reservation > 0
+    usage_tracker.release(reservation)
+    assert usage_tracker.reserved == 0.0
+
+
+def test_budget_requires_pricing():
+    with pytest.raises(ValueError):
+        usage.UsageTracker(budget=1.0).reserve("unknown-model", "hi", 20)
+
+
+def test_runner_returns_none_for_conversations_cut_off_by_the_budget(mock_client, conversation):
+    client, _ = mock_client
+    conversation_list = [conversation[:4]] * 11
+    # Enough for the first batch of 10 conversations, not the 11th.
+    usage_tracker = usage.UsageTracker(budget=get_spend(conversation_list, classify_hierarchical) * 10.5 / 11)
+    results = asyncio.run(classify_hierarchical(
+        get_model_wrapper(client, usage_tracker), conversation_list, usage_tracker=usage_tracker,
+    ))
+
+    assert len(results) == 11
+    assert all(result is not None for result in results[:10])
+    assert results[-1] is None
+    assert usage_tracker.exhausted
+    assert usage_tracker.spent <= usage_tracker.budget
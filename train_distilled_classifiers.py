@@ -0,0 +1,79 @@
+import argparse
+import os
+
+import numpy as np
+
+import emoclassifiers.io_utils as io_utils
+from emoclassifiers.distillation import (
+    HashedLogisticRegression,
+    evaluate_thresholds,
+    load_training_examples,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Train local distilled classifiers from stored LLM classification results."
+    )
+    parser.add_argument("--results_path", type=str, required=True)
+    parser.add_argument("--conversations_path", type=str, required=True)
+    parser.add_argument("--classifier_set", type=str, required=True)
+    parser.add_argument("--layout", type=str, default="classifier", choices=["classifier", "chunk"])
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--num_epochs", type=int, default=5)
+    parser.add_argument("--eval_fraction", type=float, default=0.2)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.7, 0.8, 0.9, 0.95, 0.99])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    examples = load_training_examples(
+        results_path=args.results_path,
+        conversations_path=args.conversations_path,
+        classifier_set=args.classifier_set,
+        layout=args.layout,
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    evaluation_report = {}
+    for key, (texts, labels) in examples.items():
+        order = rng.permutation(len(texts))
+        num_eval = int(len(texts) * args.eval_fraction)
+        eval_idx, train_idx = order[:num_eval], order[num_eval:]
+        model = HashedLogisticRegression(labels=sorted(set(labels)))
+        model.fit(
+            texts=[texts[i] for i in train_idx],
+            labels=[labels[i] for i in train_idx],
+            num_epochs=args.num_epochs,
+            seed=args.seed,
+        )
+        evaluation_report[key] = {
+            "num_train": len(train_idx),
+            "num_eval": num_eval,
+            "thresholds": evaluate_thresholds(
+                model=model,
+                texts=[texts[i] for i in eval_idx],
+                labels=[labels[i] for i in eval_idx],
+                thresholds=args.thresholds,
+            ),
+        }
+        # Refit on all examples for the saved model.
+        model = HashedLogisticRegression(labels=sorted(set(labels)))
+        model.fit(texts=texts, labels=labels, num_epochs=args.num_epochs, seed=args.seed)
+        model.save(os.path.join(args.output_dir, f"{key}.npz"))
+
+        print(f"\n{key} ({len(train_idx)} train / {num_eval} eval)")
+        print("threshold  calls_saved  local_agreement  overall_agreement")
+        for row in evaluation_report[key]["thresholds"]:
+            local_agreement = "n/a" if row["local_agreement"] is None else f"{row['local_agreement']:.3f}"
+            print(
+                f"{row['threshold']:>9.2f}  {row['calls_saved']:>11.3f}"
+                f"  {local_agreement:>15}  {row['overall_agreement']:>17.3f}"
+            )
+
+    report_path = os.path.join(args.output_dir, "evaluation_report.json")
+    io_utils.save_json(evaluation_report, report_path)
+    print(f"\nSaved models and evaluation report to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()